@@ -1,8 +1,278 @@
 import os
+import re
+import time
+import hashlib
+import logging
+import threading
 import jwt
 import requests
-from typing import Dict, Optional
-from cryptography.hazmat.primitives import serialization
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Set
+from services.metrics import timed
+
+logger = logging.getLogger(__name__)
+
+_MAX_AGE_RE = re.compile(r"max-age=(\d+)")
+
+
+class JWKSCache:
+    """JWKSを取得し、kidごとに解析済みの公開鍵オブジェクトを保持するキャッシュ"""
+
+    def __init__(
+        self,
+        jwks_url: str,
+        ttl: int = 3600,
+        min_refresh_interval: float = 30.0,
+        refresh_ahead_ratio: float = 0.1,
+        timeout: float = 5.0
+    ):
+        self.jwks_url = jwks_url
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.refresh_ahead_ratio = refresh_ahead_ratio
+        self.timeout = timeout
+
+        self._session = requests.Session()
+        self._keys: Dict[str, Any] = {}
+        self._expires_at = 0.0
+        self._effective_ttl = float(ttl)
+        self._last_refresh = 0.0
+        # 同時に1回だけ取得する（single-flight）ためのロック
+        self._refresh_lock = threading.Lock()
+        self._background_refreshing = False
+        self._rotation_listeners: List[Callable[[Set[str]], None]] = []
+
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.refresh_errors = 0
+
+    def _ttl_from_headers(self, headers) -> float:
+        """Cache-Controlヘッダーを考慮した有効期限（秒）を算出"""
+        cache_control = headers.get("Cache-Control", "") if headers else ""
+        if "no-store" in cache_control or "no-cache" in cache_control:
+            return self.min_refresh_interval
+        match = _MAX_AGE_RE.search(cache_control)
+        if match:
+            return max(self.min_refresh_interval, min(float(match.group(1)), float(self.ttl)))
+        return float(self.ttl)
+
+    def _parse_keys(self, jwks: Dict) -> Dict[str, Any]:
+        """JWKを公開鍵オブジェクトに変換（リクエストごとの変換を避ける）"""
+        keys = {}
+        for key in jwks.get("keys", []):
+            kid = key.get("kid")
+            if not kid or key.get("kty") != "RSA" or key.get("use", "sig") != "sig":
+                continue
+            try:
+                keys[kid] = jwt.algorithms.RSAAlgorithm.from_jwk(key)
+            except (jwt.InvalidKeyError, ValueError, KeyError) as e:
+                logger.warning(f"Skipping invalid JWK (kid={kid}): {e}")
+        return keys
+
+    def _fetch(self):
+        """JWKSを取得してキャッシュを更新（呼び出し側でロックを保持すること）"""
+        self._last_refresh = time.monotonic()
+        try:
+            response = self._session.get(self.jwks_url, timeout=self.timeout)
+            response.raise_for_status()
+            keys = self._parse_keys(response.json())
+        except Exception:
+            self.refresh_errors += 1
+            raise
+
+        self._effective_ttl = self._ttl_from_headers(response.headers)
+        old_keys = self._keys
+        self._keys = keys
+        self._expires_at = time.monotonic() + self._effective_ttl
+        self.refreshes += 1
+        logger.info(f"JWKS refreshed: {len(keys)} keys, ttl={self._effective_ttl:.0f}s")
+
+        # 削除または差し替えられたkidを通知
+        rotated = {
+            kid for kid, key in old_keys.items()
+            if kid not in keys or keys[kid].public_numbers() != key.public_numbers()
+        }
+        if rotated:
+            logger.info(f"JWKS keys rotated: {sorted(rotated)}")
+            for listener in self._rotation_listeners:
+                try:
+                    listener(rotated)
+                except Exception as e:
+                    logger.warning(f"JWKS rotation listener failed: {e}")
+
+    def add_rotation_listener(self, listener: Callable[[Set[str]], None]):
+        """鍵のローテーション時に呼び出すコールバックを登録（登録済みのものは追加しない）"""
+        if listener not in self._rotation_listeners:
+            self._rotation_listeners.append(listener)
+
+    def refresh(self, kid: Optional[str] = None, force: bool = False):
+        """JWKSを再取得（同時呼び出しは1回の取得にまとめる）"""
+        with self._refresh_lock:
+            now = time.monotonic()
+            # 待っている間に他スレッドが更新済みであれば取得しない
+            if kid is not None and kid in self._keys and now < self._expires_at:
+                return
+            if not force and kid is None and now < self._expires_at:
+                return
+            # 未知のkidによる連続取得を防ぐ
+            if (kid is not None and self._keys
+                    and now - self._last_refresh < self.min_refresh_interval):
+                return
+            self._fetch()
+
+    def _refresh_in_background(self):
+        """有効期限が近い場合にバックグラウンドで更新"""
+        if self._background_refreshing:
+            return
+        self._background_refreshing = True
+
+        def _run():
+            try:
+                with self._refresh_lock:
+                    if time.monotonic() >= self._expires_at - self._effective_ttl * self.refresh_ahead_ratio:
+                        self._fetch()
+            except Exception as e:
+                logger.warning(f"Background JWKS refresh failed: {e}")
+            finally:
+                self._background_refreshing = False
+
+        threading.Thread(target=_run, name="jwks-refresh", daemon=True).start()
+
+    def get_key(self, kid: str) -> Any:
+        """kidに対応する公開鍵オブジェクトを取得"""
+        now = time.monotonic()
+        key = self._keys.get(kid)
+
+        if key is not None and now < self._expires_at:
+            self.hits += 1
+            if now >= self._expires_at - self._effective_ttl * self.refresh_ahead_ratio:
+                self._refresh_in_background()
+            return key
+
+        self.misses += 1
+        try:
+            self.refresh(kid=kid)
+        except Exception as e:
+            # 取得に失敗した場合は期限切れの鍵で継続する
+            if key is not None:
+                logger.warning(f"JWKS refresh failed, using stale key: {e}")
+                return key
+            raise
+
+        key = self._keys.get(kid)
+        if key is None:
+            raise ValueError("Unable to find appropriate signing key")
+        return key
+
+    def stats(self) -> Dict:
+        """キャッシュの統計情報を取得"""
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "refreshes": self.refreshes,
+            "refresh_errors": self.refresh_errors,
+            "keys": len(self._keys),
+            "expires_in": max(0.0, self._expires_at - time.monotonic()),
+        }
+
+
+class VerifiedTokenCache:
+    """検証済みトークンのペイロードをトークンのハッシュをキーに保持するLRUキャッシュ"""
+
+    def __init__(self, max_entries: int = 10000, leeway: int = 0):
+        self.max_entries = max_entries
+        self.leeway = leeway
+        # digest -> (payload, expires_at, kid)
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _digest(token: str) -> str:
+        return hashlib.sha256(token.encode()).hexdigest()
+
+    def get(self, token: str) -> Optional[Dict]:
+        """有効期限内の検証済みペイロードを取得"""
+        if self.max_entries <= 0:
+            return None
+
+        digest = self._digest(token)
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is None:
+                self.misses += 1
+                return None
+            payload, expires_at, _ = entry
+            if time.time() >= expires_at:
+                del self._entries[digest]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(digest)
+            self.hits += 1
+        return dict(payload)
+
+    def put(self, token: str, payload: Dict, kid: str):
+        """検証済みペイロードをexpまで保持"""
+        exp = payload.get("exp")
+        if self.max_entries <= 0 or not isinstance(exp, (int, float)):
+            return
+
+        expires_at = exp + self.leeway
+        if time.time() >= expires_at:
+            return
+
+        digest = self._digest(token)
+        with self._lock:
+            self._entries[digest] = (dict(payload), expires_at, kid)
+            self._entries.move_to_end(digest)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def evict_kids(self, kids: Set[str]):
+        """ローテーションされた鍵で検証されたエントリを削除"""
+        with self._lock:
+            stale = [digest for digest, entry in self._entries.items() if entry[2] in kids]
+            for digest in stale:
+                del self._entries[digest]
+            self.evictions += len(stale)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict:
+        """キャッシュの統計情報を取得"""
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+        }
+
+
+_jwks_caches: Dict[str, JWKSCache] = {}
+_jwks_caches_lock = threading.Lock()
+
+
+def get_jwks_cache(jwks_url: str) -> JWKSCache:
+    """プロセス全体で共有するJWKSキャッシュを取得"""
+    with _jwks_caches_lock:
+        cache = _jwks_caches.get(jwks_url)
+        if cache is None:
+            cache = JWKSCache(
+                jwks_url,
+                ttl=int(os.getenv("AUTH0_JWKS_CACHE_TTL", "3600")),
+                min_refresh_interval=float(os.getenv("AUTH0_JWKS_MIN_REFRESH_INTERVAL", "30")),
+                timeout=float(os.getenv("AUTH0_JWKS_TIMEOUT", "5"))
+            )
+            _jwks_caches[jwks_url] = cache
+        return cache
 
 
 class VerifyToken:
@@ -11,61 +281,85 @@ class VerifyToken:
         self.AUTH0_API_AUDIENCE = os.getenv("AUTH0_API_AUDIENCE")
         self.AUTH0_ISSUER = os.getenv("AUTH0_ISSUER")
         self.AUTH0_ALGORITHMS = os.getenv("AUTH0_ALGORITHMS")
-        
+
         if not all([self.AUTH0_DOMAIN, self.AUTH0_API_AUDIENCE, self.AUTH0_ISSUER, self.AUTH0_ALGORITHMS]):
             raise ValueError("Auth0 environment variables are not properly configured")
-        
-        self._jwks_cache = None
-    
-    def _get_jwks(self) -> Dict:
-        if self._jwks_cache is None:
-            jwks_url = f"https://{self.AUTH0_DOMAIN}/.well-known/jwks.json"
-            response = requests.get(jwks_url)
-            response.raise_for_status()
-            self._jwks_cache = response.json()
-        return self._jwks_cache
-    
-    def _get_signing_key(self, token: str) -> str:
+
+        jwks_url = os.getenv("AUTH0_JWKS_URL") or f"https://{self.AUTH0_DOMAIN}/.well-known/jwks.json"
+        self._jwks_cache = get_jwks_cache(jwks_url)
+
+        self.leeway = int(os.getenv("AUTH0_CLOCK_SKEW_LEEWAY", "0"))
+        self._token_cache = VerifiedTokenCache(
+            max_entries=int(os.getenv("AUTH0_TOKEN_CACHE_SIZE", "10000")),
+            leeway=self.leeway
+        )
+
+    def _get_kid(self, token: str) -> str:
         try:
             unverified_header = jwt.get_unverified_header(token)
         except jwt.DecodeError:
             raise ValueError("Invalid token header")
-        
+
         kid = unverified_header.get("kid")
         if not kid:
             raise ValueError("Token header missing 'kid' claim")
-        
-        jwks = self._get_jwks()
-        for key in jwks["keys"]:
-            if key["kid"] == kid:
-                # Convert JWK to PEM format using PyJWT's RSAAlgorithm
-                rsa_key = jwt.algorithms.RSAAlgorithm.from_jwk(key)
-                # rsa_key is already a public key object
-                key_pem = rsa_key.public_bytes(
-                    encoding=serialization.Encoding.PEM,
-                    format=serialization.PublicFormat.SubjectPublicKeyInfo
-                )
-                return key_pem.decode()
-        
-        raise ValueError("Unable to find appropriate signing key")
-    
+
+        return kid
+
+    def _get_signing_key(self, token: str) -> Any:
+        return self._jwks_cache.get_key(self._get_kid(token))
+
+    def warm_up(self):
+        """JWKSを事前に取得（最初のリクエストで取得を待たせない）"""
+        self._jwks_cache.refresh()
+
+    def stats(self) -> Dict:
+        """JWKSキャッシュと検証済みトークンキャッシュの統計情報を取得"""
+        return {"jwks": self._jwks_cache.stats(), "token_cache": self._token_cache.stats()}
+
+    @timed("auth")
     def verify_token(self, token: str) -> Optional[Dict]:
+        # 検証済みのトークンであれば署名検証を省略
+        cached = self._token_cache.get(token)
+        if cached is not None:
+            return cached
+
         try:
-            signing_key = self._get_signing_key(token)
-            
+            kid = self._get_kid(token)
+            signing_key = self._jwks_cache.get_key(kid)
+
             payload = jwt.decode(
                 token,
                 signing_key,
                 algorithms=[self.AUTH0_ALGORITHMS],
                 audience=self.AUTH0_API_AUDIENCE,
-                issuer=self.AUTH0_ISSUER
+                issuer=self.AUTH0_ISSUER,
+                leeway=self.leeway
             )
-            
+
+            self._token_cache.put(token, payload, kid)
             return payload
-            
+
         except jwt.ExpiredSignatureError:
             raise ValueError("Token has expired")
         except jwt.InvalidTokenError as e:
             raise ValueError(f"Invalid token: {str(e)}")
         except Exception as e:
-            raise ValueError(f"Token verification failed: {str(e)}")
\ No newline at end of file
+            raise ValueError(f"Token verification failed: {str(e)}")
+
+
+_token_verifier: Optional[VerifyToken] = None
+_token_verifier_lock = threading.Lock()
+
+
+def get_token_verifier() -> VerifyToken:
+    """プロセス全体で共有するVerifyTokenインスタンスを取得"""
+    global _token_verifier
+    if _token_verifier is None:
+        with _token_verifier_lock:
+            if _token_verifier is None:
+                verifier = VerifyToken()
+                # JWKSキャッシュはプロセス全体で共有されるため、リスナーは共有インスタンスの分だけ登録する
+                verifier._jwks_cache.add_rotation_listener(verifier._token_cache.evict_kids)
+                _token_verifier = verifier
+    return _token_verifier
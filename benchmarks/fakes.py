@@ -0,0 +1,364 @@
+"""
+ベンチマーク用のローカル代替実装
+
+- FakeOpenAIServer: Azure OpenAIのチャット補完API（通常・ストリーミング）を模倣するHTTPサーバー
+- JWKSIssuer: RSA鍵でJWTを発行し、JWKSを配信するHTTPサーバー
+- FakeMySQLPool: MySQLServiceが発行するクエリだけを解釈するaiomysqlプール互換のメモリ実装
+
+HTTPサーバーは別スレッドのイベントループで動かす。VerifyTokenはJWKSを
+同期的に取得するため、同じイベントループで動かすとデッドロックする。
+"""
+
+import asyncio
+import collections
+import json
+import math
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+import jwt
+from aiohttp import web
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+
+class BackgroundServer:
+    """aiohttpのアプリケーションを別スレッドで起動する"""
+
+    def __init__(self, app: web.Application, port: int = 0):
+        self.app = app
+        self.port = port
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._runner: Optional[web.AppRunner] = None
+        self._thread: Optional[threading.Thread] = None
+        self._started = threading.Event()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    def start(self) -> "BackgroundServer":
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        self._started.wait()
+        return self
+
+    def _run(self):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        self._runner = web.AppRunner(self.app, access_log=None)
+        self._loop.run_until_complete(self._runner.setup())
+        site = web.TCPSite(self._runner, "127.0.0.1", self.port, backlog=1024)
+        self._loop.run_until_complete(site.start())
+        self.port = site._server.sockets[0].getsockname()[1]
+        self._started.set()
+        self._loop.run_forever()
+
+    def wait(self):
+        """停止されるまで待機（別プロセスで単独で動かす場合）"""
+        self._thread.join()
+
+    def stop(self):
+        if self._loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+
+class FakeOpenAIServer(BackgroundServer):
+    """設定した遅延で応答を返すAzure OpenAIのチャット補完API
+
+    requests_per_minute を指定すると、直近60秒の受付数が上限を超えた呼び出しに
+    Retry-After 付きの429を返す（デプロイメントのクォータ超過の模倣）。
+    """
+
+    def __init__(
+        self,
+        latency: float = 0.05,
+        token_delay: float = 0.002,
+        tokens: int = 20,
+        port: int = 0,
+        requests_per_minute: int = 0
+    ):
+        self.latency = latency
+        self.token_delay = token_delay
+        self.tokens = tokens
+        self.requests_per_minute = requests_per_minute
+        self.requests = 0
+        self.throttled = 0
+        # 同時に処理中の呼び出し数（並行して届いているかの確認用）
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._accepted = collections.deque()
+        app = web.Application()
+        app.router.add_post("/openai/deployments/{deployment}/chat/completions", self._completions)
+        super().__init__(app, port)
+
+    def _chunk(self, deployment: str, delta: Dict, finish_reason: Optional[str] = None) -> bytes:
+        payload = {
+            "id": "chatcmpl-bench", "object": "chat.completion.chunk", "created": int(time.time()),
+            "model": deployment,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        }
+        return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n".encode("utf-8")
+
+    def _retry_after(self) -> Optional[float]:
+        """クォータを超えていれば次に受け付けられるまでの秒数"""
+        if not self.requests_per_minute:
+            return None
+        now = time.monotonic()
+        while self._accepted and self._accepted[0] <= now - 60:
+            self._accepted.popleft()
+        if len(self._accepted) < self.requests_per_minute:
+            self._accepted.append(now)
+            return None
+        return self._accepted[0] + 60 - now
+
+    async def _completions(self, request: web.Request) -> web.StreamResponse:
+        self.requests += 1
+        retry_after = self._retry_after()
+        if retry_after is not None:
+            self.throttled += 1
+            return web.json_response(
+                {"error": {"code": "429", "message": "Requests to the deployment have exceeded the rate limit."}},
+                status=429,
+                headers={"Retry-After": str(math.ceil(retry_after))}
+            )
+        body = await request.json()
+        deployment = request.match_info["deployment"]
+        prompt_tokens = sum(len(message["content"]) for message in body["messages"])
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.latency)
+        finally:
+            self.in_flight -= 1
+
+        if not body.get("stream"):
+            return web.json_response({
+                "id": "chatcmpl-bench", "object": "chat.completion", "created": int(time.time()),
+                "model": deployment,
+                "choices": [{
+                    "index": 0, "finish_reason": "stop",
+                    "message": {"role": "assistant", "content": "ベンチマーク" * self.tokens},
+                }],
+                "usage": {
+                    "prompt_tokens": prompt_tokens, "completion_tokens": self.tokens,
+                    "total_tokens": prompt_tokens + self.tokens,
+                },
+            })
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        await response.write(self._chunk(deployment, {"role": "assistant", "content": ""}))
+        for _ in range(self.tokens):
+            await asyncio.sleep(self.token_delay)
+            await response.write(self._chunk(deployment, {"content": "ベンチマーク"}))
+        await response.write(self._chunk(deployment, {}, finish_reason="stop"))
+        if (body.get("stream_options") or {}).get("include_usage"):
+            # 使用量はchoicesが空の最後のチャンクで返される
+            usage = {
+                "id": "chatcmpl-bench", "object": "chat.completion.chunk", "created": int(time.time()),
+                "model": deployment, "choices": [],
+                "usage": {
+                    "prompt_tokens": prompt_tokens, "completion_tokens": self.tokens,
+                    "total_tokens": prompt_tokens + self.tokens,
+                },
+            }
+            await response.write(f"data: {json.dumps(usage)}\n\n".encode("utf-8"))
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+
+class JWKSIssuer(BackgroundServer):
+    """RSA鍵でトークンを発行し、/.well-known/jwks.json で公開鍵を配信する"""
+
+    def __init__(self, issuer: str = "https://bench.local/", audience: str = "https://bench.local/api"):
+        self.issuer = issuer
+        self.audience = audience
+        self.kid = uuid.uuid4().hex
+        self._private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        jwk = json.loads(jwt.algorithms.RSAAlgorithm.to_jwk(self._private_key.public_key()))
+        jwk.update({"kid": self.kid, "use": "sig", "alg": "RS256"})
+        self._jwks = {"keys": [jwk]}
+        self.requests = 0
+        app = web.Application()
+        app.router.add_get("/.well-known/jwks.json", self._jwks_handler)
+        super().__init__(app)
+
+    @property
+    def jwks_url(self) -> str:
+        return f"{self.url}/.well-known/jwks.json"
+
+    async def _jwks_handler(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        return web.json_response(self._jwks, headers={"Cache-Control": "public, max-age=3600"})
+
+    def mint_token(self, subject: str = "bench-user", ttl: int = 3600, **claims) -> str:
+        now = int(time.time())
+        payload = {
+            "sub": subject, "iss": self.issuer, "aud": self.audience,
+            "iat": now, "exp": now + ttl, **claims,
+        }
+        return jwt.encode(payload, self._private_key, algorithm="RS256", headers={"kid": self.kid})
+
+
+# --- MySQL ---
+
+class FakeMySQLDatabase:
+    """MySQLServiceが使うテーブルのメモリ上の内容"""
+
+    def __init__(self):
+        self.sessions: Dict[str, List[Dict]] = {}
+        self.messages: Dict[str, List[Dict]] = {}
+        self._next_id = 0
+
+    def next_id(self) -> int:
+        self._next_id += 1
+        return self._next_id
+
+
+def _keyset_page(rows: List[Dict], query: str, params: list) -> List[Dict]:
+    # (created_at, id) の降順で、カーソル位置より後ろを返す
+    rows = sorted(rows, key=lambda row: (row["created_at"], row["id"]), reverse=True)
+    if "created_at <" in query:
+        created_at, _, last_id = params[1:4]
+        rows = [row for row in rows if (row["created_at"], row["id"]) < (created_at, last_id)]
+    return rows[:params[-1]]
+
+
+class _FakeCursor:
+    def __init__(self, connection: "_FakeConnection", as_dict: bool):
+        self._connection = connection
+        self._as_dict = as_dict
+        self._rows: List = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def execute(self, query: str, params=None):
+        await self._connection._round_trip()
+        db = self._connection.database
+        params = list(params or [])
+        text = " ".join(query.split())
+        rows: List[Dict] = []
+
+        if text.startswith("SELECT session_id FROM chat_sessions"):
+            sessions = db.sessions.get(params[0], [])
+            rows = [{"session_id": sessions[-1]["session_id"]}] if sessions else []
+        elif text.startswith("INSERT INTO chat_sessions"):
+            db.sessions.setdefault(params[0], []).append({
+                "id": db.next_id(), "session_id": params[1], "user_email": params[0], "created_at": datetime.now(),
+            })
+        elif text.startswith("INSERT INTO chat_messages"):
+            for i in range(0, len(params), 5):
+                session_id, user_email, message, response, created_at = params[i:i + 5]
+                db.messages.setdefault(user_email, []).append({
+                    "id": db.next_id(), "session_id": session_id, "user_email": user_email,
+                    "message": message, "response": response, "created_at": created_at,
+                })
+        elif "information_schema.tables" in text:
+            rows = [{"count": len(params)}]
+        elif "information_schema" in text:
+            rows = [{"count": 0}]
+        elif text.startswith("SELECT") and "FROM chat_messages WHERE user_email" in text:
+            rows = _keyset_page(db.messages.get(params[0], []), text, params)
+        elif text.startswith("SELECT") and "FROM chat_sessions WHERE user_email" in text:
+            rows = _keyset_page(db.sessions.get(params[0], []), text, params)
+
+        self._rows = [dict(row) if self._as_dict else tuple(row.values()) for row in rows]
+        self.rowcount = len(self._rows)
+
+    async def fetchone(self):
+        return self._rows[0] if self._rows else None
+
+    async def fetchall(self):
+        return list(self._rows)
+
+
+class _FakeConnection:
+    def __init__(self, database: FakeMySQLDatabase, latency: float):
+        self.database = database
+        self.latency = latency
+        self.loop = asyncio.get_event_loop()
+        self.last_usage = self.loop.time()
+        self.closed = False
+
+    async def _round_trip(self):
+        await asyncio.sleep(self.latency)
+        self.last_usage = self.loop.time()
+
+    def cursor(self, cursor_class=None) -> _FakeCursor:
+        return _FakeCursor(self, as_dict=cursor_class is not None)
+
+    async def commit(self):
+        await self._round_trip()
+
+    async def rollback(self):
+        await self._round_trip()
+
+    async def ping(self, reconnect: bool = True):
+        await self._round_trip()
+
+    def close(self):
+        self.closed = True
+
+
+class FakeMySQLPool:
+    """aiomysql.Pool のうち MySQLService が使うインターフェースのみを実装"""
+
+    def __init__(self, database: Optional[FakeMySQLDatabase] = None, maxsize: int = 10, latency: float = 0.001):
+        self.database = database or FakeMySQLDatabase()
+        self.maxsize = maxsize
+        self.latency = latency
+        self._free: List[_FakeConnection] = []
+        self._size = 0
+        self._semaphore = asyncio.Semaphore(maxsize)
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    @property
+    def freesize(self) -> int:
+        return len(self._free)
+
+    async def acquire(self) -> _FakeConnection:
+        await self._semaphore.acquire()
+        if self._free:
+            return self._free.pop()
+        self._size += 1
+        return _FakeConnection(self.database, self.latency)
+
+    def release(self, connection: _FakeConnection):
+        if connection.closed:
+            self._size -= 1
+        else:
+            self._free.append(connection)
+        self._semaphore.release()
+
+    def close(self):
+        pass
+
+    async def wait_closed(self):
+        pass
+
+
+def seed_conversations(database: FakeMySQLDatabase, user_email: str, count: int):
+    """履歴取得のベンチマーク用に会話を登録"""
+    session_id = str(uuid.uuid4())
+    database.sessions.setdefault(user_email, []).append({
+        "id": database.next_id(), "session_id": session_id, "user_email": user_email, "created_at": datetime.now(),
+    })
+    start = datetime.now() - timedelta(minutes=count)
+    for i in range(count):
+        database.messages.setdefault(user_email, []).append({
+            "id": database.next_id(), "session_id": session_id, "user_email": user_email,
+            "message": f"質問 {i}", "response": f"回答 {i}", "created_at": start + timedelta(minutes=i),
+        })
@@ -0,0 +1,377 @@
+#!/usr/bin/env python3
+"""
+main:app の負荷試験（1ワーカーあたりの処理能力の計測）
+
+uvicorn の1ワーカーで起動した main:app に対し、ローカルの署名鍵で発行した
+JWTを付けて /chat・/chat/history・/chat/sessions を指定の割合で送信する。
+同時ユーザー数を段階的に増やし、段階ごとのスループット・レイテンシ・
+エラー率と、SLOを満たす最大の同時ユーザー数（飽和点）を出力する。
+
+Azure OpenAI・MySQL・CosmosDB・Auth0 は benchmarks/fakes.py の代替実装を使う。
+代替OpenAIサーバーとアプリはそれぞれ別プロセスで動かし、負荷生成側と
+CPUを取り合わないようにする。
+
+    python -m benchmarks.load
+    python -m benchmarks.load --stages 10,20,40,80 --stage-duration 30 --llm-latency 2
+    python -m benchmarks.load --mix chat=1 --slo-p95 chat=3000 --output load.json
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import platform
+import random
+import socket
+import tempfile
+import time
+from datetime import datetime
+from typing import Dict, List, Optional
+
+import aiohttp
+
+from benchmarks.fakes import FakeMySQLPool, FakeOpenAIServer, JWKSIssuer, seed_conversations
+from benchmarks.run import configure_environment, percentile
+
+OPERATIONS = ("chat", "history", "sessions")
+
+DEFAULT_MIX = "chat=0.6,history=0.25,sessions=0.15"
+
+DEFAULT_SLO_P95 = "chat=2000,history=300,sessions=300"
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _parse_weights(value: str) -> Dict[str, float]:
+    """"chat=0.6,history=0.4" 形式の指定を辞書に変換"""
+    weights = {}
+    for item in value.split(","):
+        name, _, number = item.partition("=")
+        name = name.strip()
+        if name not in OPERATIONS:
+            raise argparse.ArgumentTypeError(f"unknown operation: {name} (choose from {', '.join(OPERATIONS)})")
+        weights[name] = float(number)
+    return weights
+
+
+# --- 別プロセスで動かすサーバー ---
+
+def _serve_openai(port: int, latency: float, token_delay: float, requests_per_minute: int):
+    server = FakeOpenAIServer(
+        latency=latency, token_delay=token_delay, port=port, requests_per_minute=requests_per_minute
+    ).start()
+    server.wait()
+
+
+def _serve_app(port: int, args: Dict, users: List[str]):
+    # 環境変数は親プロセスで設定済み（spawn で引き継がれる）
+    logging.basicConfig(level=args["log_level"])
+    import uvicorn
+    from services.cosmosdb_service import cosmosdb_service
+    from services.local_cosmos import InMemoryContainer
+    from services.mysql_service import mysql_service
+    import main
+
+    # connect() は設定済みのプール・コンテナをそのまま使う
+    mysql_service.pool = FakeMySQLPool(maxsize=args["mysql_pool_size"], latency=args["mysql_latency"])
+    for user in users:
+        seed_conversations(mysql_service.pool.database, user, args["seed_messages"])
+    cosmosdb_service.container = InMemoryContainer(latency=args["cosmos_latency"])
+
+    uvicorn.run(
+        main.app,
+        host="127.0.0.1",
+        port=port,
+        workers=1,
+        log_level=args["log_level"].lower(),
+        access_log=False,
+    )
+
+
+async def _wait_until_ready(url: str, timeout: float):
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while True:
+            try:
+                async with session.get(url) as response:
+                    if response.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"Server did not become ready: {url}")
+            await asyncio.sleep(0.2)
+
+
+# --- 負荷生成 ---
+
+class StageRecorder:
+    """1段階分のリクエスト結果（計測開始時刻以降に開始したもののみ）"""
+
+    def __init__(self, measure_from: float):
+        self.measure_from = measure_from
+        self.latencies: Dict[str, List[float]] = {name: [] for name in OPERATIONS}
+        self.statuses: Dict[str, Dict[str, int]] = {name: {} for name in OPERATIONS}
+
+    def record(self, operation: str, started: float, elapsed: float, status: str):
+        if started < self.measure_from:
+            return
+        self.latencies[operation].append(elapsed)
+        self.statuses[operation][status] = self.statuses[operation].get(status, 0) + 1
+
+    def summary(self, window: float, slo_p95: Dict[str, float], slo_error_rate: float) -> Dict:
+        operations = {}
+        all_latencies: List[float] = []
+        total = errors = 0
+        violations = []
+        for name in OPERATIONS:
+            values = sorted(self.latencies[name])
+            if not values:
+                continue
+            failed = sum(count for status, count in self.statuses[name].items() if not status.startswith("2"))
+            result = {
+                "requests": len(values),
+                "rps": len(values) / window,
+                "error_rate": failed / len(values),
+                "p50_ms": percentile(values, 50) * 1000,
+                "p95_ms": percentile(values, 95) * 1000,
+                "p99_ms": percentile(values, 99) * 1000,
+                "statuses": self.statuses[name],
+            }
+            operations[name] = result
+            all_latencies.extend(values)
+            total += len(values)
+            errors += failed
+            if name in slo_p95 and result["p95_ms"] > slo_p95[name]:
+                violations.append(f"{name} p95 {result['p95_ms']:.0f}ms > {slo_p95[name]:.0f}ms")
+
+        all_latencies.sort()
+        error_rate = errors / total if total else 0.0
+        if error_rate > slo_error_rate:
+            violations.append(f"error rate {error_rate:.2%} > {slo_error_rate:.2%}")
+        return {
+            "requests": total,
+            "rps": total / window,
+            "error_rate": error_rate,
+            "p50_ms": percentile(all_latencies, 50) * 1000,
+            "p95_ms": percentile(all_latencies, 95) * 1000,
+            "p99_ms": percentile(all_latencies, 99) * 1000,
+            "operations": operations,
+            "slo_met": not violations and total > 0,
+            "slo_violations": violations,
+        }
+
+
+class LoadGenerator:
+    """クローズドループの仮想ユーザーでリクエストを送信する"""
+
+    def __init__(self, base_url: str, tokens: Dict[str, str], mix: Dict[str, float], think_time: float):
+        self.base_url = base_url
+        self.tokens = tokens
+        self.users = list(tokens)
+        self.operations = [name for name in OPERATIONS if mix.get(name, 0) > 0]
+        self.weights = [mix[name] for name in self.operations]
+        self.think_time = think_time
+        self._message_id = 0
+
+    def _request(self, operation: str, user: str):
+        if operation == "chat":
+            self._message_id += 1
+            return "POST", "/chat", {"json": {"message": f"負荷試験の質問 {self._message_id}", "user_email": user}}
+        if operation == "history":
+            return "GET", f"/chat/history/{user}", {"params": {"limit": 20}}
+        return "GET", f"/chat/sessions/{user}", {"params": {"limit": 10}}
+
+    async def _virtual_user(self, session: aiohttp.ClientSession, recorder: StageRecorder, stop_at: float, seed: int):
+        rng = random.Random(seed)
+        while time.perf_counter() < stop_at:
+            operation = rng.choices(self.operations, self.weights)[0]
+            user = rng.choice(self.users)
+            method, path, options = self._request(operation, user)
+            headers = {"Authorization": f"Bearer {self.tokens[user]}"}
+            started = time.perf_counter()
+            try:
+                async with session.request(method, self.base_url + path, headers=headers, **options) as response:
+                    await response.read()
+                    status = str(response.status)
+            except asyncio.TimeoutError:
+                status = "timeout"
+            except aiohttp.ClientError:
+                status = "connection_error"
+            recorder.record(operation, started, time.perf_counter() - started, status)
+            if self.think_time > 0:
+                await asyncio.sleep(rng.expovariate(1 / self.think_time))
+
+    async def run_stage(self, concurrency: int, duration: float, warmup: float, timeout: float) -> StageRecorder:
+        started = time.perf_counter()
+        recorder = StageRecorder(measure_from=started + warmup)
+        connector = aiohttp.TCPConnector(limit=0)
+        client_timeout = aiohttp.ClientTimeout(total=timeout)
+        async with aiohttp.ClientSession(connector=connector, timeout=client_timeout) as session:
+            stop_at = started + warmup + duration
+            await asyncio.gather(*(
+                self._virtual_user(session, recorder, stop_at, seed=concurrency * 100000 + i)
+                for i in range(concurrency)
+            ))
+        return recorder
+
+
+def find_saturation(stages: List[Dict], min_gain: float) -> Dict:
+    """SLOを満たす最大の同時ユーザー数と、スループットが伸びなくなった段階を求める"""
+    sustainable: Optional[Dict] = None
+    for stage in stages:
+        if not stage["slo_met"]:
+            break
+        sustainable = stage
+
+    knee: Optional[Dict] = None
+    for previous, stage in zip(stages, stages[1:]):
+        if previous["rps"] and stage["rps"] / previous["rps"] - 1 < min_gain:
+            knee = previous
+            break
+
+    return {
+        "max_sustainable_concurrency": sustainable["concurrency"] if sustainable else None,
+        "max_sustainable_rps": sustainable["rps"] if sustainable else None,
+        "throughput_knee_concurrency": knee["concurrency"] if knee else None,
+        "peak_rps": max((stage["rps"] for stage in stages), default=0.0),
+    }
+
+
+def print_stage(stage: Dict):
+    status = "ok" if stage["slo_met"] else "SLO violated: " + "; ".join(stage["slo_violations"])
+    print(
+        f"users {stage['concurrency']:>5}  {stage['rps']:>9,.1f} req/s  err {stage['error_rate']:>6.2%}  "
+        f"p50 {stage['p50_ms']:>8.1f}ms  p95 {stage['p95_ms']:>8.1f}ms  p99 {stage['p99_ms']:>8.1f}ms  {status}",
+        flush=True
+    )
+    for name, result in stage["operations"].items():
+        print(
+            f"    {name:<10} {result['rps']:>9,.1f} req/s  err {result['error_rate']:>6.2%}  "
+            f"p50 {result['p50_ms']:>8.1f}ms  p95 {result['p95_ms']:>8.1f}ms  p99 {result['p99_ms']:>8.1f}ms",
+            flush=True
+        )
+
+
+def print_report(report: Dict):
+    saturation = report["saturation"]
+    print("\n=== 結果 ===")
+    print(f"最大スループット: {saturation['peak_rps']:,.1f} req/s")
+    if saturation["max_sustainable_concurrency"] is None:
+        print("SLOを満たす段階はありませんでした")
+    else:
+        print(
+            f"SLOを満たす最大の同時ユーザー数: {saturation['max_sustainable_concurrency']} "
+            f"({saturation['max_sustainable_rps']:,.1f} req/s)"
+        )
+    if saturation["throughput_knee_concurrency"] is not None:
+        print(f"スループットが頭打ちになった同時ユーザー数: {saturation['throughput_knee_concurrency']}")
+
+
+async def ramp(args, base_url: str, tokens: Dict[str, str]) -> List[Dict]:
+    generator = LoadGenerator(base_url, tokens, args.mix, args.think_time)
+    stages = []
+    for concurrency in args.stages:
+        recorder = await generator.run_stage(concurrency, args.stage_duration, args.stage_warmup, args.timeout)
+        stage = {"concurrency": concurrency, **recorder.summary(args.stage_duration, args.slo_p95, args.slo_error_rate)}
+        stages.append(stage)
+        print_stage(stage)
+        if not stage["slo_met"] and not args.keep_going:
+            break
+    return stages
+
+
+def main():
+    parser = argparse.ArgumentParser(description="main:app の負荷試験（1ワーカー・ローカル代替実装）")
+    parser.add_argument(
+        "--stages", type=lambda value: [int(item) for item in value.split(",")], default=[1, 2, 5, 10, 20, 50, 100],
+        help="段階ごとの同時ユーザー数（カンマ区切り）"
+    )
+    parser.add_argument("--stage-duration", type=float, default=15.0, help="各段階の計測時間（秒）")
+    parser.add_argument("--stage-warmup", type=float, default=2.0, help="各段階の開始直後に計測から除く時間（秒）")
+    parser.add_argument("--mix", type=_parse_weights, default=_parse_weights(DEFAULT_MIX), help="リクエストの割合")
+    parser.add_argument("--think-time", type=float, default=0.0, help="仮想ユーザーのリクエスト間隔の平均（秒）")
+    parser.add_argument("--users", type=int, default=100, help="トークンを発行するユーザー数")
+    parser.add_argument("--seed-messages", type=int, default=50, help="ユーザーごとに事前登録する会話数")
+    parser.add_argument("--timeout", type=float, default=30.0, help="リクエストのタイムアウト（秒）")
+    parser.add_argument("--slo-p95", type=_parse_weights, default=_parse_weights(DEFAULT_SLO_P95),
+                        help="操作ごとのp95の上限（ミリ秒）")
+    parser.add_argument("--slo-error-rate", type=float, default=0.01, help="エラー率の上限")
+    parser.add_argument("--min-gain", type=float, default=0.1,
+                        help="前の段階よりスループットがこの割合以上伸びなければ頭打ちとみなす")
+    parser.add_argument("--keep-going", action="store_true", help="SLOを満たさない段階の後も続行する")
+    parser.add_argument("--llm-latency", type=float, default=1.0, help="代替OpenAIサーバーの応答遅延（秒）")
+    parser.add_argument("--llm-token-delay", type=float, default=0.02, help="ストリーミング時のトークン間隔（秒）")
+    parser.add_argument("--llm-rpm", type=int, default=0,
+                        help="代替OpenAIサーバーが429を返し始める1分あたりのリクエスト数（0なら無制限）")
+    parser.add_argument("--mysql-latency", type=float, default=0.001, help="代替MySQLの1往復あたりの遅延（秒）")
+    parser.add_argument("--mysql-pool-size", type=int, default=10)
+    parser.add_argument("--cosmos-latency", type=float, default=0.005, help="代替CosmosDBの1往復あたりの遅延（秒）")
+    parser.add_argument("--output", help="結果をJSONで保存するパス")
+    parser.add_argument("--log-level", default="WARNING")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.log_level)
+    context = multiprocessing.get_context("spawn")
+
+    openai_port = _free_port()
+    openai_process = context.Process(
+        target=_serve_openai, args=(openai_port, args.llm_latency, args.llm_token_delay, args.llm_rpm), daemon=True
+    )
+    issuer = JWKSIssuer().start()
+    workdir = tempfile.mkdtemp(prefix="chatbot-load-")
+    configure_environment(args, f"http://127.0.0.1:{openai_port}", issuer, workdir)
+
+    users = [f"load{i}@example.com" for i in range(args.users)]
+    tokens = {user: issuer.mint_token(subject=user, ttl=24 * 3600) for user in users}
+    app_port = _free_port()
+    app_process = context.Process(target=_serve_app, args=(app_port, {
+        key: getattr(args, key) for key in (
+            "log_level", "mysql_pool_size", "mysql_latency", "cosmos_latency", "seed_messages"
+        )
+    }, users))
+
+    base_url = f"http://127.0.0.1:{app_port}"
+    openai_process.start()
+    app_process.start()
+    try:
+        asyncio.run(_wait_until_ready(base_url + "/ready", timeout=60))
+        print(f"main:app (1 worker) at {base_url}, mix {args.mix}, stages {args.stages}", flush=True)
+        stages = asyncio.run(ramp(args, base_url, tokens))
+    finally:
+        # SIGTERM で uvicorn の終了処理を実行させる
+        app_process.terminate()
+        app_process.join(timeout=15)
+        openai_process.terminate()
+        openai_process.join(timeout=5)
+        issuer.stop()
+
+    report = {
+        "created_at": datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {
+            key: getattr(args, key) for key in (
+                "stages", "stage_duration", "stage_warmup", "mix", "think_time", "users", "seed_messages",
+                "slo_p95", "slo_error_rate", "llm_latency", "llm_token_delay", "llm_rpm", "mysql_latency",
+                "mysql_pool_size", "cosmos_latency",
+            )
+        },
+        "stages": stages,
+        "saturation": find_saturation(stages, args.min_gain),
+    }
+    print_report(report)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\n結果を保存しました: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+"""
+サービス層のオフラインベンチマーク
+
+Azure・MySQL・Auth0に接続せず、benchmarks/fakes.py の代替実装に対して
+各操作を実行し、ops/sec と p50/p95/p99 を出力する。--baseline で保存済みの
+結果と比較し、悪化した操作があれば終了コード1を返す。
+
+    python -m benchmarks.run
+    python -m benchmarks.run --save-baseline
+    python -m benchmarks.run --only chat --concurrency 50
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import sys
+import tempfile
+import time
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, List
+
+from benchmarks.fakes import FakeMySQLPool, FakeOpenAIServer, JWKSIssuer, seed_conversations
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), "baseline.json")
+
+BENCH_USER = "bench@example.com"
+
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    """最近傍順位法によるパーセンタイル"""
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, int(round(q / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+def summarize(latencies: List[float], elapsed: float) -> Dict:
+    values = sorted(latencies)
+    return {
+        "ops": len(values),
+        "ops_per_sec": len(values) / elapsed if elapsed > 0 else 0.0,
+        "p50_ms": percentile(values, 50) * 1000,
+        "p95_ms": percentile(values, 95) * 1000,
+        "p99_ms": percentile(values, 99) * 1000,
+        "max_ms": values[-1] * 1000 if values else 0.0,
+    }
+
+
+async def measure_async(operation: Callable[[int], Awaitable], iterations: int, concurrency: int) -> Dict:
+    """operation(i) を指定の同時実行数で iterations 回実行"""
+    latencies: List[float] = []
+    counter = iter(range(iterations))
+
+    async def worker():
+        for i in counter:
+            start = time.perf_counter()
+            await operation(i)
+            latencies.append(time.perf_counter() - start)
+
+    # ウォームアップ（接続確立・キャッシュ作成を計測から除く）
+    await operation(-1)
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(max(1, concurrency))))
+    return summarize(latencies, time.perf_counter() - started)
+
+
+def measure_sync(operation: Callable[[int], object], iterations: int) -> Dict:
+    latencies: List[float] = []
+    operation(-1)
+    started = time.perf_counter()
+    for i in range(iterations):
+        start = time.perf_counter()
+        operation(i)
+        latencies.append(time.perf_counter() - start)
+    return summarize(latencies, time.perf_counter() - started)
+
+
+def configure_environment(args, openai_url: str, issuer: JWKSIssuer, workdir: str):
+    """設定モジュールの読み込み前に、代替実装を向く環境変数を設定"""
+    os.environ.update({
+        "AZURE_OPENAI_ENDPOINT": openai_url,
+        "AZURE_OPENAI_API_KEY": "bench",
+        "AZURE_OPENAI_DEPLOYMENT_NAME": "bench",
+        "AZURE_OPENAI_MAX_RETRIES": "0",
+        "RESPONSE_CACHE_ENABLED": "false",
+        "COSMOSDB_LOCAL": "true",
+        "WRITE_BEHIND_ENABLED": "false",
+        "RECONCILIATION_LOG_PATH": os.path.join(workdir, "reconciliation.jsonl"),
+        "MYSQL_POOL_MAX_SIZE": str(args.mysql_pool_size),
+        "AUTH0_DOMAIN": "bench.local",
+        "AUTH0_ISSUER": issuer.issuer,
+        "AUTH0_API_AUDIENCE": issuer.audience,
+        "AUTH0_ALGORITHMS": "RS256",
+        "AUTH0_JWKS_URL": issuer.jwks_url,
+    })
+
+
+async def run_benchmarks(args, issuer: JWKSIssuer) -> Dict[str, Dict]:
+    # 環境変数の設定後に読み込む
+    import httpx
+    from auth.verify_token import get_token_verifier
+    from models.chat_models import ConversationRecord
+    from services.azure_openai_service import azure_openai_service
+    from services.cosmosdb_service import cosmosdb_service
+    from services.local_cosmos import InMemoryContainer
+    from services.mysql_service import mysql_service
+    import main
+
+    mysql_service.pool = FakeMySQLPool(maxsize=args.mysql_pool_size, latency=args.mysql_latency)
+    seed_conversations(mysql_service.pool.database, BENCH_USER, 200)
+    cosmosdb_service.container = InMemoryContainer(latency=args.cosmos_latency)
+
+    verifier = get_token_verifier()
+    token = issuer.mint_token()
+    fresh_tokens = [issuer.mint_token(subject=f"user-{i}") for i in range(args.iterations + 1)]
+    record = lambda i: ConversationRecord(
+        session_id="bench-session", user_email=f"user{i % 50}@example.com",
+        message=f"質問 {i}", response="回答", timestamp=datetime.now()
+    )
+
+    async def consume_stream(i):
+        async for _ in azure_openai_service.generate_response_stream(f"ストリーム {i}"):
+            pass
+
+    transport = httpx.ASGITransport(app=main.app)
+    client = httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=60)
+    headers = {"Authorization": f"Bearer {token}"}
+
+    async def chat(i):
+        response = await client.post("/chat", json={"message": f"質問 {i}", "user_email": BENCH_USER}, headers=headers)
+        response.raise_for_status()
+
+    async def history(i):
+        response = await client.get(f"/chat/history/{BENCH_USER}", params={"limit": 20}, headers=headers)
+        response.raise_for_status()
+
+    n, c = args.iterations, args.concurrency
+    benchmarks: Dict[str, Callable[[], Awaitable[Dict]]] = {
+        "auth.verify_token.cached": lambda: asyncio.to_thread(measure_sync, lambda i: verifier.verify_token(token), n),
+        "auth.verify_token.uncached": lambda: asyncio.to_thread(
+            measure_sync, lambda i: verifier.verify_token(fresh_tokens[i]), n
+        ),
+        "openai.generate_response": lambda: measure_async(
+            lambda i: azure_openai_service.generate_response(f"質問 {i}"), n, c
+        ),
+        "openai.generate_response_stream": lambda: measure_async(consume_stream, n, c),
+        "mysql.get_or_create_session": lambda: measure_async(
+            lambda i: mysql_service.get_or_create_session(f"user{i % 50}@example.com"), n, c
+        ),
+        "mysql.save_conversation": lambda: measure_async(lambda i: mysql_service.save_conversation(record(i)), n, c),
+        "mysql.get_conversation_history": lambda: measure_async(
+            lambda i: mysql_service.get_conversation_history(BENCH_USER, 20), n, c
+        ),
+        "cosmos.save_conversation": lambda: measure_async(
+            lambda i: cosmosdb_service.save_conversation(record(i)), n, c
+        ),
+        "cosmos.get_user_conversations": lambda: measure_async(
+            lambda i: cosmosdb_service.get_user_conversations("user1@example.com", 20), n, c
+        ),
+        "api.chat": lambda: measure_async(chat, n, c),
+        "api.chat_history": lambda: measure_async(history, n, c),
+    }
+
+    results: Dict[str, Dict] = {}
+    try:
+        for name, benchmark in benchmarks.items():
+            if args.only and not any(pattern in name for pattern in args.only):
+                continue
+            results[name] = await benchmark()
+            print_result(name, results[name])
+    finally:
+        await client.aclose()
+        await azure_openai_service.close()
+    return results
+
+
+def print_result(name: str, result: Dict):
+    line = (
+        f"{name:<36} {result['ops_per_sec']:>10,.1f} ops/s  "
+        f"p50 {result['p50_ms']:>8.2f}ms  p95 {result['p95_ms']:>8.2f}ms  p99 {result['p99_ms']:>8.2f}ms"
+    )
+    print(line, flush=True)
+
+
+def compare(results: Dict[str, Dict], baseline: Dict[str, Dict], tolerance: float) -> List[str]:
+    """ベースラインと比較し、悪化した操作の一覧を返す"""
+    regressions = []
+    print(f"\n=== ベースラインとの比較（許容範囲 {tolerance:.0%}） ===")
+    for name, result in results.items():
+        base = baseline.get(name)
+        if not base:
+            print(f"{name:<36} (ベースラインなし)")
+            continue
+        throughput = result["ops_per_sec"] / base["ops_per_sec"] - 1 if base["ops_per_sec"] else 0.0
+        p95 = result["p95_ms"] / base["p95_ms"] - 1 if base["p95_ms"] else 0.0
+        regressed = throughput < -tolerance or p95 > tolerance
+        if regressed:
+            regressions.append(name)
+        print(f"{name:<36} ops/s {throughput:>+7.1%}  p95 {p95:>+7.1%}  {'REGRESSION' if regressed else 'ok'}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="サービス層のオフラインベンチマーク")
+    parser.add_argument("--iterations", type=int, default=500, help="操作ごとの実行回数")
+    parser.add_argument("--concurrency", type=int, default=20, help="非同期操作の同時実行数")
+    parser.add_argument("--only", nargs="*", help="名前に指定の文字列を含むベンチマークのみ実行")
+    parser.add_argument("--llm-latency", type=float, default=0.05, help="代替OpenAIサーバーの応答遅延（秒）")
+    parser.add_argument("--llm-token-delay", type=float, default=0.002, help="ストリーミング時のトークン間隔（秒）")
+    parser.add_argument("--mysql-latency", type=float, default=0.001, help="代替MySQLの1往復あたりの遅延（秒）")
+    parser.add_argument("--mysql-pool-size", type=int, default=10)
+    parser.add_argument("--cosmos-latency", type=float, default=0.002, help="代替CosmosDBの1往復あたりの遅延（秒）")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="比較・保存に使うベースラインのJSON")
+    parser.add_argument("--save-baseline", action="store_true", help="結果をベースラインとして保存")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="悪化とみなす割合（0.2 = 20%%）")
+    parser.add_argument("--output", help="結果をJSONで保存するパス")
+    parser.add_argument("--log-level", default="WARNING")
+    args = parser.parse_args()
+
+    # main.py のログ設定より先に設定し、計測中のログ出力を抑える
+    logging.basicConfig(level=args.log_level)
+
+    openai_server = FakeOpenAIServer(latency=args.llm_latency, token_delay=args.llm_token_delay).start()
+    issuer = JWKSIssuer().start()
+    workdir = tempfile.mkdtemp(prefix="chatbot-bench-")
+    configure_environment(args, openai_server.url, issuer, workdir)
+
+    try:
+        results = asyncio.run(run_benchmarks(args, issuer))
+    finally:
+        openai_server.stop()
+        issuer.stop()
+
+    report = {
+        "created_at": datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {
+            key: getattr(args, key) for key in (
+                "iterations", "concurrency", "llm_latency", "llm_token_delay",
+                "mysql_latency", "mysql_pool_size", "cosmos_latency",
+            )
+        },
+        "results": results,
+    }
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\nベースラインを保存しました: {args.baseline}")
+        return
+
+    if os.path.exists(args.baseline):
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline.get("config") != report["config"]:
+            print("\n注意: ベースラインとは実行条件が異なります", baseline.get("config"))
+        if compare(results, baseline["results"], args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -8,7 +8,35 @@ class Settings:
     AZURE_OPENAI_ENDPOINT: str = os.getenv("AZURE_OPENAI_ENDPOINT", "")
     AZURE_OPENAI_API_KEY: str = os.getenv("AZURE_OPENAI_API_KEY", "")
     AZURE_OPENAI_DEPLOYMENT_NAME: str = os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME", "")
-    AZURE_OPENAI_API_VERSION: str = os.getenv("AZURE_OPENAI_API_VERSION", "2024-02-15-preview")
+    AZURE_OPENAI_API_VERSION: str = os.getenv("AZURE_OPENAI_API_VERSION", "2024-10-21")
+    AZURE_OPENAI_TIMEOUT: float = float(os.getenv("AZURE_OPENAI_TIMEOUT", "60"))
+    AZURE_OPENAI_CONNECT_TIMEOUT: float = float(os.getenv("AZURE_OPENAI_CONNECT_TIMEOUT", "5"))
+    # 429・接続エラー・5xxの再試行回数（再試行はレート制限の枠を確保し直してから行う）
+    AZURE_OPENAI_MAX_RETRIES: int = int(os.getenv("AZURE_OPENAI_MAX_RETRIES", "2"))
+    AZURE_OPENAI_MAX_CONNECTIONS: int = int(os.getenv("AZURE_OPENAI_MAX_CONNECTIONS", "100"))
+    AZURE_OPENAI_MAX_KEEPALIVE_CONNECTIONS: int = int(os.getenv("AZURE_OPENAI_MAX_KEEPALIVE_CONNECTIONS", "20"))
+    AZURE_OPENAI_KEEPALIVE_EXPIRY: float = float(os.getenv("AZURE_OPENAI_KEEPALIVE_EXPIRY", "30"))
+    # 同じ質問の同時リクエストを1回の呼び出しにまとめる
+    AZURE_OPENAI_COALESCE_REQUESTS: bool = os.getenv("AZURE_OPENAI_COALESCE_REQUESTS", "true").lower() == "true"
+    # クライアント側のレート制限（ワーカーごとの1分あたりの上限、0なら無制限）
+    AZURE_OPENAI_REQUESTS_PER_MINUTE: int = int(os.getenv("AZURE_OPENAI_REQUESTS_PER_MINUTE", "0"))
+    AZURE_OPENAI_TOKENS_PER_MINUTE: int = int(os.getenv("AZURE_OPENAI_TOKENS_PER_MINUTE", "0"))
+    # トークン数の見積もりに加える応答のトークン数
+    AZURE_OPENAI_ESTIMATED_COMPLETION_TOKENS: int = int(os.getenv("AZURE_OPENAI_ESTIMATED_COMPLETION_TOKENS", "500"))
+    # 枠が空くのを待つ呼び出しの上限数と待機期限（秒、超えた分は503を返す）
+    AZURE_OPENAI_MAX_QUEUE: int = int(os.getenv("AZURE_OPENAI_MAX_QUEUE", "100"))
+    AZURE_OPENAI_QUEUE_TIMEOUT: float = float(os.getenv("AZURE_OPENAI_QUEUE_TIMEOUT", "30"))
+    # 再試行の待機時間（Retry-Afterがない場合の指数バックオフの初期値と上限、秒）
+    AZURE_OPENAI_RETRY_BACKOFF: float = float(os.getenv("AZURE_OPENAI_RETRY_BACKOFF", "1"))
+    AZURE_OPENAI_RETRY_MAX_BACKOFF: float = float(os.getenv("AZURE_OPENAI_RETRY_MAX_BACKOFF", "30"))
+    
+    # 応答キャッシュ設定（同じ質問への応答を再利用する）
+    RESPONSE_CACHE_ENABLED: bool = os.getenv("RESPONSE_CACHE_ENABLED", "false").lower() == "true"
+    # memory: プロセス内LRU / disk: SQLiteファイル
+    RESPONSE_CACHE_BACKEND: str = os.getenv("RESPONSE_CACHE_BACKEND", "memory")
+    RESPONSE_CACHE_TTL: float = float(os.getenv("RESPONSE_CACHE_TTL", "86400"))
+    RESPONSE_CACHE_MAX_ENTRIES: int = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "10000"))
+    RESPONSE_CACHE_PATH: str = os.getenv("RESPONSE_CACHE_PATH", "data/response_cache.sqlite3")
     
     # MySQL設定
     MYSQL_HOST: str = os.getenv("MYSQL_HOST", "localhost")
@@ -16,15 +44,77 @@ class Settings:
     MYSQL_USER: str = os.getenv("MYSQL_USER", "")
     MYSQL_PASSWORD: str = os.getenv("MYSQL_PASSWORD", "")
     MYSQL_DATABASE: str = os.getenv("MYSQL_DATABASE", "chatbot_db")
+    MYSQL_POOL_MIN_SIZE: int = int(os.getenv("MYSQL_POOL_MIN_SIZE", "1"))
+    MYSQL_POOL_MAX_SIZE: int = int(os.getenv("MYSQL_POOL_MAX_SIZE", "10"))
+    MYSQL_POOL_RECYCLE: int = int(os.getenv("MYSQL_POOL_RECYCLE", "3600"))
+    MYSQL_POOL_PING_INTERVAL: float = float(os.getenv("MYSQL_POOL_PING_INTERVAL", "30"))
+    MYSQL_CONNECT_TIMEOUT: int = int(os.getenv("MYSQL_CONNECT_TIMEOUT", "10"))
+    MYSQL_BATCH_INSERT_SIZE: int = int(os.getenv("MYSQL_BATCH_INSERT_SIZE", "500"))
+    
+    HISTORY_MAX_PAGE_SIZE: int = int(os.getenv("HISTORY_MAX_PAGE_SIZE", "100"))
+    # get_chat_history.py export で1回に取得する件数
+    EXPORT_CHUNK_SIZE: int = int(os.getenv("EXPORT_CHUNK_SIZE", "5000"))
+    EXPORT_WORKERS: int = int(os.getenv("EXPORT_WORKERS", "1"))
+    EXPORT_SHARD_SIZE: int = int(os.getenv("EXPORT_SHARD_SIZE", "100000"))
+    
+    # セッションキャッシュ設定
+    SESSION_CACHE_ENABLED: bool = os.getenv("SESSION_CACHE_ENABLED", "true").lower() == "true"
+    SESSION_CACHE_TTL: float = float(os.getenv("SESSION_CACHE_TTL", "300"))
+    SESSION_CACHE_MAX_ENTRIES: int = int(os.getenv("SESSION_CACHE_MAX_ENTRIES", "10000"))
+    SESSION_CACHE_INVALIDATION_BACKEND: str = os.getenv("SESSION_CACHE_INVALIDATION_BACKEND", "local")
     
     # CosmosDB設定
     COSMOSDB_ENDPOINT: str = os.getenv("COSMOSDB_ENDPOINT", "")
     COSMOSDB_KEY: str = os.getenv("COSMOSDB_KEY", "")
     COSMOSDB_DATABASE_NAME: str = os.getenv("COSMOSDB_DATABASE_NAME", "chatbot")
     COSMOSDB_CONTAINER_NAME: str = os.getenv("COSMOSDB_CONTAINER_NAME", "conversations")
+    # true の場合はメモリ上の代替コンテナを使用（オフライン動作確認用）
+    COSMOSDB_LOCAL: bool = os.getenv("COSMOSDB_LOCAL", "false").lower() == "true"
+    COSMOSDB_MAX_ITEM_COUNT: int = int(os.getenv("COSMOSDB_MAX_ITEM_COUNT", "100"))
+    COSMOSDB_DELETE_CONCURRENCY: int = int(os.getenv("COSMOSDB_DELETE_CONCURRENCY", "8"))
+    COSMOSDB_DELETE_PAGE_SIZE: int = int(os.getenv("COSMOSDB_DELETE_PAGE_SIZE", "1000"))
+    COSMOSDB_DELETE_MAX_RETRIES: int = int(os.getenv("COSMOSDB_DELETE_MAX_RETRIES", "10"))
+    
+    # 会話履歴のwrite-behind保存設定
+    WRITE_BEHIND_ENABLED: bool = os.getenv("WRITE_BEHIND_ENABLED", "true").lower() == "true"
+    WRITE_BEHIND_MAX_QUEUE_SIZE: int = int(os.getenv("WRITE_BEHIND_MAX_QUEUE_SIZE", "10000"))
+    WRITE_BEHIND_BATCH_SIZE: int = int(os.getenv("WRITE_BEHIND_BATCH_SIZE", "100"))
+    WRITE_BEHIND_FLUSH_INTERVAL: float = float(os.getenv("WRITE_BEHIND_FLUSH_INTERVAL", "0.5"))
+    WRITE_BEHIND_ENQUEUE_TIMEOUT: float = float(os.getenv("WRITE_BEHIND_ENQUEUE_TIMEOUT", "5"))
+    WRITE_BEHIND_MAX_RETRIES: int = int(os.getenv("WRITE_BEHIND_MAX_RETRIES", "3"))
+    WRITE_BEHIND_DRAIN_TIMEOUT: float = float(os.getenv("WRITE_BEHIND_DRAIN_TIMEOUT", "30"))
+    WRITE_BEHIND_SPILL_PATH: str = os.getenv("WRITE_BEHIND_SPILL_PATH", "data/write_behind_spill.jsonl")
+    WRITE_BEHIND_FSYNC: bool = os.getenv("WRITE_BEHIND_FSYNC", "false").lower() == "true"
+    
+    # 同期保存（write-behind無効時・キュー満杯時）の設定
+    PERSIST_MYSQL_TIMEOUT: float = float(os.getenv("PERSIST_MYSQL_TIMEOUT", "5"))
+    PERSIST_COSMOSDB_TIMEOUT: float = float(os.getenv("PERSIST_COSMOSDB_TIMEOUT", "5"))
+    RECONCILIATION_LOG_PATH: str = os.getenv("RECONCILIATION_LOG_PATH", "data/reconciliation.jsonl")
     
     # API設定
     API_HOST: str = os.getenv("API_HOST", "0.0.0.0")
     API_PORT: int = int(os.getenv("API_PORT", "8000"))
+    # 実行環境（development: uvicornのホットリロード / production: gunicornのマルチワーカー）
+    API_ENV: str = os.getenv("API_ENV", "development")
+    # production時のワーカー数（0ならCPUコア数）
+    API_WORKERS: int = int(os.getenv("API_WORKERS", "0"))
+    # ワーカーをforkする前にアプリケーションをimportしておく（接続プールはfork後に各ワーカーで作成）
+    API_PRELOAD: bool = os.getenv("API_PRELOAD", "true").lower() == "true"
+    # 1ワーカーが処理するリクエスト数の上限（超えたら入れ替えてメモリの増加を抑える、0なら無制限）
+    API_MAX_REQUESTS: int = int(os.getenv("API_MAX_REQUESTS", "10000"))
+    # 全ワーカーが同時に入れ替わらないよう上限に加える乱数の幅
+    API_MAX_REQUESTS_JITTER: int = int(os.getenv("API_MAX_REQUESTS_JITTER", "1000"))
+    # Keep-Alive接続を保持する秒数（前段のロードバランサーのアイドルタイムアウトより短くしない）
+    API_KEEPALIVE: int = int(os.getenv("API_KEEPALIVE", "5"))
+    # 受付待ちの接続数の上限（listenのbacklog）
+    API_BACKLOG: int = int(os.getenv("API_BACKLOG", "2048"))
+    # ワーカーの終了・入れ替え時に処理中のリクエストとwrite-behindキューを書き込み終えるまで待つ秒数
+    API_GRACEFUL_TIMEOUT: int = int(os.getenv("API_GRACEFUL_TIMEOUT", "35"))
+    # 応答のないワーカーを再起動するまでの秒数
+    API_TIMEOUT: int = int(os.getenv("API_TIMEOUT", "60"))
+    # 起動時にバックエンドへ接続する際のバックエンドごとのタイムアウト（秒、起動自体は待たない）
+    STARTUP_WARMUP_TIMEOUT: float = float(os.getenv("STARTUP_WARMUP_TIMEOUT", "10"))
+    # 接続に失敗したバックエンドへの再接続を控える時間（秒、この間は503を返す）
+    BACKEND_RETRY_INTERVAL: float = float(os.getenv("BACKEND_RETRY_INTERVAL", "5"))
 
 settings = Settings()
\ No newline at end of file
@@ -1,7 +1,7 @@
 from fastapi import HTTPException, Depends
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from typing import Dict, Optional
-from auth.verify_token import VerifyToken
+from auth.verify_token import get_token_verifier
 
 security = HTTPBearer()
 
@@ -9,7 +9,7 @@ security = HTTPBearer()
 def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)) -> Dict:
     try:
         token = credentials.credentials
-        token_verifier = VerifyToken()
+        token_verifier = get_token_verifier()
         payload = token_verifier.verify_token(token)
         
         if not payload:
@@ -10,6 +10,8 @@ from datetime import datetime
 import json
 import sys
 from config.settings import settings
+from services.search import FULLTEXT_INDEX_NAME, FULLTEXT_INDEX_EXISTS_QUERY, build_search_query
+from services.history_export import export_conversations, export_conversations_parallel
 
 # ログ設定
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -18,6 +20,7 @@ logger = logging.getLogger(__name__)
 class ChatHistoryRetriever:
     def __init__(self):
         self.connection = None
+        self._fulltext_index = None
         self.connect()
 
     def connect(self):
@@ -156,25 +159,23 @@ class ChatHistoryRetriever:
             logger.error(f"Error getting sessions for user {user_email}: {e}")
             return []
 
-    def search_conversations(self, search_term: str, limit: int = 50):
-        """メッセージ内容で会話を検索"""
+    def has_fulltext_index(self) -> bool:
+        """全文検索用のFULLTEXTインデックスがあるか確認"""
+        if self._fulltext_index is None:
+            cursor = self.connection.cursor()
+            cursor.execute(FULLTEXT_INDEX_EXISTS_QUERY, (FULLTEXT_INDEX_NAME,))
+            self._fulltext_index = cursor.fetchone()[0] > 0
+            cursor.close()
+        return self._fulltext_index
+
+    def search_conversations(self, search_term: str, limit: int = 50, page: int = 1, user_email: str = None):
+        """メッセージ内容で会話を検索（FULLTEXTインデックスがあれば関連度順）"""
         try:
+            query, params, mode = build_search_query(
+                search_term, self.has_fulltext_index(), limit, page, user_email
+            )
             cursor = self.connection.cursor(dictionary=True)
-            query = """
-            SELECT 
-                cm.id,
-                cm.session_id,
-                cm.user_email,
-                cm.message,
-                cm.response,
-                cm.created_at
-            FROM chat_messages cm
-            WHERE cm.message LIKE %s OR cm.response LIKE %s
-            ORDER BY cm.created_at DESC 
-            LIMIT %s
-            """
-            search_pattern = f"%{search_term}%"
-            cursor.execute(query, (search_pattern, search_pattern, limit))
+            cursor.execute(query, params)
             messages = cursor.fetchall()
             cursor.close()
             return messages
@@ -182,6 +183,55 @@ class ChatHistoryRetriever:
             logger.error(f"Error searching conversations: {e}")
             return []
 
+    def explain_search(self, search_term: str, limit: int = 50, page: int = 1, user_email: str = None):
+        """検索に使われる方式とインデックスを確認"""
+        try:
+            query, params, mode = build_search_query(
+                search_term, self.has_fulltext_index(), limit, page, user_email
+            )
+            cursor = self.connection.cursor(dictionary=True)
+            cursor.execute("EXPLAIN " + query, params)
+            plan = cursor.fetchall()
+            cursor.close()
+            return {"mode": mode, "plan": plan}
+        except Error as e:
+            logger.error(f"Error explaining search: {e}")
+            return {"mode": None, "plan": []}
+
+    def export_conversations(self, output_path=None, fmt="jsonl", compression=None, chunk_size=None,
+                             checkpoint_path=None, since=None, until=None, user_email=None):
+        """会話履歴をJSONL/CSVでストリーミング出力（メモリ使用量は件数に依存しない）"""
+        return export_conversations(
+            self.connection,
+            output_path=output_path,
+            fmt=fmt,
+            compression=compression,
+            chunk_size=chunk_size or settings.EXPORT_CHUNK_SIZE,
+            checkpoint_path=checkpoint_path,
+            since=since,
+            until=until,
+            user_email=user_email
+        )
+
+    def export_conversations_parallel(self, output_path=None, fmt="jsonl", compression=None, chunk_size=None,
+                                      workers=None, shard_size=None, shard_by="id", since=None, until=None,
+                                      user_email=None, keep_shards=False):
+        """会話履歴をシャードに分割し、複数プロセスで並列に出力"""
+        return export_conversations_parallel(
+            self.connection,
+            output_path=output_path,
+            fmt=fmt,
+            compression=compression,
+            chunk_size=chunk_size or settings.EXPORT_CHUNK_SIZE,
+            workers=workers or settings.EXPORT_WORKERS,
+            shard_size=shard_size or settings.EXPORT_SHARD_SIZE,
+            shard_by=shard_by,
+            since=since,
+            until=until,
+            user_email=user_email,
+            keep_shards=keep_shards
+        )
+
     def close(self):
         """データベース接続を閉じる"""
         if self.connection and self.connection.is_connected():
@@ -202,12 +252,38 @@ def print_conversations(conversations):
 
     print(f"\n=== 会話履歴 ({len(conversations)}件) ===")
     for i, conv in enumerate(conversations, 1):
-        print(f"\n[{i}] ID: {conv['id']} | セッション: {conv['session_id'][:8]}... | ユーザー: {conv['user_email']}")
+        score = f" | スコア: {conv['score']:.3f}" if conv.get('score') is not None else ""
+        print(f"\n[{i}] ID: {conv['id']} | セッション: {conv['session_id'][:8]}... | ユーザー: {conv['user_email']}{score}")
         print(f"日時: {format_datetime(conv['created_at'])}")
         print(f"質問: {conv['message'][:100]}{'...' if len(conv['message']) > 100 else ''}")
         print(f"回答: {conv['response'][:100]}{'...' if len(conv['response']) > 100 else ''}")
         print("-" * 80)
 
+def print_search_plan(explain):
+    """検索の実行計画を整形して表示"""
+    print(f"\n=== 検索方式: {explain['mode']} ===")
+    for row in explain["plan"]:
+        print(f"テーブル: {row.get('table')} | 種別: {row.get('type')} | "
+              f"使用インデックス: {row.get('key') or 'なし（全件走査）'} | 推定行数: {row.get('rows')}")
+
+def pop_option(args, name, default=None):
+    """引数リストから --name value 形式のオプションを取り出す"""
+    if name in args:
+        index = args.index(name)
+        if index + 1 < len(args):
+            value = args[index + 1]
+            del args[index:index + 2]
+            return value
+        del args[index]
+    return default
+
+def pop_flag(args, name):
+    """引数リストから --name 形式のフラグを取り出す"""
+    if name in args:
+        args.remove(name)
+        return True
+    return False
+
 def print_statistics(stats):
     """統計情報を整形して表示"""
     if not stats:
@@ -229,9 +305,14 @@ def main():
         print("  python get_chat_history.py all [limit]          # 全会話履歴を取得")
         print("  python get_chat_history.py user <email> [limit] # 特定ユーザーの会話履歴")
         print("  python get_chat_history.py session <session_id> # 特定セッションの会話履歴")
-        print("  python get_chat_history.py search <term> [limit] # メッセージ内容で検索")
+        print("  python get_chat_history.py search <term> [limit] [--page N] [--user <email>] [--explain]")
+        print("                                                  # メッセージ内容で検索（関連度順）")
         print("  python get_chat_history.py stats                # ユーザー統計情報")
         print("  python get_chat_history.py sessions <email>     # ユーザーのセッション一覧")
+        print("  python get_chat_history.py export [--output <path>] [--format jsonl|csv] [--compress gzip|zstd|none]")
+        print("         [--chunk-size N] [--checkpoint <path>] [--since <date>] [--until <date>] [--user <email>]")
+        print("         [--workers N] [--shard-size N] [--shard-by id|user] [--keep-shards]")
+        print("                                                  # 会話履歴をストリーミング出力（既定は標準出力）")
         return
 
     try:
@@ -261,12 +342,18 @@ def main():
             print_conversations(conversations)
 
         elif command == "search":
-            if len(sys.argv) < 3:
+            args = sys.argv[2:]
+            page = int(pop_option(args, "--page", "1"))
+            user_email = pop_option(args, "--user")
+            explain = pop_flag(args, "--explain")
+            if not args:
                 print("検索語を指定してください。")
                 return
-            search_term = sys.argv[2]
-            limit = int(sys.argv[3]) if len(sys.argv) > 3 else 50
-            conversations = retriever.search_conversations(search_term, limit)
+            search_term = args[0]
+            limit = int(args[1]) if len(args) > 1 else 50
+            if explain:
+                print_search_plan(retriever.explain_search(search_term, limit, page, user_email))
+            conversations = retriever.search_conversations(search_term, limit, page, user_email)
             print_conversations(conversations)
 
         elif command == "stats":
@@ -289,12 +376,81 @@ def main():
             else:
                 print("セッションが見つかりませんでした。")
 
+        elif command == "export":
+            args = sys.argv[2:]
+            output_path = pop_option(args, "--output")
+            fmt = pop_option(args, "--format", "jsonl")
+            compression = pop_option(args, "--compress")
+            chunk_size = pop_option(args, "--chunk-size")
+            chunk_size = int(chunk_size) if chunk_size else None
+            since = pop_option(args, "--since")
+            until = pop_option(args, "--until")
+            user_email = pop_option(args, "--user")
+            workers = int(pop_option(args, "--workers", str(settings.EXPORT_WORKERS)))
+            shard_size = pop_option(args, "--shard-size")
+            shard_by = pop_option(args, "--shard-by")
+            # 並列・逐次のどちらか一方でしか使えないオプションも先に取り出す
+            checkpoint_path = pop_option(args, "--checkpoint")
+            keep_shards = pop_flag(args, "--keep-shards")
+            if args:
+                print(f"不明なオプション: {' '.join(args)}")
+                return
+
+            parallel = workers > 1 or shard_size or shard_by
+            if parallel and checkpoint_path:
+                print("--checkpoint は並列エクスポートでは使えません（完了済みのシャードは再実行時に自動で再利用されます）")
+                return
+            if not parallel and keep_shards:
+                print("--keep-shards は並列エクスポート（--workers 2以上・--shard-size・--shard-by）でのみ使えます")
+                return
+
+            if parallel:
+                manifest = retriever.export_conversations_parallel(
+                    output_path=output_path,
+                    fmt=fmt,
+                    compression=compression,
+                    chunk_size=chunk_size,
+                    workers=workers,
+                    shard_size=int(shard_size) if shard_size else None,
+                    shard_by=shard_by or "id",
+                    since=since,
+                    until=until,
+                    user_email=user_email,
+                    keep_shards=keep_shards
+                )
+                logger.info(
+                    f"Exported {manifest['total_rows']} rows in {len(manifest['shards'])} shards "
+                    f"at {manifest['rows_per_second']:,.0f} rows/sec"
+                )
+                return
+
+            if checkpoint_path is None and output_path:
+                checkpoint_path = output_path + ".checkpoint"
+            result = retriever.export_conversations(
+                output_path=output_path,
+                fmt=fmt,
+                compression=compression,
+                chunk_size=chunk_size,
+                checkpoint_path=checkpoint_path,
+                since=since,
+                until=until,
+                user_email=user_email
+            )
+            if result["resumed"]:
+                logger.info(f"Resumed export from checkpoint {checkpoint_path}")
+            logger.info(
+                f"Exported {result['total_rows']} rows (last id {result['last_id']}) "
+                f"at {result['rows_per_second']:,.0f} rows/sec"
+            )
+
         else:
             print(f"不明なコマンド: {command}")
 
     except Exception as e:
         logger.error(f"Error: {e}")
         print(f"エラーが発生しました: {e}")
+        # cronやCIから失敗を検知できるよう、終了コードを0以外にする
+        sys.exit(1)
 
     finally:
         if 'retriever' in locals():
@@ -0,0 +1,35 @@
+"""
+本番用のgunicorn設定（API_ENV=production）
+
+    gunicorn -c gunicorn.conf.py main:app
+
+各ワーカーはuvicornのイベントループでASGIアプリケーションを動かす。API_PRELOAD=true の場合は
+マスタープロセスでアプリケーションをimportしてからforkし、MySQLのプール・CosmosDB/Azure OpenAIの
+クライアントなどの接続はfork後に各ワーカーのlifespanで作成する。
+"""
+
+import os
+import sys
+from config.settings import settings
+
+bind = f"{settings.API_HOST}:{settings.API_PORT}"
+workers = settings.API_WORKERS or os.cpu_count() or 1
+worker_class = "uvicorn_worker.UvicornWorker"
+preload_app = settings.API_PRELOAD
+
+# 一定数のリクエストを処理したワーカーを入れ替えてメモリの増加を抑える
+max_requests = settings.API_MAX_REQUESTS
+max_requests_jitter = settings.API_MAX_REQUESTS_JITTER
+
+keepalive = settings.API_KEEPALIVE
+backlog = settings.API_BACKLOG
+graceful_timeout = settings.API_GRACEFUL_TIMEOUT
+timeout = settings.API_TIMEOUT
+
+accesslog = "-"
+
+
+def post_fork(server, worker):
+    """マスタープロセスで作られた接続をワーカーに引き継がない"""
+    if "main" in sys.modules:
+        sys.modules["main"].reset_after_fork()
@@ -1,8 +1,17 @@
+import asyncio
 import logging
+import os
+import sys
+import time
 import uvicorn
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
+from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from routes.chat_routes import router as chat_router
+from routes.metrics_routes import router as metrics_router
+from services.metrics import MetricsMiddleware
+from services.readiness import readiness
 from config.settings import settings
 
 # ログ設定
@@ -12,11 +21,89 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# アプリケーション起動・終了時の処理
+async def _warm_up_auth():
+    from auth.verify_token import get_token_verifier
+    await asyncio.to_thread(get_token_verifier().warm_up)
+
+async def _start_background_services():
+    """バックエンドへの接続を並行して確立した後、前回の未保存分を再書き込み"""
+    from services.mysql_service import mysql_service
+    from services.cosmosdb_service import cosmosdb_service
+    await readiness.start_warm_up({
+        "mysql": mysql_service.warm_up,
+        "cosmosdb": cosmosdb_service.warm_up,
+        "auth": _warm_up_auth,
+    }, timeout=settings.STARTUP_WARMUP_TIMEOUT)
+    # 前回の同期保存で書き込めなかった会話履歴を再書き込み
+    try:
+        from services.persistence_queue import reconciliation_log, concurrent_writer
+        await reconciliation_log.replay(concurrent_writer.backends)
+    except Exception as e:
+        logger.error(f"Error reconciling conversation records: {e}")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """起動・終了時の処理（接続の確立は待たずにリクエストの受付を開始する）"""
+    logger.info("Starting Chatbot API server...")
+    logger.info(f"API will be available at: http://{settings.API_HOST}:{settings.API_PORT}")
+    startup_task = asyncio.create_task(_start_background_services())
+    # 会話履歴のwrite-behindキューを起動（書き込みは接続の確立後に再試行される）
+    if settings.WRITE_BEHIND_ENABLED:
+        from services.persistence_queue import write_behind_queue
+        await write_behind_queue.start()
+
+    yield
+
+    logger.info("Shutting down Chatbot API server...")
+    if not startup_task.done():
+        startup_task.cancel()
+    await readiness.stop()
+    # 未保存の会話履歴を書き込んでから接続を閉じる
+    try:
+        from services.persistence_queue import write_behind_queue
+        await write_behind_queue.stop(timeout=settings.WRITE_BEHIND_DRAIN_TIMEOUT)
+    except Exception as e:
+        logger.error(f"Error draining write-behind queue: {e}")
+    # データベース接続を閉じる
+    try:
+        from services.mysql_service import mysql_service
+        await mysql_service.close()
+    except Exception as e:
+        logger.error(f"Error closing MySQL connection: {e}")
+    # CosmosDBクライアントを閉じる
+    try:
+        from services.cosmosdb_service import cosmosdb_service
+        await cosmosdb_service.close()
+    except Exception as e:
+        logger.error(f"Error closing CosmosDB client: {e}")
+    # Azure OpenAIクライアントを閉じる
+    try:
+        from services.azure_openai_service import azure_openai_service
+        await azure_openai_service.close()
+    except Exception as e:
+        logger.error(f"Error closing Azure OpenAI client: {e}")
+
+def reset_after_fork():
+    """gunicornのワーカーをforkした直後に呼ばれる（gunicorn.conf.py の post_fork）
+
+    API_PRELOAD=true の場合はマスタープロセスでimportしたモジュールを各ワーカーが引き継ぐため、
+    接続プール・HTTPクライアント・SQLiteの接続は共有せずにワーカーごとに作り直す。
+    """
+    from services.mysql_service import mysql_service
+    from services.cosmosdb_service import cosmosdb_service
+    from services.azure_openai_service import azure_openai_service
+    mysql_service.after_fork()
+    cosmosdb_service.after_fork()
+    azure_openai_service.after_fork()
+    readiness.started_at = time.monotonic()
+
 # FastAPIアプリケーション作成
 app = FastAPI(
     title="Chatbot API",
     description="Azure OpenAI を使用したチャットボットAPI",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 # CORS設定（Next.jsからのアクセスを許可）
@@ -28,8 +115,12 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# リクエストの所要時間をルートごとに記録
+app.add_middleware(MetricsMiddleware)
+
 # ルーター登録
 app.include_router(chat_router, tags=["chat"])
+app.include_router(metrics_router, tags=["metrics"])
 
 # ルートエンドポイント
 @app.get("/")
@@ -40,24 +131,22 @@ async def root():
         "docs": "/docs"
     }
 
-# アプリケーション起動時の処理
-@app.on_event("startup")
-async def startup_event():
-    logger.info("Starting Chatbot API server...")
-    logger.info(f"API will be available at: http://{settings.API_HOST}:{settings.API_PORT}")
+# ライブネスチェック（認証不要、プロセスがリクエストを処理できれば常に200）
+@app.get("/live")
+async def live():
+    return {"status": "alive"}
 
-# アプリケーション終了時の処理
-@app.on_event("shutdown")
-async def shutdown_event():
-    logger.info("Shutting down Chatbot API server...")
-    # データベース接続を閉じる
-    try:
-        from services.mysql_service import mysql_service
-        mysql_service.close()
-    except Exception as e:
-        logger.error(f"Error closing MySQL connection: {e}")
+# レディネスチェック（認証不要、バックエンドに接続できるまでは503）
+@app.get("/ready")
+async def ready():
+    readiness.recheck()
+    snapshot = readiness.snapshot()
+    return JSONResponse(snapshot, status_code=200 if snapshot["ready"] else 503)
 
 if __name__ == "__main__":
+    if settings.API_ENV == "production":
+        # gunicornのマルチワーカー（設定は gunicorn.conf.py）
+        os.execvp(sys.executable, [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "main:app"])
     uvicorn.run(
         "main:app",
         host=settings.API_HOST,
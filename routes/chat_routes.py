@@ -1,36 +1,99 @@
+import json
 import logging
-from fastapi import APIRouter, HTTPException
+import math
+import time
+from contextlib import aclosing
+from fastapi import APIRouter, Header, HTTPException
+from fastapi.responses import StreamingResponse
 from datetime import datetime
 from models.chat_models import ChatRequest, ChatResponse, ConversationRecord
 from services.azure_openai_service import azure_openai_service
+from services.llm_rate_limiter import LLMOverloadedError
 from services.mysql_service import mysql_service
-from services.cosmosdb_service import cosmosdb_service
+from services.cosmosdb_service import cosmosdb_service, RequestCharge, CONVERSATION_FIELDS
+from services.pagination import InvalidCursorError
+from services.persistence_queue import write_behind_queue, concurrent_writer
+from services.metrics import CHAT_STAGE_DURATION
+from services.readiness import readiness, BackendUnavailableError
+from config.settings import settings
 from dependencies.security import get_current_user
-from typing import Dict
+from typing import Dict, Optional
 from fastapi import Depends
 
 logger = logging.getLogger(__name__)
 
 router = APIRouter()
 
+def _validate_chat_request(request: ChatRequest):
+    """チャットリクエストの入力検証"""
+    if not request.message.strip():
+        raise HTTPException(status_code=400, detail="メッセージが空です")
+    
+    if not request.user_email:
+        raise HTTPException(status_code=400, detail="ユーザーメールが必要です")
+
+async def _persist_conversation(conversation_record: ConversationRecord):
+    """会話履歴保存（MySQLとCosmosDBの両方に保存）"""
+    if settings.WRITE_BEHIND_ENABLED:
+        # write-behindキューに投入し、書き込み完了を待たずにレスポンスを返す
+        try:
+            await write_behind_queue.enqueue(conversation_record)
+            return
+        except Exception as e:
+            logger.error(f"Write-behind enqueue error, saving synchronously: {e}")
+    
+    # MySQLとCosmosDBに同時に保存（失敗はログと再書き込み用の記録に残し、レスポンスは正常に返す）
+    await concurrent_writer.write(conversation_record)
+
+def _service_unavailable(error: BackendUnavailableError) -> HTTPException:
+    """接続できないバックエンドへのリクエストは503（Retry-After付き）で返す"""
+    return HTTPException(
+        status_code=503,
+        detail=f"{error.backend} に接続できません。しばらくしてから再試行してください",
+        headers={"Retry-After": str(max(1, math.ceil(error.retry_after)))}
+    )
+
+def _llm_overloaded(error: LLMOverloadedError) -> HTTPException:
+    """Azure OpenAIの枠を確保できなかったリクエストは503（429を受けた場合は429）で返す"""
+    return HTTPException(
+        status_code=429 if error.reason == "throttled" else 503,
+        detail="混み合っているため応答を生成できませんでした。しばらくしてから再試行してください",
+        headers={"Retry-After": str(max(1, math.ceil(error.retry_after)))}
+    )
+
+def _use_response_cache(cache_control: Optional[str]) -> bool:
+    """Cache-Control: no-cache / no-store が指定された場合は応答キャッシュを使わない"""
+    if not cache_control:
+        return True
+    directives = {directive.strip().lower() for directive in cache_control.split(",")}
+    return not ({"no-cache", "no-store"} & directives)
+
+def _sse_event(data: Dict, event: str = None) -> str:
+    """Server-Sent Events形式の文字列を生成"""
+    payload = json.dumps(data, ensure_ascii=False)
+    if event:
+        return f"event: {event}\ndata: {payload}\n\n"
+    return f"data: {payload}\n\n"
+
 @router.post("/chat", response_model=ChatResponse, dependencies=[Depends(get_current_user)])
-async def chat_endpoint(request: ChatRequest):
+async def chat_endpoint(request: ChatRequest, cache_control: Optional[str] = Header(None)):
     """チャットメッセージを処理するエンドポイント"""
     try:
         # 入力検証
-        if not request.message.strip():
-            raise HTTPException(status_code=400, detail="メッセージが空です")
-        
-        if not request.user_email:
-            raise HTTPException(status_code=400, detail="ユーザーメールが必要です")
+        _validate_chat_request(request)
         
         logger.info(f"Processing chat request from user: {request.user_email}")
         
         # MySQL: セッション管理
-        session_id = mysql_service.get_or_create_session(request.user_email)
+        with CHAT_STAGE_DURATION.time(route="/chat", stage="session"):
+            session_id = await mysql_service.get_or_create_session(request.user_email)
         
         # Azure OpenAI: 応答生成
-        ai_response = await azure_openai_service.generate_response(request.message)
+        with CHAT_STAGE_DURATION.time(route="/chat", stage="llm"):
+            ai_response = await azure_openai_service.generate_response(
+                request.message,
+                use_cache=_use_response_cache(cache_control)
+            )
         
         # 会話履歴保存（MySQLとCosmosDBの両方に保存）
         conversation_record = ConversationRecord(
@@ -40,20 +103,8 @@ async def chat_endpoint(request: ChatRequest):
             response=ai_response,
             timestamp=datetime.now()
         )
-        
-        # MySQL: 会話履歴保存
-        try:
-            mysql_service.save_conversation(conversation_record)
-        except Exception as e:
-            # MySQLエラーはログに記録するが、レスポンスは正常に返す
-            logger.error(f"MySQL save error: {e}")
-        
-        # CosmosDB: 会話履歴保存
-        try:
-            cosmosdb_service.save_conversation(conversation_record)
-        except Exception as e:
-            # CosmosDBエラーはログに記録するが、レスポンスは正常に返す
-            logger.error(f"CosmosDB save error: {e}")
+        with CHAT_STAGE_DURATION.time(route="/chat", stage="persist"):
+            await _persist_conversation(conversation_record)
         
         return ChatResponse(
             response=ai_response,
@@ -62,6 +113,9 @@ async def chat_endpoint(request: ChatRequest):
         
     except HTTPException:
         raise
+    except LLMOverloadedError as e:
+        logger.warning(f"Chat request shed: {e}")
+        raise _llm_overloaded(e)
     except Exception as e:
         logger.error(f"Unexpected error in chat endpoint: {e}")
         raise HTTPException(
@@ -69,31 +123,173 @@ async def chat_endpoint(request: ChatRequest):
             detail=f"予期しないエラーが発生しました: {str(e)}"
         )
 
+@router.post("/chat/stream", dependencies=[Depends(get_current_user)])
+async def chat_stream_endpoint(request: ChatRequest, cache_control: Optional[str] = Header(None)):
+    """チャット応答をServer-Sent Eventsで逐次返すエンドポイント"""
+    _validate_chat_request(request)
+    
+    logger.info(f"Processing streaming chat request from user: {request.user_email}")
+    
+    # ストリームの開始後はステータスコードを変えられないため、待機数が上限なら先に断る
+    try:
+        azure_openai_service.rate_limiter.check_capacity()
+    except LLMOverloadedError as e:
+        raise _llm_overloaded(e)
+    
+    try:
+        # MySQL: セッション管理
+        with CHAT_STAGE_DURATION.time(route="/chat/stream", stage="session"):
+            session_id = await mysql_service.get_or_create_session(request.user_email)
+    except Exception as e:
+        logger.error(f"Unexpected error in chat stream endpoint: {e}")
+        raise HTTPException(
+            status_code=500, 
+            detail=f"予期しないエラーが発生しました: {str(e)}"
+        )
+    
+    async def event_stream():
+        chunks = []
+        start = time.perf_counter()
+        try:
+            stream = azure_openai_service.generate_response_stream(
+                request.message,
+                use_cache=_use_response_cache(cache_control)
+            )
+            # クライアント切断時にも上流のストリームをすぐに閉じる
+            async with aclosing(stream):
+                async for delta in stream:
+                    if not chunks:
+                        CHAT_STAGE_DURATION.observe(
+                            time.perf_counter() - start, route="/chat/stream", stage="llm_first_token"
+                        )
+                    chunks.append(delta)
+                    yield _sse_event({"delta": delta})
+            CHAT_STAGE_DURATION.observe(time.perf_counter() - start, route="/chat/stream", stage="llm")
+        except LLMOverloadedError as e:
+            logger.warning(f"Streaming chat request shed: {e}")
+            error = _llm_overloaded(e)
+            yield _sse_event({
+                "detail": error.detail,
+                "success": False,
+                "status": error.status_code,
+                "retry_after": int(error.headers["Retry-After"])
+            }, event="error")
+            return
+        except Exception as e:
+            logger.error(f"Azure OpenAI streaming error: {e}")
+            yield _sse_event({"detail": f"エラーが発生しました: {str(e)}", "success": False}, event="error")
+            return
+        
+        # ストリーム完了後に組み立てた応答を保存（クライアント切断前に保存するため完了通知より先に行う）
+        ai_response = "".join(chunks).strip()
+        with CHAT_STAGE_DURATION.time(route="/chat/stream", stage="persist"):
+            await _persist_conversation(ConversationRecord(
+                session_id=session_id,
+                user_email=request.user_email,
+                message=request.message,
+                response=ai_response,
+                timestamp=datetime.now()
+            ))
+        
+        yield _sse_event({"response": ai_response, "success": True}, event="done")
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @router.get("/health", dependencies=[Depends(get_current_user)])
 async def health_check():
     """ヘルスチェックエンドポイント"""
-    return {"status": "healthy", "service": "chatbot-api"}
+    return {
+        "status": "healthy",
+        "service": "chatbot-api",
+        "readiness": readiness.snapshot(),
+        "write_behind": write_behind_queue.stats() if settings.WRITE_BEHIND_ENABLED else None,
+        "session_cache": mysql_service.session_cache_stats(),
+        "response_cache": azure_openai_service.response_cache.stats(),
+        "coalescing": azure_openai_service.coalescing_stats(),
+        "llm_rate_limit": azure_openai_service.rate_limiter.stats(),
+        "sync_persistence": concurrent_writer.stats()
+    }
 
 @router.get("/chat/sessions/{user_email}", dependencies=[Depends(get_current_user)])
-async def get_user_sessions(user_email: str):
-    """ユーザーのチャットセッションを取得"""
+async def get_user_sessions(user_email: str, limit: int = 10, cursor: Optional[str] = None):
+    """ユーザーのチャットセッションを取得（next_cursorで次ページを取得）"""
     try:
-        sessions = mysql_service.get_user_sessions(user_email)
-        return {"sessions": sessions}
+        sessions, next_cursor = await mysql_service.get_user_sessions(user_email, limit, cursor)
+        return {"sessions": sessions, "next_cursor": next_cursor}
+    except InvalidCursorError as e:
+        raise HTTPException(status_code=400, detail=f"不正なカーソルです: {str(e)}")
+    except BackendUnavailableError as e:
+        raise _service_unavailable(e)
     except Exception as e:
         logger.error(f"Error retrieving user sessions: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@router.get("/chat/search", dependencies=[Depends(get_current_user)])
+async def search_conversations(q: str, user_email: str, limit: int = 20, page: int = 1):
+    """ユーザーの会話履歴をメッセージ内容で検索（関連度順、全ユーザーの検索はCLIのみ）"""
+    if not q.strip():
+        raise HTTPException(status_code=400, detail="検索語が空です")
+    if not user_email.strip():
+        raise HTTPException(status_code=400, detail="ユーザーメールが必要です")
+    try:
+        conversations, mode = await mysql_service.search_conversations(q, limit, page, user_email)
+        return {"conversations": conversations, "page": page, "mode": mode}
+    except BackendUnavailableError as e:
+        raise _service_unavailable(e)
+    except Exception as e:
+        logger.error(f"Error searching conversations: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.get("/chat/sessions/{user_email}/{session_id}", dependencies=[Depends(get_current_user)])
+async def get_session_conversations(user_email: str, session_id: str):
+    """セッションの会話履歴をCosmosDBから取得（ユーザーのパーティション内で検索）"""
+    try:
+        request_charge = RequestCharge()
+        conversations = await cosmosdb_service.get_conversation_by_session(
+            session_id,
+            user_email=user_email,
+            request_charge=request_charge
+        )
+        return {"conversations": conversations, "request_charge": request_charge.total}
+    except BackendUnavailableError as e:
+        raise _service_unavailable(e)
+    except Exception as e:
+        logger.error(f"Error retrieving session conversations: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
 @router.get("/chat/history/{user_email}", dependencies=[Depends(get_current_user)])
-async def get_conversation_history(user_email: str, limit: int = 20, source: str = "mysql"):
-    """ユーザーの会話履歴を取得（MySQLまたはCosmosDBから）"""
+async def get_conversation_history(
+    user_email: str,
+    limit: int = 20,
+    source: str = "mysql",
+    cursor: Optional[str] = None,
+    fields: Optional[str] = None
+):
+    """ユーザーの会話履歴を取得（MySQLまたはCosmosDBから、next_cursorで次ページを取得）"""
+    field_list = [field.strip() for field in fields.split(",") if field.strip()] if fields else None
+    unknown = [field for field in field_list or [] if field not in CONVERSATION_FIELDS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"不正なフィールドです: {', '.join(unknown)}")
     try:
         if source.lower() == "cosmosdb":
-            conversations = cosmosdb_service.get_user_conversations(user_email, limit)
+            conversations, next_cursor = await cosmosdb_service.get_user_conversations(
+                user_email,
+                limit,
+                cursor=cursor,
+                fields=field_list
+            )
         else:
-            conversations = mysql_service.get_conversation_history(user_email, limit)
+            conversations, next_cursor = await mysql_service.get_conversation_history(user_email, limit, cursor)
         
-        return {"conversations": conversations, "source": source}
+        return {"conversations": conversations, "source": source, "next_cursor": next_cursor}
+    except InvalidCursorError as e:
+        raise HTTPException(status_code=400, detail=f"不正なカーソルです: {str(e)}")
+    except BackendUnavailableError as e:
+        raise _service_unavailable(e)
     except Exception as e:
         logger.error(f"Error retrieving conversation history from {source}: {e}")
         raise HTTPException(status_code=500, detail=str(e))
\ No newline at end of file
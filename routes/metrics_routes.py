@@ -0,0 +1,65 @@
+import logging
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+from typing import Dict, Iterable, List, Optional, Tuple
+from services.metrics import registry, Sample
+from services.mysql_service import mysql_service
+from services.azure_openai_service import azure_openai_service
+from services.persistence_queue import write_behind_queue, concurrent_writer
+from services.readiness import readiness
+from auth.verify_token import get_token_verifier
+from config.settings import settings
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter()
+
+def _gauges(prefix: str, stats: Dict, label: Optional[str] = None) -> Iterable[Tuple[str, str, str, List[Sample]]]:
+    """stats() の数値をゲージに変換（入れ子の辞書はキーをラベルにする）"""
+    samples: Dict[str, List[Sample]] = {}
+    for key, value in stats.items():
+        if isinstance(value, dict) and label:
+            for name, nested in value.items():
+                if isinstance(nested, dict):
+                    for nested_key, nested_value in nested.items():
+                        if isinstance(nested_value, (int, float)):
+                            samples.setdefault(f"{prefix}_{nested_key}", []).append(({label: name}, nested_value))
+                elif isinstance(nested, (int, float)):
+                    samples.setdefault(f"{prefix}_{key}", []).append(({label: name}, nested))
+        elif isinstance(value, (int, float)):
+            samples.setdefault(f"{prefix}_{key}", []).append(({}, value))
+    for name, metric_samples in samples.items():
+        yield name, "gauge", f"{prefix.replace('_', ' ')} statistic", metric_samples
+
+def _collect_service_stats():
+    """各サービスの既存の統計情報を収集"""
+    yield from _gauges("mysql_pool", mysql_service.pool_stats())
+    yield from _gauges("session_cache", mysql_service.session_cache_stats())
+    yield from _gauges("response_cache", azure_openai_service.response_cache.stats())
+    coalescing = azure_openai_service.coalescing_stats()
+    yield from _gauges("llm_coalescing", {"calls": {
+        "completions": coalescing["completions"], "streams": coalescing["streams"]
+    }}, label="kind")
+    yield from _gauges("llm_rate_limit", azure_openai_service.rate_limiter.stats(), label="reason")
+    if settings.WRITE_BEHIND_ENABLED:
+        yield from _gauges("write_behind", write_behind_queue.stats(), label="backend")
+    sync_stats = concurrent_writer.stats()
+    yield from _gauges("sync_persistence", {key: sync_stats[key] for key in ("written", "failed", "timed_out")}, label="backend")
+    yield from _gauges("reconciliation", sync_stats["reconciliation"])
+    yield "backend_ready", "gauge", "1 if the backend is connected, 0 otherwise", [
+        ({"backend": name}, 1 if state.status == "ready" else 0) for name, state in readiness.backends.items()
+    ]
+    try:
+        auth_stats = get_token_verifier().stats()
+        yield from _gauges("auth_jwks_cache", auth_stats["jwks"])
+        yield from _gauges("auth_token_cache", auth_stats["token_cache"])
+    except ValueError:
+        # Auth0が未設定の場合は出力しない
+        pass
+
+registry.register_collector(_collect_service_stats)
+
+@router.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """Prometheus形式のメトリクス（認証不要）"""
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
@@ -1,43 +1,274 @@
+import asyncio
 import logging
-from openai import AzureOpenAI
+import time
+import httpx
+from contextlib import aclosing
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import AsyncIterator, Dict, Optional
+from openai import (
+    AsyncAzureOpenAI, DefaultAsyncHttpxClient, APIConnectionError, APIStatusError, InternalServerError, RateLimitError
+)
 from config.settings import settings
+from services.llm_rate_limiter import LLMOverloadedError, create_llm_rate_limiter, estimate_tokens
+from services.response_cache import ResponseCache, create_response_cache_backend
+from services.single_flight import SingleFlight, SingleFlightStream
+from services.metrics import LLM_TOKENS, timed
 
 logger = logging.getLogger(__name__)
 
+SYSTEM_PROMPT = "あなたは親切で丁寧なAIアシスタントです。ユーザーの質問に対して、わかりやすく正確な回答を提供してください。日本語で回答してください。"
+
+def _retry_after(error: APIStatusError) -> Optional[float]:
+    """429応答の retry-after-ms / retry-after ヘッダーから待機秒数を取得"""
+    headers = error.response.headers
+    retry_after_ms = headers.get("retry-after-ms")
+    if retry_after_ms:
+        try:
+            return max(0.0, float(retry_after_ms) / 1000)
+        except ValueError:
+            pass
+    retry_after = headers.get("retry-after")
+    if not retry_after:
+        return None
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
+    # 秒数ではなくHTTP日付の場合
+    try:
+        retry_at = parsedate_to_datetime(retry_after)
+        return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
 class AzureOpenAIService:
     def __init__(self):
-        self.client = AzureOpenAI(
-            api_key=settings.AZURE_OPENAI_API_KEY,
-            api_version=settings.AZURE_OPENAI_API_VERSION,
-            azure_endpoint=settings.AZURE_OPENAI_ENDPOINT
-        )
+        # クライアントは最初の呼び出し時に作成する（設定不備でもモジュールの読み込みは失敗させない）
+        self.http_client: Optional[httpx.AsyncClient] = None
+        self._client: Optional[AsyncAzureOpenAI] = None
         self.deployment_name = settings.AZURE_OPENAI_DEPLOYMENT_NAME
+        # 同じ質問への応答を再利用するキャッシュ（RESPONSE_CACHE_ENABLED=true の場合のみ）
+        self.response_cache = ResponseCache(
+            create_response_cache_backend(
+                settings.RESPONSE_CACHE_BACKEND,
+                max_entries=settings.RESPONSE_CACHE_MAX_ENTRIES,
+                ttl=settings.RESPONSE_CACHE_TTL,
+                path=settings.RESPONSE_CACHE_PATH
+            ) if settings.RESPONSE_CACHE_ENABLED else None,
+            deployment=self.deployment_name,
+            system_prompt=SYSTEM_PROMPT
+        )
+        # 同じ質問の同時リクエストを1回の呼び出しにまとめる
+        self.single_flight = SingleFlight()
+        self.stream_flights = SingleFlightStream()
+        # 1分あたりのリクエスト数・トークン数の上限（再試行もこのリミッターを通す）
+        self.rate_limiter = create_llm_rate_limiter()
+
+    @property
+    def client(self) -> AsyncAzureOpenAI:
+        if self._client is None:
+            # プロセス内で共有するHTTPコネクションプール
+            self.http_client = DefaultAsyncHttpxClient(
+                limits=httpx.Limits(
+                    max_connections=settings.AZURE_OPENAI_MAX_CONNECTIONS,
+                    max_keepalive_connections=settings.AZURE_OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+                    keepalive_expiry=settings.AZURE_OPENAI_KEEPALIVE_EXPIRY
+                )
+            )
+            self._client = AsyncAzureOpenAI(
+                api_key=settings.AZURE_OPENAI_API_KEY,
+                api_version=settings.AZURE_OPENAI_API_VERSION,
+                azure_endpoint=settings.AZURE_OPENAI_ENDPOINT,
+                http_client=self.http_client,
+                timeout=httpx.Timeout(
+                    settings.AZURE_OPENAI_TIMEOUT,
+                    connect=settings.AZURE_OPENAI_CONNECT_TIMEOUT
+                ),
+                # 再試行はレート制限の枠を確保し直すため _create で行う
+                max_retries=0
+            )
+        return self._client
+
+    def _build_messages(self, user_message: str):
+        return [
+            {
+                "role": "system", 
+                "content": SYSTEM_PROMPT
+            },
+            {
+                "role": "user", 
+                "content": user_message
+            }
+        ]
+
+    def _estimate_tokens(self, user_message: str) -> int:
+        """レート制限用のトークン数の見積もり（プロンプトの概算 + 応答の想定トークン数）"""
+        return estimate_tokens(SYSTEM_PROMPT + user_message) + settings.AZURE_OPENAI_ESTIMATED_COMPLETION_TOKENS
+
+    async def _create(self, estimated_tokens: int, **kwargs):
+        """レート制限の枠を確保してから呼び出す（429はRetry-Afterに従い、一時的なエラーはバックオフして再試行）"""
+        limiter = self.rate_limiter
+        deadline = limiter.deadline()
+        max_retries = settings.AZURE_OPENAI_MAX_RETRIES
+        for attempt in range(max_retries + 1):
+            await limiter.acquire(estimated_tokens, deadline)
+            try:
+                return await self.client.chat.completions.create(model=self.deployment_name, **kwargs)
+            except RateLimitError as e:
+                delay = limiter.record_throttled(_retry_after(e), attempt)
+                if attempt >= max_retries or time.monotonic() + delay > deadline:
+                    raise limiter.reject("throttled", delay) from e
+                logger.warning(f"Azure OpenAI throttled (attempt {attempt + 1}), retrying in {delay:.2f}s")
+            except (APIConnectionError, InternalServerError) as e:
+                if attempt >= max_retries:
+                    raise
+                delay = limiter.backoff(attempt)
+                logger.warning(f"Azure OpenAI request failed (attempt {attempt + 1}): {e}; retrying in {delay:.2f}s")
+            limiter.retries += 1
+            await asyncio.sleep(delay)
+
+    def _record_usage(self, estimated_tokens: int, usage):
+        """応答の使用量をメトリクスとレート制限の見積もりに反映"""
+        LLM_TOKENS.inc(usage.prompt_tokens, deployment=self.deployment_name, type="prompt")
+        LLM_TOKENS.inc(usage.completion_tokens, deployment=self.deployment_name, type="completion")
+        self.rate_limiter.record_usage(estimated_tokens, usage.total_tokens)
 
-    async def generate_response(self, user_message: str) -> str:
+    @timed("azure_openai", "completion")
+    async def _complete(self, user_message: str, timeout: Optional[float]) -> str:
+        estimated_tokens = self._estimate_tokens(user_message)
+        response = await self._create(
+            estimated_tokens,
+            messages=self._build_messages(user_message),
+            # 呼び出しごとのタイムアウト（未指定時はクライアントの既定値）
+            **({"timeout": timeout} if timeout is not None else {})
+        )
+        
+        if response.usage:
+            self._record_usage(estimated_tokens, response.usage)
+        
+        if response.choices and len(response.choices) > 0:
+            content = response.choices[0].message.content.strip()
+            # エラーメッセージや空の応答はキャッシュしない
+            if content:
+                await self.response_cache.set(user_message, content)
+            return content
+        else:
+            return "申し訳ありません。応答を生成できませんでした。"
+
+    @timed("azure_openai")
+    async def generate_response(
+        self,
+        user_message: str,
+        timeout: Optional[float] = None,
+        use_cache: bool = True
+    ) -> str:
         """Azure OpenAIを使用してユーザーメッセージに対する応答を生成する"""
+        if use_cache:
+            cached = await self.response_cache.get(user_message)
+            if cached is not None:
+                return cached
+        elif self.response_cache.enabled:
+            self.response_cache.record_bypass()
+        
         try:
-            response = self.client.chat.completions.create(
-                model=self.deployment_name,
-                messages=[
-                    {
-                        "role": "system", 
-                        "content": "あなたは親切で丁寧なAIアシスタントです。ユーザーの質問に対して、わかりやすく正確な回答を提供してください。日本語で回答してください。"
-                    },
-                    {
-                        "role": "user", 
-                        "content": user_message
-                    }
-                ]
-            )
-            
-            if response.choices and len(response.choices) > 0:
-                return response.choices[0].message.content.strip()
-            else:
-                return "申し訳ありません。応答を生成できませんでした。"
-                
+            if settings.AZURE_OPENAI_COALESCE_REQUESTS:
+                # 同じ質問を処理中の呼び出しがあれば、その結果を待つ
+                return await self.single_flight.do(
+                    self.response_cache.key(user_message),
+                    lambda: self._complete(user_message, timeout)
+                )
+            return await self._complete(user_message, timeout)
+        
+        except LLMOverloadedError:
+            # 呼び出し元で503・429に変換する
+            raise
         except Exception as e:
             logger.error(f"Azure OpenAI API error: {str(e)}")
             return f"エラーが発生しました: {str(e)}"
 
+    @timed("azure_openai", "completion_stream")
+    async def _complete_stream(self, user_message: str, timeout: Optional[float]) -> AsyncIterator[str]:
+        chunks = []
+        completed = False
+        estimated_tokens = self._estimate_tokens(user_message)
+        stream = await self._create(
+            estimated_tokens,
+            messages=self._build_messages(user_message),
+            stream=True,
+            # 使用量は最後のチャンクで返される
+            stream_options={"include_usage": True},
+            **({"timeout": timeout} if timeout is not None else {})
+        )
+        try:
+            async for chunk in stream:
+                if chunk.usage:
+                    self._record_usage(estimated_tokens, chunk.usage)
+                # コンテンツフィルターの結果や使用量などchoicesが空のチャンクは読み飛ばす
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    chunks.append(delta)
+                    yield delta
+            completed = True
+        finally:
+            await stream.close()
+        
+        # 最後まで受信できた応答のみキャッシュする
+        content = "".join(chunks).strip()
+        if completed and content:
+            await self.response_cache.set(user_message, content)
+
+    @timed("azure_openai")
+    async def generate_response_stream(
+        self,
+        user_message: str,
+        timeout: Optional[float] = None,
+        use_cache: bool = True
+    ) -> AsyncIterator[str]:
+        """Azure OpenAIの応答をトークン単位で逐次返す（エラーは呼び出し元に送出）"""
+        if use_cache:
+            cached = await self.response_cache.get(user_message)
+            if cached is not None:
+                yield cached
+                return
+        elif self.response_cache.enabled:
+            self.response_cache.record_bypass()
+        
+        if settings.AZURE_OPENAI_COALESCE_REQUESTS:
+            # 同じ質問のストリームが配信中であれば、それを先頭から共有する
+            source = self.stream_flights.subscribe(
+                self.response_cache.key(user_message),
+                lambda: self._complete_stream(user_message, timeout)
+            )
+        else:
+            source = self._complete_stream(user_message, timeout)
+        async with aclosing(source):
+            async for delta in source:
+                yield delta
+
+    def coalescing_stats(self) -> Dict:
+        """同時リクエストの集約状況を取得"""
+        return {
+            "enabled": settings.AZURE_OPENAI_COALESCE_REQUESTS,
+            "completions": self.single_flight.stats(),
+            "streams": self.stream_flights.stats(),
+        }
+
+    def after_fork(self):
+        """fork後の子プロセスで呼ばれる（親プロセスのHTTP接続は共有せず、最初の呼び出し時に作り直す）"""
+        self._client = None
+        self.http_client = None
+        self.response_cache.after_fork()
+
+    async def close(self):
+        """HTTPクライアントを閉じる"""
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
+        await self.response_cache.close()
+        logger.info("Azure OpenAI client closed")
+
 # シングルトンインスタンス
-azure_openai_service = AzureOpenAIService()
\ No newline at end of file
+azure_openai_service = AzureOpenAIService()
@@ -0,0 +1,106 @@
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+_MISSING = object()
+
+
+class TTLCache:
+    """有効期限付きのLRUキャッシュ（イベントループ内での利用を想定）"""
+
+    def __init__(self, max_entries: int = 10000, ttl: float = 300.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # key -> (value, expires_at)
+        self._entries: "OrderedDict[Any, tuple]" = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key: Any, default: Any = None) -> Any:
+        """有効期限内の値を取得"""
+        entry = self._entries.get(key, _MISSING)
+        if entry is _MISSING:
+            self.misses += 1
+            return default
+        value, expires_at = entry
+        if time.monotonic() >= expires_at:
+            del self._entries[key]
+            self.misses += 1
+            return default
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Any, value: Any, ttl: Optional[float] = None):
+        """値を保存（上限を超えた場合は最も古いものから削除）"""
+        if self.max_entries <= 0:
+            return
+        self._entries[key] = (value, time.monotonic() + (self.ttl if ttl is None else ttl))
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def delete(self, key: Any):
+        """値を削除"""
+        if self._entries.pop(key, _MISSING) is not _MISSING:
+            self.invalidations += 1
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> Dict:
+        """キャッシュの統計情報を取得"""
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits / lookups) if lookups else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+        }
+
+
+class InvalidationBackend:
+    """ワーカー間でキャッシュ無効化を通知するバックエンドのインターフェース"""
+
+    async def publish(self, channel: str, key: str):
+        raise NotImplementedError
+
+    def subscribe(self, channel: str, callback: Callable[[str], None]):
+        raise NotImplementedError
+
+
+class LocalInvalidationBackend(InvalidationBackend):
+    """同一プロセス内で無効化を通知するバックエンド（単一ワーカー・テスト用）"""
+
+    def __init__(self):
+        self._subscribers: Dict[str, List[Callable[[str], None]]] = {}
+
+    async def publish(self, channel: str, key: str):
+        for callback in self._subscribers.get(channel, []):
+            try:
+                callback(key)
+            except Exception as e:
+                logger.warning(f"Cache invalidation callback failed on {channel}: {e}")
+
+    def subscribe(self, channel: str, callback: Callable[[str], None]):
+        self._subscribers.setdefault(channel, []).append(callback)
+
+
+def create_invalidation_backend(name: str) -> InvalidationBackend:
+    """設定名から無効化バックエンドを作成"""
+    if name == "local":
+        return LocalInvalidationBackend()
+    raise ValueError(f"Unknown cache invalidation backend: {name}")
@@ -1,166 +1,493 @@
+import asyncio
 import logging
 import uuid
 from datetime import datetime
-from azure.cosmos import CosmosClient, PartitionKey, exceptions
-from typing import List, Dict, Optional
+from azure.cosmos import exceptions
+from azure.cosmos.aio import CosmosClient
+from typing import Callable, List, Dict, Optional, Tuple
 from config.settings import settings
+from services.pagination import InvalidCursorError, encode_cursor, decode_cursor
+from services.metrics import COSMOS_REQUEST_CHARGE, timed
+from services.readiness import readiness
 from models.chat_models import ConversationRecord
 
 logger = logging.getLogger(__name__)
 
+class RequestCharge:
+    """Cosmos DBのresponse_hookとして渡し、消費RUを集計する（操作ごとのメトリクスにも加算）"""
+
+    def __init__(self, operation: str = "other"):
+        self.operation = operation
+        self.total = 0.0
+        self.responses = 0
+
+    def __call__(self, headers, *args):
+        try:
+            charge = float(headers.get("x-ms-request-charge", 0))
+        except (TypeError, ValueError):
+            charge = 0.0
+        self.total += charge
+        self.responses += 1
+        COSMOS_REQUEST_CHARGE.inc(charge, operation=self.operation)
+
+def _request_charge(request_charge: Optional[RequestCharge], operation: str) -> RequestCharge:
+    """呼び出し元の集計用オブジェクト（なければ新規）に操作名を設定"""
+    charge = request_charge or RequestCharge()
+    charge.operation = operation
+    return charge
+
+# 会話履歴の取得クエリ（user_email + timestamp順）用の複合インデックスを含むインデックスポリシー
+INDEXING_POLICY = {
+    "indexingMode": "consistent",
+    "automatic": True,
+    "includedPaths": [{"path": "/*"}],
+    "excludedPaths": [
+        # 本文は検索条件に使わないためインデックス対象外にして書き込みRUを抑える
+        {"path": "/message/?"},
+        {"path": "/response/?"},
+        {"path": '/"_etag"/?'}
+    ],
+    "compositeIndexes": [
+        [
+            {"path": "/user_email", "order": "ascending"},
+            {"path": "/timestamp", "order": "descending"}
+        ],
+        [
+            {"path": "/user_email", "order": "ascending"},
+            {"path": "/session_id", "order": "ascending"},
+            {"path": "/timestamp", "order": "descending"}
+        ]
+    ]
+}
+
+# 取得時に指定できるフィールド
+CONVERSATION_FIELDS = ("id", "session_id", "user_email", "message", "response", "timestamp")
+
+# トランザクションバッチ1回あたりの操作数の上限
+TRANSACTIONAL_BATCH_LIMIT = 100
+
+# ユーザーの会話削除で、取得→削除を繰り返す回数の上限（削除中に追加された会話の取りこぼし対策）
+DELETE_MAX_PASSES = 3
+
+class ConversationDeletionError(Exception):
+    """ユーザーの会話を削除しきれなかった（deleted は削除できた件数）"""
+
+    def __init__(self, user_email: str, deleted: int, reason: str):
+        self.user_email = user_email
+        self.deleted = deleted
+        super().__init__(f"Deleted only {deleted} conversations for user {user_email}: {reason}")
+
+class _AdaptiveLimiter:
+    """429（スロットリング）に応じて同時実行数を増減させるリミッター"""
+
+    def __init__(self, max_concurrency: int):
+        self.max_concurrency = max(1, max_concurrency)
+        self.limit = self.max_concurrency
+        self.throttled = 0
+        self._in_flight = 0
+        self._successes = 0
+        self._condition = asyncio.Condition()
+
+    async def acquire(self):
+        async with self._condition:
+            await self._condition.wait_for(lambda: self._in_flight < self.limit)
+            self._in_flight += 1
+
+    async def release(self, throttled: bool = False):
+        async with self._condition:
+            self._in_flight -= 1
+            if throttled:
+                # スロットリング時は同時実行数を半減
+                self.throttled += 1
+                self.limit = max(1, self.limit // 2)
+                self._successes = 0
+            else:
+                # 成功が続けば1つずつ戻す
+                self._successes += 1
+                if self._successes >= self.limit and self.limit < self.max_concurrency:
+                    self.limit += 1
+                    self._successes = 0
+            self._condition.notify_all()
+
 class CosmosDBService:
-    def __init__(self):
+    def __init__(self, container=None):
+        self.client: Optional[CosmosClient] = None
+        # テスト等でコンテナを直接渡すことができる
+        self.container = container
+        self.database_name = settings.COSMOSDB_DATABASE_NAME
+        self.container_name = settings.COSMOSDB_CONTAINER_NAME
+        self._setup_lock: Optional[asyncio.Lock] = None
+        self.state = readiness.register("cosmosdb")
+
+    async def connect(self):
+        """CosmosDBクライアントを作成し、コンテナに接続"""
+        if self.container is not None:
+            return
+
+        if settings.COSMOSDB_LOCAL:
+            # ローカル代替実装（オフライン動作用）
+            from services.local_cosmos import InMemoryContainer
+            self.container = InMemoryContainer(id=self.container_name)
+            logger.info("Using in-memory CosmosDB container")
+            return
+
+        # クライアントは1つのHTTPセッションをプロセス内で共有する
         self.client = CosmosClient(
             settings.COSMOSDB_ENDPOINT,
             settings.COSMOSDB_KEY
         )
-        self.database_name = settings.COSMOSDB_DATABASE_NAME
-        self.container_name = settings.COSMOSDB_CONTAINER_NAME
-        self.setup_database()
-
-    def setup_database(self):
-        """データベースとコンテナを設定"""
+        # データベースとコンテナは setup_database.py で作成済みのものを使う
+        container = self.client.get_database_client(self.database_name).get_container_client(self.container_name)
         try:
-            # データベースの作成（存在しない場合）
-            database = self.client.create_database_if_not_exists(
-                id=self.database_name
-            )
-            
-            # コンテナの作成（存在しない場合）
-            container = database.create_container_if_not_exists(
-                id=self.container_name,
-                partition_key=PartitionKey(path="/user_email"),
-                offer_throughput=400
+            await container.read()
+        except exceptions.CosmosResourceNotFoundError:
+            await self.close()
+            raise RuntimeError(
+                f"CosmosDB container '{self.database_name}/{self.container_name}' does not exist; "
+                f"run `python setup_database.py`"
             )
-            
-            self.container = container
-            logger.info("CosmosDB database and container setup completed")
-            
-        except exceptions.CosmosHttpResponseError as e:
-            logger.error(f"CosmosDB setup error: {e}")
+        except Exception:
+            await self.close()
             raise
+        self.container = container
+        logger.info(f"Connected to CosmosDB container '{self.database_name}/{self.container_name}'")
+
+    async def _get_container(self):
+        """コンテナを取得（未設定の場合は接続、接続失敗直後は再接続せずに失敗させる）"""
+        if self.container is None:
+            self.state.check_available()
+            if self._setup_lock is None:
+                self._setup_lock = asyncio.Lock()
+            async with self._setup_lock:
+                if self.container is None:
+                    self.state.check_available()
+                    try:
+                        await self.connect()
+                    except Exception as e:
+                        raise self.state.unavailable(e) from e
+                    self.state.mark_ready()
+        return self.container
+
+    async def warm_up(self):
+        """クライアントを作成し、コンテナの存在を確認"""
+        await self._get_container()
 
-    def save_conversation(self, conversation: ConversationRecord) -> str:
+    @timed("cosmosdb")
+    async def save_conversation(self, conversation: ConversationRecord) -> str:
         """会話記録をCosmosDBに保存"""
         try:
+            container = await self._get_container()
+
             # IDが設定されていない場合は生成
             if not conversation.id:
                 conversation.id = str(uuid.uuid4())
-            
+
             # Pydanticモデルを辞書に変換
             document = conversation.dict()
-            
+
             # datetimeをISO文字列に変換
             if isinstance(document['timestamp'], datetime):
                 document['timestamp'] = document['timestamp'].isoformat()
-            
+
             # ドキュメントを作成
-            created_item = self.container.create_item(body=document)
-            
+            created_item = await container.create_item(
+                body=document,
+                response_hook=RequestCharge("save_conversation")
+            )
+
             logger.info(f"Conversation saved to CosmosDB: {created_item['id']}")
             return created_item['id']
-            
+
         except exceptions.CosmosHttpResponseError as e:
             logger.error(f"Error saving conversation to CosmosDB: {e}")
             raise
 
-    def get_user_conversations(
-        self, 
-        user_email: str, 
+    @timed("cosmosdb")
+    async def get_user_conversations(
+        self,
+        user_email: str,
         limit: int = 50,
-        session_id: Optional[str] = None
-    ) -> List[Dict]:
-        """ユーザーの会話履歴を取得"""
+        session_id: Optional[str] = None,
+        cursor: Optional[str] = None,
+        fields: Optional[List[str]] = None,
+        request_charge: Optional[RequestCharge] = None
+    ) -> Tuple[List[Dict], Optional[str]]:
+        """ユーザーの会話履歴を1ページ分取得（次ページのカーソルを併せて返す）"""
+        # 取得するフィールドを限定してRUと転送量を抑える
+        if fields:
+            unknown = [field for field in fields if field not in CONVERSATION_FIELDS]
+            if unknown:
+                raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+            projection = ", ".join(f"c.{field}" for field in dict.fromkeys(["id", *fields]))
+        else:
+            projection = "*"
+
+        position = decode_cursor(cursor)
+        continuation_token = position.get("ct") if position else None
+        page_size = max(1, min(limit, settings.COSMOSDB_MAX_ITEM_COUNT))
+        charge = _request_charge(request_charge, "get_user_conversations")
+
         try:
+            container = await self._get_container()
+
             if session_id:
                 # 特定のセッションの会話を取得
-                query = """
-                SELECT * FROM c 
-                WHERE c.user_email = @user_email 
-                AND c.session_id = @session_id 
-                ORDER BY c.timestamp DESC 
-                OFFSET 0 LIMIT @limit
+                query = f"""
+                SELECT {projection} FROM c
+                WHERE c.user_email = @user_email
+                AND c.session_id = @session_id
+                ORDER BY c.timestamp DESC
                 """
                 parameters = [
                     {"name": "@user_email", "value": user_email},
-                    {"name": "@session_id", "value": session_id},
-                    {"name": "@limit", "value": limit}
+                    {"name": "@session_id", "value": session_id}
                 ]
             else:
                 # ユーザーのすべての会話を取得
-                query = """
-                SELECT * FROM c 
-                WHERE c.user_email = @user_email 
-                ORDER BY c.timestamp DESC 
-                OFFSET 0 LIMIT @limit
+                query = f"""
+                SELECT {projection} FROM c
+                WHERE c.user_email = @user_email
+                ORDER BY c.timestamp DESC
                 """
                 parameters = [
-                    {"name": "@user_email", "value": user_email},
-                    {"name": "@limit", "value": limit}
+                    {"name": "@user_email", "value": user_email}
                 ]
-            
-            items = list(self.container.query_items(
+
+            # 継続トークンで1ページだけ読み進める
+            pages = container.query_items(
                 query=query,
                 parameters=parameters,
-                enable_cross_partition_query=True
-            ))
-            
-            logger.info(f"Retrieved {len(items)} conversations for user: {user_email}")
-            return items
-            
+                partition_key=user_email,
+                max_item_count=page_size,
+                response_hook=charge
+            ).by_page(continuation_token=continuation_token)
+
+            items: List[Dict] = []
+            async for page in pages:
+                items = [item async for item in page]
+                break
+            next_token = pages.continuation_token
+
+            logger.info(f"Retrieved {len(items)} conversations for user: {user_email} ({charge.total:.2f} RU)")
+            return items, (encode_cursor({"ct": next_token}) if next_token else None)
+
         except exceptions.CosmosHttpResponseError as e:
+            # 空のページを返すと履歴の終わりと区別できないため、エラーは呼び出し元に伝える
+            if e.status_code == 400 and continuation_token:
+                # 継続トークンが壊れている・期限切れ
+                raise InvalidCursorError("Invalid cursor: the continuation token was rejected by CosmosDB")
             logger.error(f"Error retrieving conversations from CosmosDB: {e}")
-            return []
+            raise
 
-    def get_conversation_by_session(self, session_id: str) -> List[Dict]:
-        """セッションIDで会話履歴を取得"""
+    @timed("cosmosdb")
+    async def get_conversation_by_session(
+        self,
+        session_id: str,
+        user_email: Optional[str] = None,
+        request_charge: Optional[RequestCharge] = None
+    ) -> List[Dict]:
+        """セッションIDで会話履歴を取得（user_email指定時は単一パーティションで検索）"""
+        charge = _request_charge(request_charge, "get_conversation_by_session")
         try:
+            container = await self._get_container()
+
             query = """
-            SELECT * FROM c 
-            WHERE c.session_id = @session_id 
+            SELECT * FROM c
+            WHERE c.session_id = @session_id
             ORDER BY c.timestamp ASC
             """
             parameters = [{"name": "@session_id", "value": session_id}]
-            
-            items = list(self.container.query_items(
+
+            if user_email:
+                # パーティションキーを指定して単一パーティションのクエリにする
+                query_options = {"partition_key": user_email}
+            else:
+                logger.warning(f"Cross-partition session lookup for session: {session_id}")
+                query_options = {}
+
+            items = [item async for item in container.query_items(
                 query=query,
                 parameters=parameters,
-                enable_cross_partition_query=True
-            ))
-            
-            logger.info(f"Retrieved {len(items)} conversations for session: {session_id}")
+                response_hook=charge,
+                **query_options
+            )]
+
+            logger.info(
+                f"Retrieved {len(items)} conversations for session: {session_id} "
+                f"({charge.total:.2f} RU, {'single' if user_email else 'cross'}-partition)"
+            )
             return items
-            
+
         except exceptions.CosmosHttpResponseError as e:
             logger.error(f"Error retrieving session conversations: {e}")
             return []
 
-    def delete_user_conversations(self, user_email: str) -> int:
-        """ユーザーのすべての会話を削除"""
+    async def _delete_batch(self, container, user_email: str, item_ids: List[str], limiter: _AdaptiveLimiter) -> int:
+        """同一パーティション内の会話をトランザクションバッチで削除（429時は待機して再試行）"""
+        for attempt in range(settings.COSMOSDB_DELETE_MAX_RETRIES + 1):
+            await limiter.acquire()
+            throttled = False
+            try:
+                await container.execute_item_batch(
+                    batch_operations=[("delete", (item_id,)) for item_id in item_ids],
+                    partition_key=user_email,
+                    response_hook=RequestCharge("delete_batch")
+                )
+                return len(item_ids)
+            except exceptions.CosmosBatchOperationError:
+                # 既に削除済みの項目が含まれる場合は1件ずつ削除する
+                deleted = 0
+                for item_id in item_ids:
+                    try:
+                        await container.delete_item(
+                            item=item_id,
+                            partition_key=user_email,
+                            response_hook=RequestCharge("delete_item")
+                        )
+                        deleted += 1
+                    except exceptions.CosmosResourceNotFoundError:
+                        pass
+                return deleted
+            except exceptions.CosmosHttpResponseError as e:
+                if e.status_code != 429 or attempt >= settings.COSMOSDB_DELETE_MAX_RETRIES:
+                    raise
+                throttled = True
+                retry_after_ms = (e.headers or {}).get("x-ms-retry-after-ms")
+                delay = float(retry_after_ms) / 1000 if retry_after_ms else min(0.1 * 2 ** attempt, 5.0)
+            finally:
+                await limiter.release(throttled)
+            logger.warning(f"CosmosDB throttled while deleting; retrying in {delay:.2f}s (limit={limiter.limit})")
+            await asyncio.sleep(delay)
+        return 0
+
+    async def _has_conversations(self, container, user_email: str) -> bool:
+        """ユーザーの会話が1件でも残っているか"""
+        pages = container.query_items(
+            query="SELECT c.id FROM c WHERE c.user_email = @user_email OFFSET 0 LIMIT 1",
+            parameters=[{"name": "@user_email", "value": user_email}],
+            partition_key=user_email,
+            response_hook=RequestCharge("delete_query")
+        ).by_page()
+        async for page in pages:
+            async for _ in page:
+                return True
+        return False
+
+    @timed("cosmosdb")
+    async def delete_user_conversations(
+        self,
+        user_email: str,
+        progress_callback: Optional[Callable[[int], None]] = None
+    ) -> int:
+        """ユーザーのすべての会話を削除（ページ単位で取得し、バッチを並列に実行）
+
+        一部のバッチが失敗した場合や、上限回数まで繰り返しても会話が残る場合は
+        ConversationDeletionError を送出する。
+        """
+        deleted_count = 0
+        tasks: set = set()
+        errors: List[BaseException] = []
+
+        def _on_done(task: asyncio.Task):
+            nonlocal deleted_count
+            tasks.discard(task)
+            if task.cancelled():
+                return
+            if task.exception() is not None:
+                errors.append(task.exception())
+                return
+            deleted_count += task.result()
+            if progress_callback:
+                progress_callback(deleted_count)
+
+        async def _cancel_pending():
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        def _raise_if_failed():
+            if errors:
+                raise ConversationDeletionError(
+                    user_email, deleted_count, f"{len(errors)} batches failed: {errors[0]}"
+                ) from errors[0]
+
         try:
-            query = "SELECT c.id, c.user_email FROM c WHERE c.user_email = @user_email"
+            container = await self._get_container()
+            limiter = _AdaptiveLimiter(settings.COSMOSDB_DELETE_CONCURRENCY)
+
+            query = "SELECT c.id FROM c WHERE c.user_email = @user_email"
             parameters = [{"name": "@user_email", "value": user_email}]
-            
-            items = list(self.container.query_items(
-                query=query,
-                parameters=parameters,
-                enable_cross_partition_query=True
-            ))
-            
-            deleted_count = 0
-            for item in items:
-                self.container.delete_item(
-                    item=item['id'], 
-                    partition_key=item['user_email']
-                )
-                deleted_count += 1
-            
-            logger.info(f"Deleted {deleted_count} conversations for user: {user_email}")
+
+            # 削除中に取得漏れが出た場合に備え、1件も見つからなくなるまで繰り返す
+            for _ in range(DELETE_MAX_PASSES):
+                found = 0
+                pages = container.query_items(
+                    query=query,
+                    parameters=parameters,
+                    partition_key=user_email,
+                    max_item_count=settings.COSMOSDB_DELETE_PAGE_SIZE,
+                    response_hook=RequestCharge("delete_query")
+                ).by_page()
+                async for page in pages:
+                    item_ids = [item["id"] async for item in page]
+                    found += len(item_ids)
+                    for i in range(0, len(item_ids), TRANSACTIONAL_BATCH_LIMIT):
+                        # 同時実行数の上限に達している場合は空きが出るまで待つ
+                        while len(tasks) >= limiter.limit:
+                            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                        _raise_if_failed()
+                        task = asyncio.create_task(self._delete_batch(
+                            container, user_email, item_ids[i:i + TRANSACTIONAL_BATCH_LIMIT], limiter
+                        ))
+                        tasks.add(task)
+                        task.add_done_callback(_on_done)
+                    logger.info(f"Deleting conversations for user: {user_email} ({deleted_count}/{found} done)")
+
+                if tasks:
+                    await asyncio.wait(tasks)
+                _raise_if_failed()
+                if found == 0:
+                    break
+            else:
+                # 最後の回ですべて削除できた場合もあるため、残っているかを確認してから失敗とする
+                if await self._has_conversations(container, user_email):
+                    raise ConversationDeletionError(
+                        user_email, deleted_count, f"conversations still remain after {DELETE_MAX_PASSES} passes"
+                    )
+
+            logger.info(
+                f"Deleted {deleted_count} conversations for user: {user_email} "
+                f"(throttled {limiter.throttled} times)"
+            )
             return deleted_count
-            
+
+        except ConversationDeletionError as e:
+            await _cancel_pending()
+            logger.error(f"Error deleting user conversations: {e}")
+            raise
         except exceptions.CosmosHttpResponseError as e:
+            await _cancel_pending()
             logger.error(f"Error deleting user conversations: {e}")
-            return 0
+            raise ConversationDeletionError(user_email, deleted_count, str(e)) from e
+        except BaseException:
+            # キャンセル・予期しないエラーでも実行中のバッチを残さない
+            await _cancel_pending()
+            raise
+
+    def after_fork(self):
+        """fork後の子プロセスで呼ばれる（親プロセスのクライアントは閉じずに手放し、必要になった時点で作り直す）"""
+        if self.client:
+            self.client = None
+            self.container = None
+        self._setup_lock = None
+
+    async def close(self):
+        """CosmosDBクライアントを閉じる"""
+        if self.client:
+            await self.client.close()
+            self.client = None
+            self.container = None
+            logger.info("CosmosDB client closed")
 
 # シングルトンインスタンス
-cosmosdb_service = CosmosDBService()
\ No newline at end of file
+cosmosdb_service = CosmosDBService()
@@ -0,0 +1,559 @@
+"""
+会話履歴（chat_messages）をJSONL/CSVでストリーミング出力する
+
+非バッファのカーソルで結果をサーバーから逐次受け取り、chunk_size 件ずつ
+書き出すため、テーブルの大きさに関係なくメモリ使用量は一定になる。
+圧縮時はチャンクごとに独立したgzipメンバー / zstdフレームとして書き込み、
+チェックポイントには最後に書き出した id とファイルのバイト位置を記録する。
+再開時はその位置までファイルを切り詰めてから続きを追記するため、
+中断されても重複や壊れたデータが残らない。
+"""
+
+import csv
+import gzip
+import hashlib
+import io
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Tuple
+import mysql.connector
+from config.settings import settings
+
+logger = logging.getLogger(__name__)
+
+EXPORT_COLUMNS = ["id", "session_id", "user_email", "message", "response", "created_at"]
+
+FORMATS = ("jsonl", "csv")
+COMPRESSIONS = ("none", "gzip", "zstd")
+
+
+def detect_compression(path: Optional[str]) -> str:
+    """出力ファイルの拡張子から圧縮形式を判定"""
+    if path and path.endswith(".gz"):
+        return "gzip"
+    if path and path.endswith(".zst"):
+        return "zstd"
+    return "none"
+
+
+def _compressor(compression: str) -> Callable[[bytes], bytes]:
+    if compression == "gzip":
+        return lambda data: gzip.compress(data, compresslevel=6)
+    if compression == "zstd":
+        try:
+            import zstandard
+        except ImportError:
+            raise RuntimeError("zstd圧縮には zstandard パッケージが必要です（pip install zstandard）")
+        compressor = zstandard.ZstdCompressor(level=3)
+        return compressor.compress
+    return lambda data: data
+
+
+def _format_value(value):
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m-%d %H:%M:%S')
+    return value
+
+
+def serialize_rows(rows: List[Dict], fmt: str, header: bool = False) -> bytes:
+    """行をJSONLまたはCSVのバイト列に変換"""
+    if fmt == "jsonl":
+        return "".join(
+            json.dumps({column: _format_value(row[column]) for column in EXPORT_COLUMNS}, ensure_ascii=False) + "\n"
+            for row in rows
+        ).encode("utf-8")
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    if header:
+        writer.writerow(EXPORT_COLUMNS)
+    for row in rows:
+        writer.writerow([_format_value(row[column]) for column in EXPORT_COLUMNS])
+    return buffer.getvalue().encode("utf-8")
+
+
+def _filter_clause(
+    since: Optional[str] = None,
+    until: Optional[str] = None,
+    user_email: Optional[str] = None,
+    user_emails: Optional[List[str]] = None
+) -> Tuple[str, list]:
+    clause = ""
+    params: list = []
+    if since:
+        clause += " AND created_at >= %s"
+        params.append(since)
+    if until:
+        clause += " AND created_at < %s"
+        params.append(until)
+    if user_email:
+        clause += " AND user_email = %s"
+        params.append(user_email)
+    if user_emails:
+        clause += f" AND user_email IN ({', '.join(['%s'] * len(user_emails))})"
+        params.extend(user_emails)
+    return clause, params
+
+
+def build_export_query(
+    since: Optional[str] = None,
+    until: Optional[str] = None,
+    user_email: Optional[str] = None,
+    after_id: int = 0,
+    max_id: Optional[int] = None,
+    user_emails: Optional[List[str]] = None
+) -> Tuple[str, list]:
+    """id 昇順で読み出すSQLとパラメータを返す（主キーの範囲走査）"""
+    query = f"SELECT {', '.join(EXPORT_COLUMNS)} FROM chat_messages WHERE id > %s"
+    params: list = [after_id]
+    if max_id is not None:
+        query += " AND id <= %s"
+        params.append(max_id)
+    clause, filter_params = _filter_clause(since, until, user_email, user_emails)
+    query += clause + " ORDER BY id"
+    return query, params + filter_params
+
+
+class ExportCheckpoint:
+    """エクスポートの再開位置をJSONファイルに保存する"""
+
+    def __init__(self, path: Optional[str]):
+        self.path = path
+        self.last_id = 0
+        self.rows = 0
+        self.offset = 0
+        self.params: Dict = {}
+
+    def load(self, params: Dict) -> bool:
+        """チェックポイントを読み込む（条件が異なる場合はエラー）"""
+        if not self.path or not os.path.exists(self.path):
+            return False
+        with open(self.path, encoding="utf-8") as f:
+            state = json.load(f)
+        if state.get("params") != params:
+            raise ValueError(
+                f"チェックポイント {self.path} は別の条件のエクスポートのものです: {state.get('params')}"
+            )
+        self.last_id = state["last_id"]
+        self.rows = state["rows"]
+        self.offset = state["offset"]
+        self.params = params
+        return True
+
+    def save(self, last_id: int, rows: int, offset: int, params: Dict, completed: bool = False):
+        self.last_id, self.rows, self.offset, self.params = last_id, rows, offset, params
+        if not self.path:
+            return
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({
+                "last_id": last_id,
+                "rows": rows,
+                "offset": offset,
+                "params": params,
+                "completed": completed,
+                "updated_at": datetime.now().isoformat(),
+            }, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+
+class ProgressReporter:
+    """処理件数と rows/sec を標準エラー出力に表示"""
+
+    def __init__(self, label: str = "export", interval: float = 5.0, stream=None):
+        self.label = label
+        self.interval = interval
+        self.stream = stream or sys.stderr
+        self.started_at = time.monotonic()
+        self._last_report = self.started_at
+        self.rows = 0
+        self.bytes = 0
+
+    def update(self, rows: int, written: int):
+        self.rows += rows
+        self.bytes += written
+        now = time.monotonic()
+        if now - self._last_report >= self.interval:
+            self._last_report = now
+            self._print(now)
+
+    def _print(self, now: float, prefix: str = ""):
+        elapsed = max(now - self.started_at, 1e-9)
+        print(
+            f"{prefix}[{self.label}] {self.rows:,} rows, {self.bytes / 1024 / 1024:.1f} MiB, "
+            f"{elapsed:.1f}s, {self.rows / elapsed:,.0f} rows/sec",
+            file=self.stream
+        )
+
+    def summary(self) -> Dict:
+        now = time.monotonic()
+        self._print(now, prefix="完了 ")
+        elapsed = now - self.started_at
+        return {
+            "rows": self.rows,
+            "bytes": self.bytes,
+            "elapsed_seconds": elapsed,
+            "rows_per_second": self.rows / elapsed if elapsed > 0 else 0.0,
+        }
+
+
+def export_conversations(
+    connection,
+    output_path: Optional[str] = None,
+    fmt: str = "jsonl",
+    compression: Optional[str] = None,
+    chunk_size: int = 5000,
+    checkpoint_path: Optional[str] = None,
+    since: Optional[str] = None,
+    until: Optional[str] = None,
+    user_email: Optional[str] = None,
+    after_id: int = 0,
+    max_id: Optional[int] = None,
+    user_emails: Optional[List[str]] = None,
+    csv_header: bool = True,
+    reporter: Optional[ProgressReporter] = None
+) -> Dict:
+    """chat_messages を id 順にストリーミング出力し、件数と速度を返す
+
+    output_path が None の場合は標準出力に書き込む（ファイルの切り詰めによる
+    再開はできないが、チェックポイントの id からの再開は可能）。
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"Unsupported export format: {fmt}")
+    compression = compression or detect_compression(output_path)
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"Unsupported compression: {compression}")
+    compress = _compressor(compression)
+
+    params = {
+        "output": output_path, "format": fmt, "compression": compression,
+        "since": since, "until": until, "user_email": user_email,
+        "after_id": after_id, "max_id": max_id, "user_emails": user_emails,
+    }
+    checkpoint = ExportCheckpoint(checkpoint_path)
+    resumed = checkpoint.load(params)
+    if resumed and output_path and (
+        not os.path.exists(output_path) or os.path.getsize(output_path) < checkpoint.offset
+    ):
+        # 出力ファイルが消えた・短くなった場合は、続きから書くと先頭が欠けるため最初からやり直す
+        logger.warning(
+            f"Output {output_path} is missing or shorter than the checkpoint offset "
+            f"({checkpoint.offset} bytes); discarding the checkpoint and restarting the export"
+        )
+        resumed = False
+    last_id = checkpoint.last_id if resumed else after_id
+    total_rows = checkpoint.rows if resumed else 0
+    reporter = reporter or ProgressReporter()
+
+    if output_path:
+        out = open(output_path, "r+b" if resumed else "wb")
+        if resumed:
+            # 最後のチェックポイント以降に書かれた不完全な出力を捨てる
+            out.truncate(checkpoint.offset)
+            out.seek(checkpoint.offset)
+    else:
+        out = sys.stdout.buffer
+
+    query, query_params = build_export_query(since, until, user_email, last_id, max_id, user_emails)
+    # buffered=False: 結果セットをクライアントに溜め込まず、fetchmany で逐次受け取る
+    cursor = connection.cursor(dictionary=True, buffered=False)
+    try:
+        cursor.execute(query, query_params)
+        header = fmt == "csv" and csv_header and total_rows == 0
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            data = compress(serialize_rows(rows, fmt, header=header))
+            header = False
+            out.write(data)
+            out.flush()
+            last_id = rows[-1]["id"]
+            total_rows += len(rows)
+            checkpoint.save(last_id, total_rows, out.tell() if output_path else 0, params)
+            reporter.update(len(rows), len(data))
+
+        if header:
+            # 0件でもCSVのヘッダーは出力する
+            out.write(compress(serialize_rows([], fmt, header=True)))
+        checkpoint.save(last_id, total_rows, out.tell() if output_path else 0, params, completed=True)
+    finally:
+        cursor.close()
+        if output_path:
+            out.close()
+        else:
+            out.flush()
+
+    result = reporter.summary()
+    result.update({"total_rows": total_rows, "last_id": last_id, "resumed": resumed})
+    return result
+
+
+# --- 並列エクスポート ---
+
+def plan_id_shards(
+    connection,
+    shard_size: int,
+    since: Optional[str] = None,
+    until: Optional[str] = None,
+    user_email: Optional[str] = None
+) -> List[Dict]:
+    """対象行の id の範囲を shard_size ごとに分割する"""
+    clause, params = _filter_clause(since, until, user_email)
+    cursor = connection.cursor()
+    cursor.execute(f"SELECT MIN(id), MAX(id) FROM chat_messages WHERE 1 = 1{clause}", params)
+    min_id, max_id = cursor.fetchone()
+    cursor.close()
+    if min_id is None:
+        return []
+
+    shards = []
+    start = min_id - 1
+    while start < max_id:
+        end = min(start + shard_size, max_id)
+        shards.append({"after_id": start, "max_id": end})
+        start = end
+    return shards
+
+
+def plan_user_shards(
+    connection,
+    shard_size: int,
+    since: Optional[str] = None,
+    until: Optional[str] = None
+) -> List[Dict]:
+    """ユーザーをメールアドレス順に、1シャードあたり約 shard_size 件になるようまとめる"""
+    clause, params = _filter_clause(since, until)
+    cursor = connection.cursor()
+    # 計画時点の最大 id で各シャードを打ち切り、再開時に後から追加された行が混ざらないようにする
+    cursor.execute(f"SELECT MAX(id) FROM chat_messages WHERE 1 = 1{clause}", params)
+    max_id = cursor.fetchone()[0]
+    cursor.execute(
+        f"SELECT user_email, COUNT(*) FROM chat_messages WHERE 1 = 1{clause} AND id <= %s "
+        "GROUP BY user_email ORDER BY user_email",
+        params + [max_id]
+    )
+    shards: List[Dict] = []
+    users: List[str] = []
+    rows = 0
+    for user, count in cursor:
+        if users and rows + count > shard_size:
+            shards.append({"user_emails": users, "max_id": max_id})
+            users, rows = [], 0
+        users.append(user)
+        rows += count
+    cursor.close()
+    if users:
+        shards.append({"user_emails": users, "max_id": max_id})
+    return shards
+
+
+def _load_shard_plan(path: str, params: Dict) -> Optional[List[Dict]]:
+    """前回の実行で保存したシャード計画を読み込む（条件が異なる場合は None）"""
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        plan = json.load(f)
+    if plan.get("params") != params:
+        return None
+    return plan["shards"]
+
+
+def _save_shard_plan(path: str, params: Dict, shards: List[Dict]):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({
+            "params": params,
+            "shards": shards,
+            "created_at": datetime.now().isoformat(),
+        }, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def _export_shard(job: Dict) -> Dict:
+    """1シャードを専用の接続でファイルに出力（ProcessPoolExecutor のワーカーで実行）"""
+    connection = mysql.connector.connect(
+        host=settings.MYSQL_HOST,
+        port=settings.MYSQL_PORT,
+        user=settings.MYSQL_USER,
+        password=settings.MYSQL_PASSWORD,
+        database=settings.MYSQL_DATABASE
+    )
+    try:
+        shard = job["shard"]
+        result = export_conversations(
+            connection,
+            output_path=job["path"],
+            fmt=job["format"],
+            compression=job["compression"],
+            chunk_size=job["chunk_size"],
+            checkpoint_path=job["path"] + ".checkpoint",
+            since=job["since"],
+            until=job["until"],
+            user_email=job["user_email"],
+            after_id=shard.get("after_id", 0),
+            max_id=shard.get("max_id"),
+            user_emails=shard.get("user_emails"),
+            csv_header=job["index"] == 0,
+            reporter=ProgressReporter(label=f"shard {job['index'] + 1}/{job['total']}")
+        )
+    finally:
+        connection.close()
+    result["index"] = job["index"]
+    return result
+
+
+def _sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def export_conversations_parallel(
+    connection,
+    output_path: Optional[str] = None,
+    fmt: str = "jsonl",
+    compression: Optional[str] = None,
+    chunk_size: int = 5000,
+    workers: int = 4,
+    shard_size: int = 100000,
+    shard_by: str = "id",
+    since: Optional[str] = None,
+    until: Optional[str] = None,
+    user_email: Optional[str] = None,
+    keep_shards: bool = False
+) -> Dict:
+    """対象をシャードに分割してプロセスプールで並列に出力し、シャード順に結合する
+
+    各シャードは独自の接続・チェックポイントを持つため、中断後に再実行すると
+    完了済みのシャードは読み直さずに再開される。シャードの範囲は初回に
+    <output>.shards/plan.json に保存して再実行時も同じものを使うため、
+    その間に行が追加されても各シャードのチェックポイントと食い違わない。出力先がファイルの場合は
+    シャードごとの範囲・件数・SHA-256を記録したマニフェスト（<output>.manifest.json）も出力する。
+    gzipメンバー / zstdフレームは連結しても有効なため、結合はバイト列の連結で行う。
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"Unsupported export format: {fmt}")
+    if shard_by not in ("id", "user"):
+        raise ValueError(f"Unsupported shard key: {shard_by}")
+    compression = compression or detect_compression(output_path)
+    started_at = time.monotonic()
+
+    if shard_by == "user" and user_email:
+        raise ValueError("--user はユーザー単位のシャード分割と併用できません")
+
+    shard_dir = (output_path or "export") + ".shards"
+    os.makedirs(shard_dir, exist_ok=True)
+    extension = {"gzip": ".gz", "zstd": ".zst"}.get(compression, "")
+    plan_path = os.path.join(shard_dir, "plan.json")
+    plan_params = {
+        "format": fmt, "compression": compression, "shard_by": shard_by, "shard_size": shard_size,
+        "since": since, "until": until, "user_email": user_email,
+    }
+    shards = _load_shard_plan(plan_path, plan_params)
+    if shards is None:
+        # 条件の異なる前回のシャードが残っていれば、チェックポイントごと捨ててから計画し直す
+        for name in os.listdir(shard_dir):
+            if name.startswith("shard-"):
+                logger.warning(f"Discarding shard {name} left by an export with different options")
+                os.remove(os.path.join(shard_dir, name))
+        if shard_by == "user":
+            shards = plan_user_shards(connection, shard_size, since, until)
+        else:
+            shards = plan_id_shards(connection, shard_size, since, until, user_email)
+        _save_shard_plan(plan_path, plan_params, shards)
+    else:
+        print(f"[export] resuming with the shard plan in {plan_path}", file=sys.stderr)
+    jobs = [{
+        "index": index,
+        "total": len(shards),
+        "shard": shard,
+        "path": os.path.join(shard_dir, f"shard-{index:05d}.{fmt}{extension}"),
+        "format": fmt,
+        "compression": compression,
+        "chunk_size": chunk_size,
+        "since": since,
+        "until": until,
+        "user_email": user_email,
+    } for index, shard in enumerate(shards)]
+    print(f"[export] {len(jobs)} shards ({shard_by}), {workers} workers", file=sys.stderr)
+
+    results: Dict[int, Dict] = {}
+    with ProcessPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = {executor.submit(_export_shard, job): job for job in jobs}
+        for future in as_completed(futures):
+            result = future.result()
+            results[result["index"]] = result
+            print(
+                f"[export] shard {result['index'] + 1}/{len(jobs)} done: {result['total_rows']:,} rows "
+                f"({result['rows_per_second']:,.0f} rows/sec), {len(results)}/{len(jobs)} shards complete",
+                file=sys.stderr
+            )
+
+    # シャード順に結合
+    out = open(output_path, "wb") if output_path else sys.stdout.buffer
+    try:
+        if not jobs and fmt == "csv":
+            out.write(_compressor(compression)(serialize_rows([], fmt, header=True)))
+        for job in jobs:
+            with open(job["path"], "rb") as f:
+                while True:
+                    block = f.read(1024 * 1024)
+                    if not block:
+                        break
+                    out.write(block)
+    finally:
+        if output_path:
+            out.close()
+        else:
+            out.flush()
+
+    total_rows = sum(result["total_rows"] for result in results.values())
+    elapsed = time.monotonic() - started_at
+    manifest = {
+        "output": output_path,
+        "format": fmt,
+        "compression": compression,
+        "shard_by": shard_by,
+        "filters": {"since": since, "until": until, "user_email": user_email},
+        "total_rows": total_rows,
+        "elapsed_seconds": elapsed,
+        "rows_per_second": total_rows / elapsed if elapsed > 0 else 0.0,
+        "workers": workers,
+        "created_at": datetime.now().isoformat(),
+        "shards": [{
+            "index": job["index"],
+            **job["shard"],
+            "rows": results[job["index"]]["total_rows"],
+            "bytes": os.path.getsize(job["path"]),
+            "sha256": _sha256(job["path"]),
+            "elapsed_seconds": results[job["index"]]["elapsed_seconds"],
+        } for job in jobs],
+    }
+    if output_path:
+        manifest["sha256"] = _sha256(output_path)
+        with open(output_path + ".manifest.json", "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2)
+
+    if not keep_shards:
+        for job in jobs:
+            for path in (job["path"], job["path"] + ".checkpoint"):
+                if os.path.exists(path):
+                    os.remove(path)
+        os.remove(plan_path)
+        if not os.listdir(shard_dir):
+            os.rmdir(shard_dir)
+
+    print(
+        f"完了 [export] {total_rows:,} rows, {len(jobs)} shards, {elapsed:.1f}s, "
+        f"{manifest['rows_per_second']:,.0f} rows/sec",
+        file=sys.stderr
+    )
+    return manifest
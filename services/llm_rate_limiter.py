@@ -0,0 +1,222 @@
+"""
+Azure OpenAIへの呼び出しのクライアント側レート制限
+
+デプロイメントのクォータ（1分あたりのリクエスト数・トークン数）を超えないよう、
+呼び出し前に枠を確保する。枠が空くまでは到着順に待機させ、待機数の上限や
+待機期限を超える場合は呼び出さずに LLMOverloadedError を送出する（負荷の切り捨て）。
+429（スロットリング）を受けた場合は Retry-After の間すべての呼び出しを止める。
+"""
+
+import asyncio
+import logging
+import random
+import time
+from typing import Dict, Optional
+from config.settings import settings
+
+logger = logging.getLogger(__name__)
+
+# 待機数の上限を超えた / 待機期限までに枠が空かない / 429の再試行を使い切った
+SHED_REASONS = ("queue_full", "timeout", "throttled")
+
+
+class LLMOverloadedError(Exception):
+    """Azure OpenAIの呼び出し枠を確保できなかった（ルートでは503・429に変換する）"""
+
+    def __init__(self, reason: str, retry_after: float):
+        self.reason = reason
+        self.retry_after = retry_after
+        super().__init__(f"Azure OpenAI request was shed ({reason}); retry after {retry_after:.1f}s")
+
+
+def estimate_tokens(text: str) -> int:
+    """トークン数の概算（ASCIIは4文字で1トークン、それ以外は1文字1トークンとして多めに見積もる）"""
+    ascii_chars = sum(1 for char in text if char.isascii())
+    return (ascii_chars + 3) // 4 + (len(text) - ascii_chars)
+
+
+# Azure OpenAIは1分あたりの上限を10秒単位でも評価するため、一度に使える量は10秒分までとする
+BURST_SECONDS = 10.0
+
+
+class _TokenBucket:
+    """1分あたりの上限を連続的に補充するトークンバケット"""
+
+    def __init__(self, per_minute: int):
+        self.rate = per_minute / 60.0
+        self.capacity = max(1.0, self.rate * BURST_SECONDS)
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """amount を消費できるようになるまでの秒数"""
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        return max(0.0, (amount - self.level) / self.rate)
+
+    def consume(self, amount: float, now: float):
+        self._refill(now)
+        self.level -= min(amount, self.capacity)
+
+    def adjust(self, amount: float):
+        """見積もりと実際の差分を反映（負の値なら返却）"""
+        self.level = min(self.capacity, self.level - amount)
+
+
+class LLMRateLimiter:
+    """1分あたりのリクエスト数・推定トークン数の上限と、429に応じた呼び出しの一時停止"""
+
+    def __init__(
+        self,
+        requests_per_minute: int = 0,
+        tokens_per_minute: int = 0,
+        max_queue: int = 100,
+        queue_timeout: float = 30.0,
+        retry_backoff: float = 1.0,
+        retry_max_backoff: float = 30.0
+    ):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.retry_backoff = retry_backoff
+        self.retry_max_backoff = retry_max_backoff
+
+        # 0以下は無制限
+        self._requests = _TokenBucket(requests_per_minute) if requests_per_minute > 0 else None
+        self._tokens = _TokenBucket(tokens_per_minute) if tokens_per_minute > 0 else None
+        # asyncio.Lock は取得を待つ順に渡されるため、待機中の呼び出しは到着順に枠を得る
+        self._turn = asyncio.Lock()
+        self._cooldown_until = 0.0
+
+        self.waiting = 0
+        self.admitted = 0
+        self.delayed = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+        self.throttled = 0
+        self.retries = 0
+        self.shed: Dict[str, int] = {reason: 0 for reason in SHED_REASONS}
+
+    def deadline(self) -> float:
+        """この時点から待機できる期限（time.monotonic() 基準）"""
+        return time.monotonic() + self.queue_timeout
+
+    def reject(self, reason: str, retry_after: float) -> LLMOverloadedError:
+        """切り捨てを記録し、呼び出し元に送出する例外を返す"""
+        self.shed[reason] += 1
+        return LLMOverloadedError(reason, max(retry_after, 0.0))
+
+    def _wait_time(self, tokens: int, now: float) -> float:
+        wait = self._cooldown_until - now
+        if self._requests:
+            wait = max(wait, self._requests.wait_time(1, now))
+        if self._tokens:
+            wait = max(wait, self._tokens.wait_time(tokens, now))
+        return max(0.0, wait)
+
+    def check_capacity(self):
+        """待機数が上限に達していれば即座に失敗させる（ストリーム開始前の確認用）"""
+        if self.waiting >= self.max_queue:
+            raise self.reject("queue_full", self._wait_time(0, time.monotonic()))
+
+    def _consume(self, tokens: int, now: float):
+        if self._requests:
+            self._requests.consume(1, now)
+        if self._tokens:
+            self._tokens.consume(tokens, now)
+
+    async def _take_turn(self, tokens: int, deadline: float):
+        async with self._turn:
+            while True:
+                now = time.monotonic()
+                wait = self._wait_time(tokens, now)
+                if wait <= 0:
+                    self._consume(tokens, now)
+                    return
+                if now + wait > deadline:
+                    # 期限までに枠が空かないことが分かった時点で諦める
+                    raise self.reject("timeout", wait)
+                await asyncio.sleep(wait)
+
+    async def acquire(self, tokens: int, deadline: Optional[float] = None):
+        """tokens（推定トークン数）の枠を確保するまで待機"""
+        now = time.monotonic()
+        if self.waiting == 0 and self._wait_time(tokens, now) <= 0:
+            # 待機中の呼び出しがなく枠が空いていれば待たずに通す
+            self._consume(tokens, now)
+            self.admitted += 1
+            return
+        self.check_capacity()
+        deadline = deadline or self.deadline()
+        start = time.monotonic()
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self._take_turn(tokens, deadline), timeout=max(0.0, deadline - start))
+        except asyncio.TimeoutError:
+            raise self.reject("timeout", self._wait_time(tokens, time.monotonic()))
+        finally:
+            self.waiting -= 1
+        waited = time.monotonic() - start
+        self.admitted += 1
+        if waited > 0.001:
+            self.delayed += 1
+        self.wait_seconds_total += waited
+        self.wait_seconds_max = max(self.wait_seconds_max, waited)
+
+    def record_usage(self, estimated: int, actual: int):
+        """応答に含まれる実際のトークン数で見積もりを補正"""
+        if self._tokens:
+            self._tokens.adjust(actual - estimated)
+
+    def record_throttled(self, retry_after: Optional[float], attempt: int) -> float:
+        """429を記録して全呼び出しを一時停止し、この呼び出しが再試行まで待つ秒数（ジッター付き）を返す"""
+        self.throttled += 1
+        delay = retry_after if retry_after is not None else min(
+            self.retry_max_backoff, self.retry_backoff * (2 ** attempt)
+        )
+        self._cooldown_until = max(self._cooldown_until, time.monotonic() + delay)
+        # 待機していた呼び出しが一斉に再開しないよう、再試行の時刻をばらつかせる
+        return delay + random.uniform(0, min(self.retry_max_backoff, self.retry_backoff * (2 ** attempt)))
+
+    def backoff(self, attempt: int) -> float:
+        """429以外の一時的なエラーの再試行までの秒数（ジッター付き指数バックオフ）"""
+        return random.uniform(0, min(self.retry_max_backoff, self.retry_backoff * (2 ** attempt)))
+
+    def stats(self) -> Dict:
+        now = time.monotonic()
+        stats = {
+            "waiting": self.waiting,
+            "max_queue": self.max_queue,
+            "admitted": self.admitted,
+            "delayed": self.delayed,
+            "wait_seconds_total": round(self.wait_seconds_total, 3),
+            "wait_seconds_max": round(self.wait_seconds_max, 3),
+            "throttled": self.throttled,
+            "retries": self.retries,
+            "cooldown_seconds": round(max(0.0, self._cooldown_until - now), 3),
+            "shed": dict(self.shed),
+        }
+        if self._requests:
+            self._requests._refill(now)
+            stats["requests_available"] = round(self._requests.level, 1)
+        if self._tokens:
+            self._tokens._refill(now)
+            stats["tokens_available"] = round(self._tokens.level, 1)
+        return stats
+
+
+def create_llm_rate_limiter() -> LLMRateLimiter:
+    """設定値からリミッターを作成"""
+    return LLMRateLimiter(
+        requests_per_minute=settings.AZURE_OPENAI_REQUESTS_PER_MINUTE,
+        tokens_per_minute=settings.AZURE_OPENAI_TOKENS_PER_MINUTE,
+        max_queue=settings.AZURE_OPENAI_MAX_QUEUE,
+        queue_timeout=settings.AZURE_OPENAI_QUEUE_TIMEOUT,
+        retry_backoff=settings.AZURE_OPENAI_RETRY_BACKOFF,
+        retry_max_backoff=settings.AZURE_OPENAI_RETRY_MAX_BACKOFF
+    )
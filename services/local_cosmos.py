@@ -0,0 +1,300 @@
+"""
+CosmosDBコンテナのローカル代替実装（オフラインでの動作確認・テスト用）
+
+azure.cosmos.aio.ContainerProxy のうち本アプリケーションで使用する
+メソッドのみを、メモリ上のデータで再現する。クエリは
+SELECT / WHERE（AND結合の比較条件）/ ORDER BY / OFFSET LIMIT の
+単純な構文のみをサポートする。
+"""
+
+import asyncio
+import copy
+import re
+import time
+from typing import Any, Dict, List, Optional, Tuple
+from azure.cosmos import exceptions
+
+_QUERY_RE = re.compile(
+    r"^\s*SELECT\s+(?P<select>.+?)\s+FROM\s+(?P<alias>\w+)"
+    r"(?:\s+WHERE\s+(?P<where>.+?))?"
+    r"(?:\s+ORDER\s+BY\s+(?P<order>.+?))?"
+    r"(?:\s+OFFSET\s+(?P<offset>\S+)\s+LIMIT\s+(?P<limit>\S+))?\s*$",
+    re.IGNORECASE | re.DOTALL
+)
+_CONDITION_RE = re.compile(r"^\s*(?P<field>[\w.]+)\s*(?P<op>=|!=|<>|<=|>=|<|>)\s*(?P<value>.+?)\s*$")
+
+_OPERATORS = {
+    "=": lambda a, b: a == b,
+    "!=": lambda a, b: a != b,
+    "<>": lambda a, b: a != b,
+    "<": lambda a, b: a is not None and a < b,
+    ">": lambda a, b: a is not None and a > b,
+    "<=": lambda a, b: a is not None and a <= b,
+    ">=": lambda a, b: a is not None and a >= b,
+}
+
+
+def _field_path(expr: str, alias: str) -> List[str]:
+    parts = expr.strip().split(".")
+    if parts[0] == alias:
+        parts = parts[1:]
+    return parts
+
+
+def _get_field(document: Dict, path: List[str]) -> Any:
+    value: Any = document
+    for part in path:
+        if not isinstance(value, dict):
+            return None
+        value = value.get(part)
+    return value
+
+
+class _ParsedQuery:
+    def __init__(self, query: str, parameters: Optional[List[Dict]]):
+        match = _QUERY_RE.match(query)
+        if not match:
+            raise exceptions.CosmosHttpResponseError(status_code=400, message=f"Unsupported query: {query}")
+
+        params = {p["name"]: p["value"] for p in (parameters or [])}
+        self.alias = match.group("alias")
+
+        select = match.group("select").strip()
+        if select == "*":
+            self.projection = None
+        else:
+            self.projection = [
+                (_field_path(field, self.alias)[-1], _field_path(field, self.alias))
+                for field in select.split(",")
+            ]
+
+        self.conditions: List[Tuple[List[str], Any, Any]] = []
+        if match.group("where"):
+            for clause in re.split(r"\s+AND\s+", match.group("where"), flags=re.IGNORECASE):
+                condition = _CONDITION_RE.match(clause)
+                if not condition:
+                    raise exceptions.CosmosHttpResponseError(
+                        status_code=400, message=f"Unsupported condition: {clause}"
+                    )
+                self.conditions.append((
+                    _field_path(condition.group("field"), self.alias),
+                    _OPERATORS[condition.group("op")],
+                    self._resolve(condition.group("value"), params)
+                ))
+
+        self.order: List[Tuple[List[str], bool]] = []
+        if match.group("order"):
+            for term in match.group("order").split(","):
+                tokens = term.split()
+                descending = len(tokens) > 1 and tokens[1].upper() == "DESC"
+                self.order.append((_field_path(tokens[0], self.alias), descending))
+
+        self.offset = int(self._resolve(match.group("offset"), params)) if match.group("offset") else 0
+        self.limit = int(self._resolve(match.group("limit"), params)) if match.group("limit") else None
+
+    @staticmethod
+    def _resolve(token: str, params: Dict) -> Any:
+        token = token.strip()
+        if token.startswith("@"):
+            return params.get(token)
+        if token.startswith(("'", '"')):
+            return token[1:-1]
+        if token.lower() in ("true", "false"):
+            return token.lower() == "true"
+        try:
+            return int(token)
+        except ValueError:
+            return float(token)
+
+    def matches(self, document: Dict) -> bool:
+        return all(op(_get_field(document, path), value) for path, op, value in self.conditions)
+
+    def apply(self, documents: List[Dict]) -> List[Dict]:
+        results = [doc for doc in documents if self.matches(doc)]
+        for path, descending in reversed(self.order):
+            results.sort(key=lambda doc: (_get_field(doc, path) is not None, _get_field(doc, path) or ""),
+                         reverse=descending)
+        end = self.offset + self.limit if self.limit is not None else None
+        results = results[self.offset:end]
+        if self.projection is not None:
+            results = [{name: _get_field(doc, path) for name, path in self.projection} for doc in results]
+        return [copy.deepcopy(doc) for doc in results]
+
+
+class _LocalPage:
+    def __init__(self, items: List[Dict]):
+        self._items = items
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for item in self._items:
+            yield item
+
+
+class _LocalPageIterator:
+    def __init__(self, items: List[Dict], page_size: int, continuation_token: Optional[str]):
+        self._items = items
+        self._page_size = page_size
+        self._position = int(continuation_token) if continuation_token else 0
+        self._done = False
+        self.continuation_token: Optional[str] = continuation_token
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> _LocalPage:
+        if self._done:
+            raise StopAsyncIteration
+        page = self._items[self._position:self._position + self._page_size]
+        self._position += len(page)
+        if self._position >= len(self._items):
+            self._done = True
+            self.continuation_token = None
+        else:
+            self.continuation_token = str(self._position)
+        return _LocalPage(page)
+
+
+class _LocalItemPaged:
+    def __init__(self, items: List[Dict], page_size: int):
+        self._items = items
+        self._page_size = page_size
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for item in self._items:
+            yield item
+
+    def by_page(self, continuation_token: Optional[str] = None) -> _LocalPageIterator:
+        return _LocalPageIterator(self._items, self._page_size, continuation_token)
+
+
+# 消費RUの概算値（実際の課金とは異なるが、クエリ方式の比較に使える）
+_RU_WRITE = 6.0
+_RU_READ = 1.0
+_RU_PER_PARTITION = 2.5
+_RU_PER_DOCUMENT_SCANNED = 0.05
+
+
+def _report_charge(kwargs: Dict, charge: float):
+    response_hook = kwargs.get("response_hook")
+    if response_hook:
+        response_hook({"x-ms-request-charge": f"{charge:.2f}"}, None)
+
+
+class InMemoryContainer:
+    """メモリ上でCosmosDBコンテナを模倣するクラス"""
+
+    def __init__(self, id: str = "conversations", partition_key_path: str = "/user_email", latency: float = 0.0):
+        self.id = id
+        self.partition_key_path = partition_key_path
+        self.latency = latency
+        # partition key -> item id -> document
+        self._partitions: Dict[Any, Dict[str, Dict]] = {}
+
+    def _partition_value(self, document: Dict) -> Any:
+        return _get_field(document, self.partition_key_path.strip("/").split("/"))
+
+    async def _round_trip(self):
+        await asyncio.sleep(self.latency)
+
+    async def create_item(self, body: Dict, **kwargs) -> Dict:
+        await self._round_trip()
+        if "id" not in body:
+            raise exceptions.CosmosHttpResponseError(status_code=400, message="'id' is required")
+        partition = self._partitions.setdefault(self._partition_value(body), {})
+        if body["id"] in partition:
+            raise exceptions.CosmosResourceExistsError(status_code=409, message="Entity with the specified id already exists")
+        document = copy.deepcopy(body)
+        document["_ts"] = int(time.time())
+        partition[document["id"]] = document
+        _report_charge(kwargs, _RU_WRITE)
+        return copy.deepcopy(document)
+
+    async def upsert_item(self, body: Dict, **kwargs) -> Dict:
+        await self._round_trip()
+        document = copy.deepcopy(body)
+        document["_ts"] = int(time.time())
+        self._partitions.setdefault(self._partition_value(body), {})[document["id"]] = document
+        _report_charge(kwargs, _RU_WRITE)
+        return copy.deepcopy(document)
+
+    async def read_item(self, item: str, partition_key: Any, **kwargs) -> Dict:
+        await self._round_trip()
+        document = self._partitions.get(partition_key, {}).get(item)
+        if document is None:
+            raise exceptions.CosmosResourceNotFoundError(status_code=404, message="Entity with the specified id does not exist")
+        _report_charge(kwargs, _RU_READ)
+        return copy.deepcopy(document)
+
+    async def delete_item(self, item: Any, partition_key: Any, **kwargs) -> None:
+        await self._round_trip()
+        item_id = item["id"] if isinstance(item, dict) else item
+        partition = self._partitions.get(partition_key, {})
+        if item_id not in partition:
+            raise exceptions.CosmosResourceNotFoundError(status_code=404, message="Entity with the specified id does not exist")
+        del partition[item_id]
+        _report_charge(kwargs, _RU_WRITE)
+
+    def query_items(
+        self,
+        query: str,
+        parameters: Optional[List[Dict]] = None,
+        partition_key: Any = None,
+        max_item_count: Optional[int] = None,
+        **kwargs
+    ) -> _LocalItemPaged:
+        parsed = _ParsedQuery(query, parameters)
+        if partition_key is not None:
+            documents = list(self._partitions.get(partition_key, {}).values())
+            partitions_touched = 1
+        else:
+            # クロスパーティションクエリはすべてのパーティションに展開される
+            documents = [doc for partition in self._partitions.values() for doc in partition.values()]
+            partitions_touched = max(1, len(self._partitions))
+        _report_charge(
+            kwargs,
+            _RU_PER_PARTITION * partitions_touched + _RU_PER_DOCUMENT_SCANNED * len(documents)
+        )
+        return _LocalItemPaged(parsed.apply(documents), max_item_count or 100)
+
+    async def execute_item_batch(self, batch_operations: List[Tuple], partition_key: Any, **kwargs) -> List[Dict]:
+        """同一パーティション内の操作をまとめて実行（1件でも失敗した場合は全体を取り消す）"""
+        await self._round_trip()
+        partition = self._partitions.setdefault(partition_key, {})
+        staged = dict(partition)
+        results = []
+        for operation in batch_operations:
+            name, args = operation[0], operation[1]
+            if name == "delete":
+                item_id = args[0]["id"] if isinstance(args[0], dict) else args[0]
+                if item_id not in staged:
+                    raise exceptions.CosmosBatchOperationError(
+                        error_index=len(results), headers={}, status_code=404,
+                        message="Entity with the specified id does not exist",
+                        operation_responses=results
+                    )
+                del staged[item_id]
+                results.append({"statusCode": 204})
+            elif name in ("create", "upsert"):
+                document = copy.deepcopy(args[0])
+                if name == "create" and document["id"] in staged:
+                    raise exceptions.CosmosBatchOperationError(
+                        error_index=len(results), headers={}, status_code=409,
+                        message="Entity with the specified id already exists",
+                        operation_responses=results
+                    )
+                staged[document["id"]] = document
+                results.append({"statusCode": 201, "resourceBody": copy.deepcopy(document)})
+            else:
+                raise exceptions.CosmosHttpResponseError(status_code=400, message=f"Unsupported batch operation: {name}")
+        self._partitions[partition_key] = staged
+        _report_charge(kwargs, _RU_WRITE * len(batch_operations))
+        return results
+
+    def item_count(self) -> int:
+        return sum(len(partition) for partition in self._partitions.values())
@@ -0,0 +1,304 @@
+"""
+Prometheus形式のメトリクス（カウンター・ヒストグラム）
+
+外部ライブラリを使わない最小限の実装。ラベルの組み合わせごとの値を辞書で保持し、
+/metrics へのアクセス時にテキスト形式へ変換する。VerifyToken はスレッドプールで
+実行されるため、値の更新はメトリクスごとのロックで保護する。
+"""
+
+import functools
+import inspect
+import math
+import threading
+import time
+from bisect import bisect_left
+from contextlib import aclosing, contextmanager
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+# 秒単位のレイテンシ用バケット（LLM呼び出しの数十秒まで）
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# (ラベル, 値) の組
+Sample = Tuple[Dict[str, str], float]
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels.items()) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    type = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def _labels(self, key: Tuple[str, ...]) -> Dict[str, str]:
+        return dict(zip(self.labelnames, key))
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        lines.extend(self._render_samples())
+        return lines
+
+    def _render_samples(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    """単調増加するカウンター"""
+
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+    def _render_samples(self) -> List[str]:
+        with self._lock:
+            values = list(self._values.items())
+        return [f"{self.name}{_format_labels(self._labels(key))} {_format_value(value)}" for key, value in values]
+
+
+class Histogram(_Metric):
+    """値の分布（累積バケット・合計・件数）"""
+
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # ラベル -> [バケットごとの件数..., 合計, 件数]
+        self._values: Dict[Tuple[str, ...], List[float]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            entry[index] += 1
+            entry[-2] += value
+            entry[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """with ブロックの経過時間を記録"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _render_samples(self) -> List[str]:
+        with self._lock:
+            values = [(key, list(entry)) for key, entry in self._values.items()]
+        lines = []
+        for key, entry in values:
+            labels = self._labels(key)
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), entry):
+                cumulative += count
+                lines.append(
+                    f"{self.name}_bucket{_format_labels({**labels, 'le': _format_value(bound)})} {cumulative}"
+                )
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {_format_value(entry[-2])}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {entry[-1]}")
+        return lines
+
+
+class MetricsRegistry:
+    """メトリクスと、出力時に値を収集する関数（既存のstats()など）を保持する"""
+
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+        self._collectors: List[Callable[[], Iterable[Tuple[str, str, str, List[Sample]]]]] = []
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        metric = Counter(name, documentation, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS
+    ) -> Histogram:
+        metric = Histogram(name, documentation, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def register_collector(self, collector: Callable[[], Iterable[Tuple[str, str, str, List[Sample]]]]):
+        """(名前, 型, 説明, サンプル) を返す関数を登録"""
+        self._collectors.append(collector)
+
+    def render(self) -> str:
+        """Prometheusのテキスト形式に変換"""
+        lines: List[str] = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for collector in self._collectors:
+            for name, metric_type, documentation, samples in collector():
+                lines.append(f"# HELP {name} {documentation}")
+                lines.append(f"# TYPE {name} {metric_type}")
+                for labels, value in samples:
+                    if value is None:
+                        continue
+                    lines.append(f"{name}{_format_labels(labels)} {_format_value(float(value))}")
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+SERVICE_CALL_DURATION = registry.histogram(
+    "service_call_duration_seconds",
+    "Duration of service method calls",
+    ("service", "method", "outcome")
+)
+CHAT_STAGE_DURATION = registry.histogram(
+    "chat_stage_duration_seconds",
+    "Duration of each stage of a chat request",
+    ("route", "stage")
+)
+HTTP_REQUEST_DURATION = registry.histogram(
+    "http_request_duration_seconds",
+    "Duration of HTTP requests until the response body is complete",
+    ("method", "route", "status")
+)
+LLM_TOKENS = registry.counter(
+    "llm_tokens_total",
+    "Tokens used by Azure OpenAI completions",
+    ("deployment", "type")
+)
+COSMOS_REQUEST_CHARGE = registry.counter(
+    "cosmosdb_request_charge_total",
+    "Request units consumed by CosmosDB operations",
+    ("operation",)
+)
+
+
+def timed(service: str, method: Optional[str] = None):
+    """サービスメソッドの所要時間と成否を記録するデコレーター（同期・非同期・非同期ジェネレーターに対応）"""
+
+    def decorator(func):
+        name = method or func.__name__
+
+        if inspect.isasyncgenfunction(func):
+            @functools.wraps(func)
+            async def async_gen_wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                outcome = "error"
+                try:
+                    # ラッパーが閉じられたら内側のジェネレーターもすぐに閉じる（上流のストリームを解放する）
+                    async with aclosing(func(*args, **kwargs)) as gen:
+                        async for item in gen:
+                            yield item
+                    outcome = "success"
+                except GeneratorExit:
+                    outcome = "cancelled"
+                    raise
+                finally:
+                    SERVICE_CALL_DURATION.observe(
+                        time.perf_counter() - start, service=service, method=name, outcome=outcome
+                    )
+            return async_gen_wrapper
+
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                outcome = "error"
+                try:
+                    result = await func(*args, **kwargs)
+                    outcome = "success"
+                    return result
+                finally:
+                    SERVICE_CALL_DURATION.observe(
+                        time.perf_counter() - start, service=service, method=name, outcome=outcome
+                    )
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            outcome = "error"
+            try:
+                result = func(*args, **kwargs)
+                outcome = "success"
+                return result
+            finally:
+                SERVICE_CALL_DURATION.observe(
+                    time.perf_counter() - start, service=service, method=name, outcome=outcome
+                )
+        return wrapper
+
+    return decorator
+
+
+class MetricsMiddleware:
+    """HTTPリクエストの所要時間をルートのパス（テンプレート）ごとに記録するASGIミドルウェア"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            # ユーザーのメールアドレス等を含む実際のパスではなく、ルートの定義を使う
+            route = scope.get("route")
+            HTTP_REQUEST_DURATION.observe(
+                time.perf_counter() - start,
+                method=scope["method"],
+                route=getattr(route, "path", "unmatched"),
+                status=str(status)
+            )
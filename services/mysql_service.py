@@ -1,198 +1,445 @@
+import asyncio
 import logging
-import mysql.connector
-from mysql.connector import Error
-from typing import Optional
+import time
+import aiomysql
+from aiomysql import Error
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional, Tuple
 from datetime import datetime
 import uuid
 from config.settings import settings
+from services.cache import TTLCache, create_invalidation_backend
+from services.pagination import keyset_cursor, decode_keyset_cursor
+from services.search import FULLTEXT_INDEX_NAME, FULLTEXT_INDEX_EXISTS_QUERY, build_search_query
+from services.metrics import timed
+from services.readiness import readiness, BackendUnavailableError
 from models.chat_models import ChatSession, ConversationRecord
 
 logger = logging.getLogger(__name__)
 
+SESSION_INVALIDATION_CHANNEL = "chat_sessions"
+
+# FULLTEXTインデックスがない場合に再確認するまでの秒数（起動後に setup_database.py で追加された場合に備える）
+FULLTEXT_INDEX_RECHECK_INTERVAL = 60.0
+
+# 起動時に存在を確認するテーブル
+REQUIRED_TABLES = ("chat_sessions", "chat_messages")
+REQUIRED_TABLES_QUERY = (
+    "SELECT COUNT(*) FROM information_schema.tables "
+    "WHERE table_schema = DATABASE() AND table_name IN (%s, %s)"
+)
+
 class MySQLService:
     def __init__(self):
-        self.connection = None
-        self.connect()
-        self.create_tables()
+        self.pool: Optional[aiomysql.Pool] = None
+        self._pool_lock: Optional[asyncio.Lock] = None
+        self.state = readiness.register("mysql")
+
+        # ユーザー -> 最新セッションIDのキャッシュ
+        self.session_cache = TTLCache(
+            max_entries=settings.SESSION_CACHE_MAX_ENTRIES if settings.SESSION_CACHE_ENABLED else 0,
+            ttl=settings.SESSION_CACHE_TTL
+        )
+        self.invalidation_backend = create_invalidation_backend(settings.SESSION_CACHE_INVALIDATION_BACKEND)
+        self.invalidation_backend.subscribe(SESSION_INVALIDATION_CHANNEL, self.session_cache.delete)
+        self._fulltext_index: Optional[bool] = None
+        self._fulltext_checked_at = 0.0
+
+        # プール飽和状況のメトリクス
+        self._waiting = 0
+        self.acquire_count = 0
+        self.acquire_wait_seconds = 0.0
+        self.acquire_wait_max = 0.0
+        self.health_check_count = 0
+        self.health_check_failures = 0
+
+    async def connect(self):
+        """MySQL コネクションプールを作成"""
+        if self.pool is not None:
+            return
 
-    def connect(self):
-        """MySQL データベースに接続"""
         try:
-            self.connection = mysql.connector.connect(
+            self.pool = await aiomysql.create_pool(
                 host=settings.MYSQL_HOST,
                 port=settings.MYSQL_PORT,
                 user=settings.MYSQL_USER,
                 password=settings.MYSQL_PASSWORD,
-                database=settings.MYSQL_DATABASE
+                db=settings.MYSQL_DATABASE,
+                minsize=settings.MYSQL_POOL_MIN_SIZE,
+                maxsize=settings.MYSQL_POOL_MAX_SIZE,
+                pool_recycle=settings.MYSQL_POOL_RECYCLE,
+                connect_timeout=settings.MYSQL_CONNECT_TIMEOUT,
+                charset="utf8mb4",
+                autocommit=False
+            )
+            logger.info(
+                f"MySQL connection pool created "
+                f"(min={settings.MYSQL_POOL_MIN_SIZE}, max={settings.MYSQL_POOL_MAX_SIZE})"
             )
-            logger.info("MySQL database connected successfully")
         except Error as e:
             logger.error(f"MySQL connection error: {e}")
             raise
 
-    def create_tables(self):
-        """必要なテーブルを作成"""
-        if not self.connection:
-            return
+    async def _get_pool(self) -> aiomysql.Pool:
+        """プールを取得（未作成の場合は作成、接続失敗直後は再接続せずに失敗させる）"""
+        if self.pool is None:
+            self.state.check_available()
+            if self._pool_lock is None:
+                self._pool_lock = asyncio.Lock()
+            async with self._pool_lock:
+                if self.pool is None:
+                    self.state.check_available()
+                    try:
+                        await self.connect()
+                    except Exception as e:
+                        raise self.state.unavailable(e) from e
+                    self.state.mark_ready()
+        return self.pool
+
+    async def warm_up(self):
+        """プールを作成し、テーブルが作成済みか確認（DDLは setup_database.py で実行する）"""
+        async with self.acquire() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute(REQUIRED_TABLES_QUERY, REQUIRED_TABLES)
+                (count,) = await cursor.fetchone()
+            await conn.commit()
+        if count < len(REQUIRED_TABLES):
+            raise RuntimeError("MySQL tables are missing; run `python setup_database.py`")
 
+    @asynccontextmanager
+    async def acquire(self):
+        """ヘルスチェック済みのコネクションをプールから取得"""
+        pool = await self._get_pool()
+
+        self._waiting += 1
+        start = time.perf_counter()
         try:
-            cursor = self.connection.cursor()
-            
-            # chat_sessions テーブル
-            create_sessions_table = """
-            CREATE TABLE IF NOT EXISTS chat_sessions (
-                id INT PRIMARY KEY AUTO_INCREMENT,
-                user_email VARCHAR(255) NOT NULL,
-                session_id VARCHAR(255) UNIQUE NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                INDEX idx_user_email (user_email),
-                INDEX idx_session_id (session_id)
-            )
-            """
-            cursor.execute(create_sessions_table)
-            
-            self.connection.commit()
-            cursor.close()
-            logger.info("MySQL tables created successfully")
-            
-        except Error as e:
-            logger.error(f"MySQL table creation error: {e}")
+            conn = await pool.acquire()
+        finally:
+            self._waiting -= 1
+        waited = time.perf_counter() - start
+        self.acquire_count += 1
+        self.acquire_wait_seconds += waited
+        self.acquire_wait_max = max(self.acquire_wait_max, waited)
 
-    def create_chat_session(self, user_email: str) -> str:
+        try:
+            # 一定時間使われていないコネクションは疎通確認し、切断されていれば再接続
+            idle = conn.loop.time() - conn.last_usage
+            if idle >= settings.MYSQL_POOL_PING_INTERVAL:
+                self.health_check_count += 1
+                try:
+                    await conn.ping(reconnect=True)
+                except Error:
+                    self.health_check_failures += 1
+                    conn.close()
+                    raise
+
+            try:
+                yield conn
+            except asyncio.CancelledError:
+                # タイムアウト等で通信途中に中断された接続は状態が不明なため再利用しない
+                conn.close()
+                raise
+            except BaseException:
+                # 途中のトランザクションを破棄してからプールに戻す
+                if not conn.closed:
+                    try:
+                        await conn.rollback()
+                    except Error:
+                        conn.close()
+                raise
+        finally:
+            pool.release(conn)
+
+    def pool_stats(self) -> Dict:
+        """コネクションプールの統計情報を取得"""
+        size = self.pool.size if self.pool else 0
+        free = self.pool.freesize if self.pool else 0
+        return {
+            "size": size,
+            "free": free,
+            "in_use": size - free,
+            "max_size": settings.MYSQL_POOL_MAX_SIZE,
+            "waiting": self._waiting,
+            "acquires": self.acquire_count,
+            "acquire_wait_avg": (self.acquire_wait_seconds / self.acquire_count) if self.acquire_count else 0.0,
+            "acquire_wait_max": self.acquire_wait_max,
+            "health_checks": self.health_check_count,
+            "health_check_failures": self.health_check_failures,
+        }
+
+    def session_cache_stats(self) -> Dict:
+        """セッションキャッシュの統計情報を取得"""
+        return self.session_cache.stats()
+
+    @timed("mysql")
+    async def create_chat_session(self, user_email: str) -> str:
         """新しいチャットセッションを作成"""
         session_id = str(uuid.uuid4())
-        
+
         try:
-            cursor = self.connection.cursor()
-            query = "INSERT INTO chat_sessions (user_email, session_id) VALUES (%s, %s)"
-            cursor.execute(query, (user_email, session_id))
-            self.connection.commit()
-            cursor.close()
-            
+            async with self.acquire() as conn:
+                async with conn.cursor() as cursor:
+                    query = "INSERT INTO chat_sessions (user_email, session_id) VALUES (%s, %s)"
+                    await cursor.execute(query, (user_email, session_id))
+                await conn.commit()
+
+            # 他ワーカーのキャッシュを無効化してから新しいセッションを登録
+            await self.invalidation_backend.publish(SESSION_INVALIDATION_CHANNEL, user_email)
+            self.session_cache.set(user_email, session_id)
+
             logger.info(f"Created chat session for user: {user_email}")
             return session_id
-            
+
         except Error as e:
             logger.error(f"Error creating chat session: {e}")
             return str(uuid.uuid4())  # フォールバック
 
-    def get_or_create_session(self, user_email: str) -> str:
+    @timed("mysql")
+    async def get_or_create_session(self, user_email: str) -> str:
         """既存のセッションを取得、または新しく作成"""
+        cached = self.session_cache.get(user_email)
+        if cached is not None:
+            return cached
+
         try:
-            cursor = self.connection.cursor()
-            
-            # 最新のセッションを取得
-            query = """
-            SELECT session_id FROM chat_sessions 
-            WHERE user_email = %s 
-            ORDER BY created_at DESC 
-            LIMIT 1
-            """
-            cursor.execute(query, (user_email,))
-            result = cursor.fetchone()
-            cursor.close()
-            
+            async with self.acquire() as conn:
+                async with conn.cursor() as cursor:
+                    # 最新のセッションを取得
+                    query = """
+                    SELECT session_id FROM chat_sessions
+                    WHERE user_email = %s
+                    ORDER BY created_at DESC
+                    LIMIT 1
+                    """
+                    await cursor.execute(query, (user_email,))
+                    result = await cursor.fetchone()
+                # 読み取りのみのためスナップショットを解放
+                await conn.commit()
+
             if result:
+                self.session_cache.set(user_email, result[0])
                 return result[0]
             else:
-                return self.create_chat_session(user_email)
-                
+                return await self.create_chat_session(user_email)
+
+        except BackendUnavailableError as e:
+            # MySQLに接続できない間も応答は返せるよう、一時的なセッションIDを使う
+            logger.warning(f"Using a temporary session id: {e}")
+            return str(uuid.uuid4())
         except Error as e:
             logger.error(f"Error getting/creating session: {e}")
-            return self.create_chat_session(user_email)
+            return await self.create_chat_session(user_email)
 
-    def get_user_sessions(self, user_email: str, limit: int = 10):
-        """ユーザーのセッション履歴を取得"""
+    async def _fetch_keyset_page(
+        self,
+        table: str,
+        columns: str,
+        user_email: str,
+        limit: int,
+        cursor: Optional[str]
+    ) -> Tuple[List[Dict], Optional[str]]:
+        """(created_at, id) のキーセットで1ページ分を取得"""
+        position = decode_keyset_cursor(cursor)
+        limit = max(1, min(limit, settings.HISTORY_MAX_PAGE_SIZE))
+
+        query = f"SELECT {columns} FROM {table} WHERE user_email = %s"
+        params: list = [user_email]
+        if position:
+            # OFFSETを使わず前ページ末尾の位置から読み進める
+            query += " AND (created_at < %s OR (created_at = %s AND id < %s))"
+            params.extend((position[0], position[0], position[1]))
+        query += " ORDER BY created_at DESC, id DESC LIMIT %s"
+        # 次ページの有無を判定するため1件多く取得
+        params.append(limit + 1)
+
+        async with self.acquire() as conn:
+            async with conn.cursor(aiomysql.DictCursor) as cur:
+                await cur.execute(query, params)
+                rows = await cur.fetchall()
+            await conn.commit()
+
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = keyset_cursor(rows[-1]["created_at"], rows[-1]["id"])
+        return list(rows), next_cursor
+
+    @timed("mysql")
+    async def get_user_sessions(
+        self,
+        user_email: str,
+        limit: int = 10,
+        cursor: Optional[str] = None
+    ) -> Tuple[List[Dict], Optional[str]]:
+        """ユーザーのセッション履歴を取得（次ページのカーソルを併せて返す）"""
         try:
-            cursor = self.connection.cursor(dictionary=True)
-            query = """
-            SELECT * FROM chat_sessions 
-            WHERE user_email = %s 
-            ORDER BY created_at DESC 
-            LIMIT %s
-            """
-            cursor.execute(query, (user_email, limit))
-            sessions = cursor.fetchall()
-            cursor.close()
-            return sessions
-            
+            return await self._fetch_keyset_page(
+                "chat_sessions", "id, session_id, user_email, created_at", user_email, limit, cursor
+            )
+
         except Error as e:
             logger.error(f"Error getting user sessions: {e}")
-            return []
+            return [], None
 
-    def save_conversation(self, conversation: ConversationRecord) -> bool:
+    async def save_conversation(self, conversation: ConversationRecord) -> bool:
         """会話記録をMySQLに保存"""
+        return await self.save_conversations([conversation])
+
+    @timed("mysql")
+    async def save_conversations(self, conversations: List[ConversationRecord]) -> bool:
+        """複数の会話記録を1トランザクションでまとめてMySQLに保存"""
+        if not conversations:
+            return True
+
+        # ユーザーごとの統計差分をメモリ上でまとめる: user_email -> [件数, 最初, 最後]
+        stats: Dict[str, list] = {}
+        for conversation in conversations:
+            entry = stats.get(conversation.user_email)
+            if entry is None:
+                stats[conversation.user_email] = [1, conversation.timestamp, conversation.timestamp]
+            else:
+                entry[0] += 1
+                entry[1] = min(entry[1], conversation.timestamp)
+                entry[2] = max(entry[2], conversation.timestamp)
+
         try:
-            cursor = self.connection.cursor()
-            query = """
-            INSERT INTO chat_messages (session_id, user_email, message, response, created_at) 
-            VALUES (%s, %s, %s, %s, %s)
-            """
-            cursor.execute(query, (
-                conversation.session_id,
-                conversation.user_email,
-                conversation.message,
-                conversation.response,
-                conversation.timestamp
-            ))
-            self.connection.commit()
-            cursor.close()
-            
-            # 統計情報を更新
-            self.update_user_stats(conversation.user_email)
-            
-            logger.info(f"Conversation saved for user: {conversation.user_email}")
+            async with self.acquire() as conn:
+                async with conn.cursor() as cursor:
+                    # 複数行INSERT（パケットサイズを超えないよう分割）
+                    chunk_size = settings.MYSQL_BATCH_INSERT_SIZE
+                    for i in range(0, len(conversations), chunk_size):
+                        chunk = conversations[i:i + chunk_size]
+                        query = (
+                            "INSERT INTO chat_messages (session_id, user_email, message, response, created_at) VALUES "
+                            + ", ".join(["(%s, %s, %s, %s, %s)"] * len(chunk))
+                        )
+                        params = []
+                        for conversation in chunk:
+                            params.extend((
+                                conversation.session_id,
+                                conversation.user_email,
+                                conversation.message,
+                                conversation.response,
+                                conversation.timestamp
+                            ))
+                        await cursor.execute(query, params)
+
+                    # 統計情報を更新または挿入（ユーザーごとに1行、デッドロック回避のため順序を固定）
+                    users = sorted(stats)
+                    query = (
+                        "INSERT INTO user_stats (user_email, total_messages, first_chat_at, last_chat_at) VALUES "
+                        + ", ".join(["(%s, %s, %s, %s)"] * len(users))
+                        + """
+                        ON DUPLICATE KEY UPDATE
+                            total_messages = total_messages + VALUES(total_messages),
+                            last_chat_at = GREATEST(COALESCE(last_chat_at, VALUES(last_chat_at)), VALUES(last_chat_at)),
+                            first_chat_at = COALESCE(first_chat_at, VALUES(first_chat_at))
+                        """
+                    )
+                    params = []
+                    for user_email in users:
+                        count, first_chat_at, last_chat_at = stats[user_email]
+                        params.extend((user_email, count, first_chat_at, last_chat_at))
+                    await cursor.execute(query, params)
+
+                await conn.commit()
+
+            logger.info(f"Saved {len(conversations)} conversations for {len(stats)} users")
             return True
-            
+
         except Error as e:
-            logger.error(f"Error saving conversation: {e}")
+            logger.error(f"Error saving conversations: {e}")
             return False
 
-    def get_conversation_history(self, user_email: str, limit: int = 20):
-        """ユーザーの会話履歴を取得"""
+    @timed("mysql")
+    async def get_conversation_history(
+        self,
+        user_email: str,
+        limit: int = 20,
+        cursor: Optional[str] = None
+    ) -> Tuple[List[Dict], Optional[str]]:
+        """ユーザーの会話履歴を取得（次ページのカーソルを併せて返す）"""
         try:
-            cursor = self.connection.cursor(dictionary=True)
-            query = """
-            SELECT * FROM chat_messages 
-            WHERE user_email = %s 
-            ORDER BY created_at DESC 
-            LIMIT %s
-            """
-            cursor.execute(query, (user_email, limit))
-            messages = cursor.fetchall()
-            cursor.close()
-            return messages
-            
+            return await self._fetch_keyset_page(
+                "chat_messages",
+                "id, session_id, user_email, message, response, created_at",
+                user_email, limit, cursor
+            )
+
         except Error as e:
             logger.error(f"Error getting conversation history: {e}")
-            return []
+            return [], None
+
+    @timed("mysql")
+    async def search_conversations(
+        self,
+        search_term: str,
+        limit: int = 20,
+        page: int = 1,
+        user_email: Optional[str] = None
+    ) -> Tuple[List[Dict], str]:
+        """会話を全文検索（FULLTEXTインデックスがあれば関連度順）し、検索方式を併せて返す"""
+        limit = max(1, min(limit, settings.HISTORY_MAX_PAGE_SIZE))
+        try:
+            async with self.acquire() as conn:
+                async with conn.cursor() as cur:
+                    # インデックスがあることは一度確認すれば十分だが、ない場合は一定時間ごとに確認し直す
+                    if self._fulltext_index is None or (
+                        not self._fulltext_index
+                        and time.monotonic() - self._fulltext_checked_at >= FULLTEXT_INDEX_RECHECK_INTERVAL
+                    ):
+                        await cur.execute(FULLTEXT_INDEX_EXISTS_QUERY, (FULLTEXT_INDEX_NAME,))
+                        self._fulltext_index = (await cur.fetchone())[0] > 0
+                        self._fulltext_checked_at = time.monotonic()
+                query, params, mode = build_search_query(
+                    search_term, self._fulltext_index, limit, page, user_email
+                )
+                async with conn.cursor(aiomysql.DictCursor) as cur:
+                    await cur.execute(query, params)
+                    messages = await cur.fetchall()
+                await conn.commit()
+            return list(messages), mode
+
+        except Error as e:
+            # 検索方式が不明な空の結果を返さず、呼び出し元で5xxにする
+            logger.error(f"Error searching conversations: {e}")
+            raise
 
-    def update_user_stats(self, user_email: str):
+    @timed("mysql")
+    async def update_user_stats(self, user_email: str):
         """ユーザー統計情報を更新"""
         try:
-            cursor = self.connection.cursor()
-            
-            # 統計情報を更新または挿入
-            query = """
-            INSERT INTO user_stats (user_email, total_messages, first_chat_at, last_chat_at)
-            VALUES (%s, 1, NOW(), NOW())
-            ON DUPLICATE KEY UPDATE
-                total_messages = total_messages + 1,
-                last_chat_at = NOW(),
-                first_chat_at = COALESCE(first_chat_at, NOW())
-            """
-            cursor.execute(query, (user_email,))
-            self.connection.commit()
-            cursor.close()
-            
+            async with self.acquire() as conn:
+                async with conn.cursor() as cursor:
+                    # 統計情報を更新または挿入
+                    query = """
+                    INSERT INTO user_stats (user_email, total_messages, first_chat_at, last_chat_at)
+                    VALUES (%s, 1, NOW(), NOW())
+                    ON DUPLICATE KEY UPDATE
+                        total_messages = total_messages + 1,
+                        last_chat_at = NOW(),
+                        first_chat_at = COALESCE(first_chat_at, NOW())
+                    """
+                    await cursor.execute(query, (user_email,))
+                await conn.commit()
+
         except Error as e:
             logger.error(f"Error updating user stats: {e}")
 
-    def close(self):
-        """データベース接続を閉じる"""
-        if self.connection and self.connection.is_connected():
-            self.connection.close()
-            logger.info("MySQL connection closed")
+    def after_fork(self):
+        """fork後の子プロセスで呼ばれる（親プロセスのプールは閉じずに手放し、必要になった時点で作り直す）"""
+        self.pool = None
+        self._pool_lock = None
+        self.session_cache.clear()
+
+    async def close(self):
+        """コネクションプールを閉じる"""
+        if self.pool:
+            self.pool.close()
+            await self.pool.wait_closed()
+            self.pool = None
+            logger.info("MySQL connection pool closed")
 
 # シングルトンインスタンス
-mysql_service = MySQLService()
\ No newline at end of file
+mysql_service = MySQLService()
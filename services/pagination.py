@@ -0,0 +1,44 @@
+import base64
+import json
+from datetime import datetime
+from typing import Dict, Optional
+
+
+class InvalidCursorError(ValueError):
+    """クライアントから渡されたカーソルを復元できない（ルートでは400に変換する）"""
+
+
+def encode_cursor(position: Dict) -> str:
+    """ページ位置を不透明なカーソル文字列に変換"""
+    payload = json.dumps(position, separators=(",", ":"), default=str)
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: Optional[str]) -> Optional[Dict]:
+    """カーソル文字列をページ位置に変換（不正な場合はInvalidCursorError）"""
+    if not cursor:
+        return None
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        position = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except (ValueError, UnicodeDecodeError) as e:
+        raise InvalidCursorError(f"Invalid cursor: {e}")
+    if not isinstance(position, dict):
+        raise InvalidCursorError("Invalid cursor")
+    return position
+
+
+def keyset_cursor(created_at: datetime, row_id: int) -> str:
+    """(created_at, id) のキーセットカーソルを作成"""
+    return encode_cursor({"created_at": created_at.isoformat(), "id": row_id})
+
+
+def decode_keyset_cursor(cursor: Optional[str]):
+    """(created_at, id) のキーセットカーソルを復元"""
+    position = decode_cursor(cursor)
+    if position is None:
+        return None
+    try:
+        return datetime.fromisoformat(position["created_at"]), int(position["id"])
+    except (KeyError, TypeError, ValueError) as e:
+        raise InvalidCursorError(f"Invalid cursor: {e}")
@@ -0,0 +1,632 @@
+import asyncio
+import glob
+import json
+import logging
+import os
+import time
+import uuid
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+from azure.cosmos import exceptions
+from config.settings import settings
+from models.chat_models import ConversationRecord
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+BackendWriter = Callable[[List[ConversationRecord]], Awaitable[None]]
+
+
+class PersistenceQueueFullError(Exception):
+    """write-behindキューが満杯で待機時間内に投入できなかった"""
+
+
+async def _write_split(
+    writer: BackendWriter,
+    records: List[ConversationRecord]
+) -> List[Tuple[ConversationRecord, str]]:
+    """records を半分ずつに分けて書き込み、単独でも書き込めなかった記録とエラーを返す
+
+    書き込めない記録（長すぎる値・サイズ超過など）が1件あっても、同じバッチの
+    他の記録は書き込めるようにする。
+    """
+    try:
+        await writer(records)
+        return []
+    except Exception as e:
+        if len(records) == 1:
+            return [(records[0], str(e))]
+    middle = len(records) // 2
+    return await _write_split(writer, records[:middle]) + await _write_split(writer, records[middle:])
+
+
+def _try_lock(path: str):
+    """ロックファイルを排他ロックして返す（他のプロセスが保持している場合はNone）
+
+    複数ワーカーで動かす場合に、同じファイルを複数のプロセスが書き換えないようにする。
+    fcntlのない環境ではロックせずに返す（単一プロセスでの利用を前提とする）。
+    """
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    lock_file = open(path, "a")
+    if fcntl is None:
+        return lock_file
+    try:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return None
+    return lock_file
+
+
+class WriteBehindQueue:
+    """会話記録をレスポンス返却後にバックエンドへまとめて書き込むキュー
+
+    投入された記録はまずスピルファイル（JSONL）に追記され、各バックエンドへの
+    書き込みが完了した時点でackが記録される。プロセスが異常終了した場合でも、
+    次回起動時に未完了の記録が再投入される。
+
+    複数ワーカーで動かす場合は、各プロセスがロックを取れた番号のスピルファイル
+    （write_behind_spill.jsonl, write_behind_spill.1.jsonl, ...）を使い、
+    ロックされていない他の番号のファイルに残った記録も引き継ぐ。
+
+    再試行しても書き込めないバッチは分割して書き込み、それでも書き込めない記録は
+    dead_letter（ReconciliationLog）に移して、後続の記録の書き込みを止めない。
+    """
+
+    def __init__(
+        self,
+        backends: Dict[str, BackendWriter],
+        max_queue_size: int = 10000,
+        batch_size: int = 100,
+        flush_interval: float = 0.5,
+        enqueue_timeout: float = 5.0,
+        max_retries: int = 3,
+        max_backoff: float = 30.0,
+        spill_path: Optional[str] = None,
+        fsync: bool = False,
+        compact_threshold: int = 10000,
+        dead_letter: Optional["ReconciliationLog"] = None
+    ):
+        self.backends = backends
+        self.max_queue_size = max_queue_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.enqueue_timeout = enqueue_timeout
+        self.max_retries = max_retries
+        self.max_backoff = max_backoff
+        self.spill_path = spill_path
+        self._base_spill_path = spill_path
+        self.fsync = fsync
+        self.compact_threshold = compact_threshold
+        self.dead_letter = dead_letter
+
+        self._queues: Dict[str, asyncio.Queue] = {}
+        # キューに空きができたことを投入待ちの呼び出しに知らせる
+        self._space: Optional[asyncio.Condition] = None
+        self._flushers: List[asyncio.Task] = []
+        # seq -> (記録, 未完了のバックエンド)
+        self._pending: Dict[int, Tuple[ConversationRecord, Set[str]]] = {}
+        # バックエンドごとの未完了記録の投入時刻（投入順）
+        self._pending_since: Dict[str, Dict[int, float]] = {name: {} for name in backends}
+        self._seq = 0
+        self._acks_since_compaction = 0
+        self._spill_file = None
+        self._spill_lock = None
+        self._started = False
+
+        self.enqueued = 0
+        self.rejected = 0
+        self.flushed: Dict[str, int] = {name: 0 for name in backends}
+        self.failed: Dict[str, int] = {name: 0 for name in backends}
+        self.dead_lettered: Dict[str, int] = {name: 0 for name in backends}
+        self.batches: Dict[str, int] = {name: 0 for name in backends}
+        self.last_flush_lag: Dict[str, float] = {name: 0.0 for name in backends}
+
+    # --- スピルファイル ---
+
+    def _open_spill_file(self):
+        directory = os.path.dirname(self.spill_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._spill_file = open(self.spill_path, "a", encoding="utf-8")
+
+    def _write_spill(self, entry: Dict):
+        if not self._spill_file:
+            return
+        self._spill_file.write(json.dumps(entry, ensure_ascii=False, default=str) + "\n")
+        self._spill_file.flush()
+        if self.fsync:
+            os.fsync(self._spill_file.fileno())
+
+    def _slot_path(self, slot: int) -> str:
+        if slot == 0:
+            return self._base_spill_path
+        root, ext = os.path.splitext(self._base_spill_path)
+        return f"{root}.{slot}{ext}"
+
+    def _claim_spill_files(self) -> List[Tuple[str, object]]:
+        """自プロセスのスピルファイルを決め、引き継ぐ他の番号のファイルをロックして返す"""
+        slot = 0
+        while True:
+            lock = _try_lock(self._slot_path(slot) + ".lock")
+            if lock is not None:
+                break
+            slot += 1
+        self.spill_path = self._slot_path(slot)
+        self._spill_lock = lock
+
+        # 終了したワーカーやワーカー数を減らした後に残ったファイルを引き継ぐ
+        adopted = []
+        root, ext = os.path.splitext(self._base_spill_path)
+        paths = [self._base_spill_path] + [
+            path for path in sorted(glob.glob(f"{glob.escape(root)}.*{ext}"))
+            if path[len(root) + 1:len(path) - len(ext)].isdigit()
+        ]
+        for path in paths:
+            if path == self.spill_path or not os.path.exists(path):
+                continue
+            lock = _try_lock(path + ".lock")
+            if lock is not None:
+                adopted.append((path, lock))
+        return adopted
+
+    def _load_spill(self, path: Optional[str] = None) -> List[Tuple[ConversationRecord, Set[str]]]:
+        """スピルファイルから未完了の記録を読み込む"""
+        path = path or self.spill_path
+        if not path or not os.path.exists(path):
+            return []
+
+        puts: Dict[int, Tuple[Dict, Set[str]]] = {}
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # 書き込み途中で終了した最終行は無視する
+                    continue
+                if entry["op"] == "put":
+                    puts[entry["seq"]] = (entry["record"], set(entry["backends"]))
+                elif entry["op"] == "ack" and entry["seq"] in puts:
+                    puts[entry["seq"]][1].discard(entry["backend"])
+
+        recovered = []
+        for record, remaining in puts.values():
+            remaining &= set(self.backends)
+            if remaining:
+                recovered.append((ConversationRecord(**record), remaining))
+        return recovered
+
+    def _compact_spill(self):
+        """未完了の記録のみでスピルファイルを書き直す"""
+        if not self.spill_path:
+            return
+        if self._spill_file:
+            self._spill_file.close()
+        tmp_path = self.spill_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for seq, (record, remaining) in self._pending.items():
+                f.write(json.dumps({
+                    "op": "put", "seq": seq, "backends": sorted(remaining), "record": record.dict()
+                }, ensure_ascii=False, default=str) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.spill_path)
+        self._acks_since_compaction = 0
+        self._open_spill_file()
+
+    # --- ライフサイクル ---
+
+    async def start(self):
+        """フラッシュ用タスクを起動し、前回未完了の記録を再投入"""
+        if self._started:
+            return
+
+        adopted = self._claim_spill_files() if self.spill_path else []
+        # 再投入分が溢れないようにキューの上限を拡張する
+        recovered = self._load_spill()
+        for path, _ in adopted:
+            recovered.extend(self._load_spill(path))
+        for name in self.backends:
+            self._queues[name] = asyncio.Queue(maxsize=max(self.max_queue_size, len(recovered)))
+        self._space = asyncio.Condition()
+
+        for record, remaining in recovered:
+            self._add(record, remaining, write_spill=False)
+        if recovered:
+            logger.info(f"Recovered {len(recovered)} conversation records from write-behind spill file")
+
+        if self.spill_path:
+            self._compact_spill()
+        # 引き継いだ記録は自プロセスのファイルに書き直したので元のファイルは削除する
+        for path, lock in adopted:
+            os.remove(path)
+            lock.close()
+        if adopted:
+            logger.info(f"Adopted write-behind spill files: {[path for path, _ in adopted]}")
+
+        for name, writer in self.backends.items():
+            self._flushers.append(asyncio.create_task(self._flush_loop(name, writer), name=f"write-behind-{name}"))
+        self._started = True
+        logger.info(f"Write-behind queue started (backends={list(self.backends)})")
+
+    async def stop(self, timeout: float = 30.0):
+        """キューに残っている記録を書き込んでから停止"""
+        if not self._started:
+            return
+
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(*(queue.join() for queue in self._queues.values())),
+                timeout=timeout
+            )
+        except asyncio.TimeoutError:
+            logger.warning(
+                f"Write-behind drain timed out; {len(self._pending)} records remain in the spill file"
+            )
+
+        for task in self._flushers:
+            task.cancel()
+        await asyncio.gather(*self._flushers, return_exceptions=True)
+        self._flushers.clear()
+
+        if self._spill_file:
+            self._compact_spill()
+            self._spill_file.close()
+            self._spill_file = None
+        if self._spill_lock:
+            self._spill_lock.close()
+            self._spill_lock = None
+        self._started = False
+        logger.info("Write-behind queue stopped")
+
+    # --- 投入 ---
+
+    def _add(self, record: ConversationRecord, backends: Set[str], write_spill: bool = True) -> int:
+        self._seq += 1
+        seq = self._seq
+        if write_spill:
+            self._write_spill({"op": "put", "seq": seq, "backends": sorted(backends), "record": record.dict()})
+        self._pending[seq] = (record, set(backends))
+        now = time.monotonic()
+        for name in backends:
+            self._pending_since[name][seq] = now
+            self._queues[name].put_nowait((seq, record, now))
+        return seq
+
+    async def enqueue(self, record: ConversationRecord):
+        """会話記録を投入（キューが満杯の場合は空きが出るまで待機）"""
+        if not self._started:
+            raise RuntimeError("Write-behind queue is not started")
+
+        # CosmosDBへの再投入を冪等にするため、投入時点でIDを確定する
+        if not record.id:
+            record.id = str(uuid.uuid4())
+
+        async with self._space:
+            try:
+                await asyncio.wait_for(
+                    self._space.wait_for(lambda: not any(queue.full() for queue in self._queues.values())),
+                    timeout=self.enqueue_timeout
+                )
+            except asyncio.TimeoutError:
+                self.rejected += 1
+                raise PersistenceQueueFullError("Write-behind queue is full")
+            self._add(record, set(self.backends))
+        self.enqueued += 1
+
+    # --- フラッシュ ---
+
+    async def _flush_loop(self, name: str, writer: BackendWriter):
+        queue = self._queues[name]
+        while True:
+            first = await queue.get()
+            batch = [first]
+            # 一定時間待って複数件をまとめる
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(queue.get(), timeout=remaining))
+                except asyncio.TimeoutError:
+                    break
+            async with self._space:
+                self._space.notify_all()
+
+            try:
+                await self._write_batch(name, writer, batch)
+            finally:
+                for _ in batch:
+                    queue.task_done()
+
+    async def _write_batch(self, name: str, writer: BackendWriter, batch: List[Tuple[int, ConversationRecord, float]]):
+        """max_retries 回まで再試行し、それでも失敗したバッチは分割して書き込む
+
+        単独でも書き込めなかった記録は dead_letter に移す（停止時に残った記録は
+        スピルファイルから次回再投入される）。
+        """
+        records = [record for _, record, _ in batch]
+        rejected: List[Tuple[ConversationRecord, str]] = []
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                await asyncio.sleep(min(2 ** (attempt - 1) * 0.5, self.max_backoff))
+            try:
+                await writer(records)
+                break
+            except Exception as e:
+                error = e
+        else:
+            self.failed[name] += len(batch)
+            logger.error(
+                f"Write-behind flush of {len(batch)} records to {name} failed after "
+                f"{self.max_retries + 1} attempts, splitting the batch: {error}"
+            )
+            if len(records) > 1:
+                middle = len(records) // 2
+                rejected = await _write_split(writer, records[:middle]) + await _write_split(writer, records[middle:])
+            else:
+                rejected = [(records[0], str(error))]
+            for record, reason in rejected:
+                self.dead_lettered[name] += 1
+                logger.error(f"Moving conversation {record.id} that cannot be written to {name} to the dead-letter log: {reason}")
+                if self.dead_letter:
+                    self.dead_letter.record(name, record, reason)
+
+        now = time.monotonic()
+        self.flushed[name] += len(batch) - len(rejected)
+        self.batches[name] += 1
+        self.last_flush_lag[name] = now - batch[0][2]
+        for seq, _, _ in batch:
+            self._ack(name, seq)
+
+    def _ack(self, name: str, seq: int):
+        self._pending_since[name].pop(seq, None)
+        self._write_spill({"op": "ack", "seq": seq, "backend": name})
+        entry = self._pending.get(seq)
+        if entry is None:
+            return
+        entry[1].discard(name)
+        if not entry[1]:
+            del self._pending[seq]
+
+        self._acks_since_compaction += 1
+        if self._spill_file and self._acks_since_compaction >= self.compact_threshold:
+            self._compact_spill()
+
+    # --- メトリクス ---
+
+    def stats(self) -> Dict:
+        """キューの深さと遅延を取得"""
+        now = time.monotonic()
+        backends = {}
+        for name in self.backends:
+            pending_since = self._pending_since[name]
+            oldest = next(iter(pending_since.values()), None)
+            backends[name] = {
+                "depth": self._queues[name].qsize() if name in self._queues else 0,
+                "lag_seconds": (now - oldest) if oldest is not None else 0.0,
+                "last_flush_lag_seconds": self.last_flush_lag[name],
+                "flushed": self.flushed[name],
+                "failed": self.failed[name],
+                "dead_lettered": self.dead_lettered[name],
+                "batches": self.batches[name],
+            }
+        return {
+            "enqueued": self.enqueued,
+            "rejected": self.rejected,
+            "pending": len(self._pending),
+            "max_queue_size": self.max_queue_size,
+            "backends": backends,
+        }
+
+
+async def _write_mysql(records: List[ConversationRecord]):
+    from services.mysql_service import mysql_service
+    # 1トランザクションの複数行INSERTでまとめて保存
+    if not await mysql_service.save_conversations(records):
+        raise RuntimeError(f"MySQL batch save failed for {len(records)} conversations")
+
+
+async def _write_cosmosdb(records: List[ConversationRecord]):
+    from services.cosmosdb_service import cosmosdb_service
+
+    async def _save(record: ConversationRecord):
+        try:
+            await cosmosdb_service.save_conversation(record)
+        except exceptions.CosmosResourceExistsError:
+            # 再投入された記録は既に保存済み
+            pass
+
+    await asyncio.gather(*(_save(record) for record in records))
+
+
+class ReconciliationLog:
+    """同期保存で一部のバックエンドへの書き込みに失敗した記録を保持し、後から再書き込みする"""
+
+    def __init__(self, path: Optional[str]):
+        self.path = path
+        self.recorded = 0
+        self.reconciled = 0
+        self.last_replay_failures = 0
+        # 未反映の件数（最初の参照時と再書き込みの後にファイルから数え、以降は追記のたびに加算する）
+        self._pending: Optional[int] = None
+
+    def record(self, backend: str, record: ConversationRecord, error: str):
+        """書き込みに失敗した記録を追記"""
+        self.recorded += 1
+        if not self.path:
+            logger.error(f"Conversation {record.id} was not saved to {backend} and no reconciliation log is configured")
+            return
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps({
+                "backend": backend, "error": error, "failed_at": time.time(), "record": record.dict()
+            }, ensure_ascii=False, default=str) + "\n")
+        if self._pending is not None:
+            self._pending += 1
+
+    async def replay(self, backends: Dict[str, BackendWriter]) -> Dict[str, int]:
+        """記録済みの失敗をバックエンドごとにまとめて再書き込みし、再び失敗したものは残す"""
+        if not self.path or not os.path.exists(self.path):
+            return {}
+        # 複数ワーカーで動かす場合は1つのプロセスのみが再書き込みする
+        lock = _try_lock(self.path + ".lock")
+        if lock is None:
+            return {}
+        try:
+            return await self._replay(backends)
+        finally:
+            lock.close()
+            self._pending = None
+
+    async def _replay(self, backends: Dict[str, BackendWriter]) -> Dict[str, int]:
+        if not os.path.exists(self.path) and not os.path.exists(self.path + ".replaying"):
+            return {}
+
+        # 再書き込み中に追記される記録と混ざらないよう、対象のファイルを退避してから処理する
+        replaying_path = self.path + ".replaying"
+        if not os.path.exists(replaying_path):
+            os.replace(self.path, replaying_path)
+
+        entries: Dict[str, List[Dict]] = {}
+        with open(replaying_path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                entries.setdefault(entry["backend"], []).append(entry)
+
+        remaining: List[Dict] = []
+        result: Dict[str, int] = {}
+        for backend, backend_entries in entries.items():
+            writer = backends.get(backend)
+            if writer is None:
+                remaining.extend(backend_entries)
+                continue
+            records = [ConversationRecord(**entry["record"]) for entry in backend_entries]
+            # 書き込めない記録があっても他の記録は反映されるよう、失敗したバッチは分割する
+            failed_ids = {id(record) for record, _ in await _write_split(writer, records)}
+            failed_entries = [entry for entry, record in zip(backend_entries, records) if id(record) in failed_ids]
+            if failed_entries:
+                logger.error(f"Reconciliation of {len(failed_entries)} records to {backend} failed")
+                remaining.extend(failed_entries)
+            written = len(backend_entries) - len(failed_entries)
+            if written:
+                result[backend] = written
+                self.reconciled += written
+
+        if remaining:
+            with open(self.path, "a", encoding="utf-8") as f:
+                for entry in remaining:
+                    f.write(json.dumps(entry, ensure_ascii=False, default=str) + "\n")
+        os.remove(replaying_path)
+        self.last_replay_failures = len(remaining)
+        if result:
+            logger.info(f"Reconciled conversation records: {result}")
+        return result
+
+    def pending(self) -> int:
+        """未反映の記録の件数（他のワーカーがファイルを数えた後に追記した分は含まない）"""
+        if self._pending is None:
+            count = 0
+            for path in (self.path, self.path + ".replaying") if self.path else ():
+                if os.path.exists(path):
+                    with open(path, encoding="utf-8") as f:
+                        count += sum(1 for _ in f)
+            self._pending = count
+        return self._pending
+
+    def stats(self) -> Dict:
+        return {
+            "recorded": self.recorded,
+            "reconciled": self.reconciled,
+            "pending": self.pending(),
+            "last_replay_failures": self.last_replay_failures,
+        }
+
+
+class ConcurrentWriter:
+    """会話記録を各バックエンドへ同時に書き込む（同期保存用）
+
+    バックエンドごとにタイムアウトを設け、失敗は他のバックエンドに影響させずに
+    ReconciliationLog に記録する。タイムアウトした書き込みは実際には完了している
+    場合があるため、再書き込みはバックエンド側で冪等であることを前提とする
+    （CosmosDBは同じIDの作成を無視し、MySQLは重複行が残る可能性がある）。
+    """
+
+    def __init__(
+        self,
+        backends: Dict[str, BackendWriter],
+        timeouts: Dict[str, float],
+        reconciliation_log: ReconciliationLog
+    ):
+        self.backends = backends
+        self.timeouts = timeouts
+        self.reconciliation_log = reconciliation_log
+        self.written: Dict[str, int] = {name: 0 for name in backends}
+        self.failed: Dict[str, int] = {name: 0 for name in backends}
+        self.timed_out: Dict[str, int] = {name: 0 for name in backends}
+
+    async def _write(self, name: str, writer: BackendWriter, record: ConversationRecord) -> bool:
+        try:
+            await asyncio.wait_for(writer([record]), timeout=self.timeouts.get(name))
+            self.written[name] += 1
+            return True
+        except asyncio.TimeoutError:
+            self.timed_out[name] += 1
+            error = f"timed out after {self.timeouts.get(name)}s"
+        except Exception as e:
+            error = str(e)
+        self.failed[name] += 1
+        logger.error(f"{name} save error: {error}")
+        self.reconciliation_log.record(name, record, error)
+        return False
+
+    async def write(self, record: ConversationRecord) -> Dict[str, bool]:
+        """すべてのバックエンドに同時に書き込み、バックエンドごとの成否を返す"""
+        # 再書き込み時に同じ記録として扱えるよう、書き込み前にIDを確定する
+        if not record.id:
+            record.id = str(uuid.uuid4())
+        results = await asyncio.gather(*(
+            self._write(name, writer, record) for name, writer in self.backends.items()
+        ))
+        return dict(zip(self.backends, results))
+
+    def stats(self) -> Dict:
+        return {
+            "written": self.written,
+            "failed": self.failed,
+            "timed_out": self.timed_out,
+            "reconciliation": self.reconciliation_log.stats(),
+        }
+
+
+# シングルトンインスタンス
+reconciliation_log = ReconciliationLog(settings.RECONCILIATION_LOG_PATH or None)
+
+write_behind_queue = WriteBehindQueue(
+    backends={"mysql": _write_mysql, "cosmosdb": _write_cosmosdb},
+    max_queue_size=settings.WRITE_BEHIND_MAX_QUEUE_SIZE,
+    batch_size=settings.WRITE_BEHIND_BATCH_SIZE,
+    flush_interval=settings.WRITE_BEHIND_FLUSH_INTERVAL,
+    enqueue_timeout=settings.WRITE_BEHIND_ENQUEUE_TIMEOUT,
+    max_retries=settings.WRITE_BEHIND_MAX_RETRIES,
+    spill_path=settings.WRITE_BEHIND_SPILL_PATH or None,
+    fsync=settings.WRITE_BEHIND_FSYNC,
+    dead_letter=reconciliation_log
+)
+
+concurrent_writer = ConcurrentWriter(
+    backends={"mysql": _write_mysql, "cosmosdb": _write_cosmosdb},
+    timeouts={"mysql": settings.PERSIST_MYSQL_TIMEOUT, "cosmosdb": settings.PERSIST_COSMOSDB_TIMEOUT},
+    reconciliation_log=reconciliation_log
+)
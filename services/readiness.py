@@ -0,0 +1,163 @@
+"""
+バックエンド（MySQL・CosmosDB・Auth0のJWKS）の接続状態
+
+起動時のウォームアップはリクエストの受付を止めずにバックグラウンドで並行して行い、
+結果を /ready で返す。接続に失敗したバックエンドは一定時間（BACKEND_RETRY_INTERVAL）
+再接続を試みずに BackendUnavailableError を送出し、各リクエストが接続タイムアウトまで
+待たされないようにする。
+"""
+
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Dict, Optional
+from config.settings import settings
+
+logger = logging.getLogger(__name__)
+
+
+class BackendUnavailableError(Exception):
+    """バックエンドに接続できない（ルートでは503に変換する）"""
+
+    def __init__(self, backend: str, retry_after: float, cause: Optional[BaseException] = None):
+        self.backend = backend
+        self.retry_after = retry_after
+        detail = f": {cause}" if cause else ""
+        super().__init__(f"{backend} is unavailable{detail}")
+
+
+class BackendState:
+    """1つのバックエンドの接続状態"""
+
+    def __init__(self, name: str, retry_interval: float, required: bool = True):
+        self.name = name
+        self.retry_interval = retry_interval
+        self.required = required
+        self.status = "pending"
+        self.error: Optional[str] = None
+        self.failed_at: Optional[float] = None
+        self.warmup_seconds: Optional[float] = None
+        self.failures = 0
+
+    def mark_ready(self):
+        if self.status != "ready":
+            logger.info(f"Backend '{self.name}' is ready")
+        self.status = "ready"
+        self.error = None
+        self.failed_at = None
+
+    def mark_failed(self, error: BaseException):
+        self.status = "failed"
+        self.error = str(error) or type(error).__name__
+        self.failed_at = time.monotonic()
+        self.failures += 1
+        logger.error(f"Backend '{self.name}' is unavailable: {self.error}")
+
+    def retry_after(self) -> float:
+        """再接続を試みるまでの残り秒数（0なら接続を試みてよい）"""
+        if self.status != "failed" or self.failed_at is None:
+            return 0.0
+        return max(0.0, self.retry_interval - (time.monotonic() - self.failed_at))
+
+    def check_available(self):
+        """直前の接続失敗から再試行間隔が経過していなければ即座に失敗させる"""
+        remaining = self.retry_after()
+        if remaining > 0:
+            raise BackendUnavailableError(self.name, remaining)
+
+    def unavailable(self, error: BaseException) -> BackendUnavailableError:
+        """接続失敗を記録し、呼び出し元に送出する例外を返す"""
+        self.mark_failed(error)
+        return BackendUnavailableError(self.name, self.retry_interval, error)
+
+    def snapshot(self) -> Dict:
+        return {
+            "status": self.status,
+            "required": self.required,
+            "error": self.error,
+            "retry_after": round(self.retry_after(), 3),
+            "warmup_seconds": self.warmup_seconds,
+            "failures": self.failures,
+        }
+
+
+class Readiness:
+    """全バックエンドの接続状態と起動時のウォームアップ"""
+
+    def __init__(self, retry_interval: float):
+        self.retry_interval = retry_interval
+        self.backends: Dict[str, BackendState] = {}
+        self.started_at = time.monotonic()
+        self.warmup_task: Optional[asyncio.Task] = None
+        self._warm_ups: Dict[str, Callable[[], Awaitable]] = {}
+        self._timeout = 0.0
+        self._rechecks: Dict[str, asyncio.Task] = {}
+
+    def register(self, name: str, required: bool = True) -> BackendState:
+        state = self.backends.get(name)
+        if state is None:
+            state = self.backends[name] = BackendState(name, self.retry_interval, required)
+        return state
+
+    async def _warm_up_one(self, state: BackendState, warm_up: Callable[[], Awaitable], timeout: float):
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(warm_up(), timeout)
+            state.mark_ready()
+        except asyncio.TimeoutError:
+            state.mark_failed(TimeoutError(f"warm-up timed out after {timeout}s"))
+        except BackendUnavailableError:
+            # 接続失敗はサービス側で記録済み
+            pass
+        except Exception as e:
+            state.mark_failed(e)
+        finally:
+            state.warmup_seconds = round(time.perf_counter() - start, 3)
+
+    async def warm_up(self, warm_ups: Dict[str, Callable[[], Awaitable]], timeout: float):
+        """各バックエンドへの接続を並行して確立（失敗しても例外は送出しない）"""
+        self._warm_ups = dict(warm_ups)
+        self._timeout = timeout
+        await asyncio.gather(*(
+            self._warm_up_one(self.register(name), warm_up, timeout)
+            for name, warm_up in warm_ups.items()
+        ))
+        logger.info(
+            "Backend warm-up finished: "
+            + ", ".join(f"{name}={state.status}" for name, state in self.backends.items())
+        )
+
+    def start_warm_up(self, warm_ups: Dict[str, Callable[[], Awaitable]], timeout: float) -> asyncio.Task:
+        """ウォームアップをバックグラウンドで開始（リクエストの受付は待たせない）"""
+        self.warmup_task = asyncio.create_task(self.warm_up(warm_ups, timeout))
+        return self.warmup_task
+
+    def recheck(self):
+        """失敗したバックエンドのうち再試行間隔が経過したものを、バックグラウンドで再度ウォームアップ"""
+        if self.warmup_task is None or not self.warmup_task.done():
+            return
+        for name, warm_up in self._warm_ups.items():
+            state = self.backends[name]
+            running = self._rechecks.get(name)
+            if state.status != "failed" or state.retry_after() > 0 or (running and not running.done()):
+                continue
+            self._rechecks[name] = asyncio.create_task(self._warm_up_one(state, warm_up, self._timeout))
+
+    async def stop(self):
+        tasks = [task for task in [self.warmup_task, *self._rechecks.values()] if task and not task.done()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def is_ready(self) -> bool:
+        return all(state.status == "ready" for state in self.backends.values() if state.required)
+
+    def snapshot(self) -> Dict:
+        return {
+            "ready": self.is_ready(),
+            "uptime_seconds": round(time.monotonic() - self.started_at, 3),
+            "backends": {name: state.snapshot() for name, state in self.backends.items()},
+        }
+
+
+readiness = Readiness(retry_interval=settings.BACKEND_RETRY_INTERVAL)
@@ -0,0 +1,266 @@
+"""
+Azure OpenAIの応答キャッシュ
+
+同じ質問（FAQなど）への応答を再利用する。キーは正規化したプロンプトと
+デプロイメント名・システムプロンプトから作るため、どちらかが変わると
+以前の応答は使われない。保存先はメモリ（LRU）とディスク（SQLite）を選べる。
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+import sqlite3
+import time
+import unicodedata
+from typing import Dict, Optional
+from services.cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+# 正規化の方法を変えた場合は値を上げて既存のキャッシュを無効にする
+KEY_VERSION = 1
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_prompt(prompt: str) -> str:
+    """プロンプトを正規化
+
+    NFKCで全角英数字・半角カナ・全角スペースなどの幅の違いを揃え、
+    連続する空白を1つにまとめて前後の空白を取り除く。
+    """
+    return _WHITESPACE.sub(" ", unicodedata.normalize("NFKC", prompt)).strip()
+
+
+def build_cache_key(prompt: str, deployment: str, system_prompt: str) -> str:
+    """キャッシュキーを作成"""
+    payload = json.dumps(
+        [KEY_VERSION, deployment, hashlib.sha256(system_prompt.encode("utf-8")).hexdigest(), normalize_prompt(prompt)],
+        ensure_ascii=False
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCacheBackend:
+    """応答キャッシュの保存先のインターフェース"""
+
+    async def get(self, key: str) -> Optional[str]:
+        raise NotImplementedError
+
+    async def set(self, key: str, value: str):
+        raise NotImplementedError
+
+    async def clear(self):
+        raise NotImplementedError
+
+    def stats(self) -> Dict:
+        return {}
+
+    def after_fork(self):
+        """fork後の子プロセスで呼ばれる（親プロセスの接続を使わないようにする）"""
+
+    async def close(self):
+        pass
+
+
+class MemoryResponseCacheBackend(ResponseCacheBackend):
+    """プロセス内のLRUキャッシュ"""
+
+    def __init__(self, max_entries: int, ttl: float):
+        self._cache = TTLCache(max_entries=max_entries, ttl=ttl)
+
+    async def get(self, key: str) -> Optional[str]:
+        return self._cache.get(key)
+
+    async def set(self, key: str, value: str):
+        self._cache.set(key, value)
+
+    async def clear(self):
+        self._cache.clear()
+
+    def stats(self) -> Dict:
+        stats = self._cache.stats()
+        return {"entries": stats["entries"], "max_entries": stats["max_entries"], "evictions": stats["evictions"]}
+
+
+class DiskResponseCacheBackend(ResponseCacheBackend):
+    """SQLiteファイルに保存するキャッシュ（再起動後も保持され、同一ホストのワーカー間で共有できる）"""
+
+    def __init__(self, path: str, max_entries: int, ttl: float):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.evictions = 0
+        # 書き込みのたびに件数を数えないよう、上限をこの件数だけ超えたらまとめて削除する
+        self._eviction_slack = max(1, max_entries // 10)
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._connection = self._connect()
+        # sqlite3の接続はスレッド間で同時に使えないため、操作を直列化する
+        self._lock = asyncio.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL, last_access REAL NOT NULL)"
+        )
+        connection.execute("CREATE INDEX IF NOT EXISTS idx_last_access ON responses (last_access)")
+        # 件数の見積もり（他のワーカーの書き込みは削除時に数え直して反映する）
+        self._entries = connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        return connection
+
+    def after_fork(self):
+        # SQLiteの接続はforkをまたいで使えないため、子プロセスで開き直す（親の接続は閉じない）
+        self._connection = self._connect()
+        self._lock = asyncio.Lock()
+
+    def _get(self, key: str) -> Optional[str]:
+        now = time.time()
+        row = self._connection.execute(
+            "SELECT value, expires_at FROM responses WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        if row[1] <= now:
+            self._connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self._entries = max(0, self._entries - 1)
+            return None
+        self._connection.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+        return row[0]
+
+    def _set(self, key: str, value: str):
+        now = time.time()
+        self._connection.execute(
+            "INSERT OR REPLACE INTO responses (key, value, expires_at, last_access) VALUES (?, ?, ?, ?)",
+            (key, value, now + self.ttl, now)
+        )
+        # 既存のキーの上書きでも1件と数える（多めの見積もりは削除時の数え直しで補正される）
+        self._entries += 1
+        if self._entries > self.max_entries + self._eviction_slack:
+            self._evict(now)
+
+    def _evict(self, now: float):
+        """期限切れを先に削除し、それでも上限を超える場合は最も使われていないものから削除"""
+        self._connection.execute("DELETE FROM responses WHERE expires_at <= ?", (now,))
+        cursor = self._connection.execute(
+            "DELETE FROM responses WHERE key IN "
+            "(SELECT key FROM responses ORDER BY last_access LIMIT MAX(0, (SELECT COUNT(*) FROM responses) - ?))",
+            (self.max_entries,)
+        )
+        self.evictions += cursor.rowcount
+        self._entries = self._connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    async def get(self, key: str) -> Optional[str]:
+        async with self._lock:
+            return await asyncio.to_thread(self._get, key)
+
+    async def set(self, key: str, value: str):
+        async with self._lock:
+            await asyncio.to_thread(self._set, key, value)
+
+    async def clear(self):
+        async with self._lock:
+            await asyncio.to_thread(self._connection.execute, "DELETE FROM responses")
+            self._entries = 0
+
+    def stats(self) -> Dict:
+        # 接続を使わずに見積もりの件数を返す（get/set と同時に実行されても安全）
+        return {
+            "entries": self._entries, "max_entries": self.max_entries,
+            "evictions": self.evictions, "path": self.path
+        }
+
+    async def close(self):
+        async with self._lock:
+            self._connection.close()
+
+
+def create_response_cache_backend(name: str, max_entries: int, ttl: float, path: str) -> ResponseCacheBackend:
+    """設定名から応答キャッシュの保存先を作成"""
+    if name == "memory":
+        return MemoryResponseCacheBackend(max_entries, ttl)
+    if name == "disk":
+        return DiskResponseCacheBackend(path, max_entries, ttl)
+    raise ValueError(f"Unknown response cache backend: {name}")
+
+
+class ResponseCache:
+    """正規化したプロンプトをキーに応答を保存・取得する"""
+
+    def __init__(self, backend: Optional[ResponseCacheBackend], deployment: str, system_prompt: str):
+        self.backend = backend
+        self.deployment = deployment
+        self.system_prompt = system_prompt
+
+        self.hits = 0
+        self.misses = 0
+        self.bypasses = 0
+        self.stores = 0
+        self.errors = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.backend is not None
+
+    def key(self, prompt: str) -> str:
+        return build_cache_key(prompt, self.deployment, self.system_prompt)
+
+    def after_fork(self):
+        if self.backend is not None:
+            self.backend.after_fork()
+
+    def record_bypass(self):
+        self.bypasses += 1
+
+    async def get(self, prompt: str) -> Optional[str]:
+        """キャッシュされた応答を取得（キャッシュの障害時はミスとして扱う）"""
+        if not self.enabled:
+            return None
+        try:
+            value = await self.backend.get(self.key(prompt))
+        except Exception as e:
+            self.errors += 1
+            logger.warning(f"Response cache lookup failed: {e}")
+            value = None
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    async def set(self, prompt: str, response: str):
+        """応答を保存"""
+        if not self.enabled:
+            return
+        try:
+            await self.backend.set(self.key(prompt), response)
+            self.stores += 1
+        except Exception as e:
+            self.errors += 1
+            logger.warning(f"Response cache store failed: {e}")
+
+    def stats(self) -> Dict:
+        """ヒット率などの統計情報を取得"""
+        lookups = self.hits + self.misses
+        stats = {
+            "enabled": self.enabled,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits / lookups) if lookups else 0.0,
+            "bypasses": self.bypasses,
+            "stores": self.stores,
+            "errors": self.errors,
+        }
+        if self.enabled:
+            stats.update(self.backend.stats())
+        return stats
+
+    async def close(self):
+        if self.enabled:
+            await self.backend.close()
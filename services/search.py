@@ -0,0 +1,90 @@
+"""
+会話履歴の全文検索クエリを組み立てる（CLIとAPIで共通）
+
+chat_messages の (message, response) に ngram パーサーの FULLTEXT インデックス
+（setup_database.py で作成）がある場合は MATCH ... AGAINST で関連度順に検索し、
+インデックスがない場合やトークン長より短い語のみの場合は LIKE 検索に切り替える。
+"""
+
+import re
+from typing import List, Optional, Tuple
+
+FULLTEXT_INDEX_NAME = "ft_message_response"
+
+# MySQLの既定の ngram_token_size
+NGRAM_TOKEN_SIZE = 2
+
+SEARCH_COLUMNS = "id, session_id, user_email, message, response, created_at"
+
+MODE_FULLTEXT = "fulltext"
+MODE_LIKE = "like"
+
+_BOOLEAN_OPERATORS = re.compile(r'[+\-<>()~*"@]')
+
+FULLTEXT_INDEX_EXISTS_QUERY = """
+SELECT COUNT(*) FROM information_schema.statistics
+WHERE table_schema = DATABASE() AND table_name = 'chat_messages' AND index_name = %s
+"""
+
+
+def split_terms(search_term: str) -> List[str]:
+    """検索語を空白で分割し、ブール検索の演算子を取り除く"""
+    return [term for term in (_BOOLEAN_OPERATORS.sub(" ", part).strip() for part in search_term.split()) if term]
+
+
+def choose_mode(terms: List[str], has_fulltext_index: bool) -> str:
+    """検索方式を決定"""
+    if has_fulltext_index and terms and all(len(term) >= NGRAM_TOKEN_SIZE for term in terms):
+        return MODE_FULLTEXT
+    return MODE_LIKE
+
+
+def build_search_query(
+    search_term: str,
+    has_fulltext_index: bool,
+    limit: int = 50,
+    page: int = 1,
+    user_email: Optional[str] = None
+) -> Tuple[str, list, str]:
+    """検索SQL・パラメータ・検索方式を返す"""
+    terms = split_terms(search_term)
+    mode = choose_mode(terms, has_fulltext_index)
+    offset = (max(page, 1) - 1) * limit
+
+    if mode == MODE_FULLTEXT:
+        # すべての語を含む（各語はフレーズとして一致させる）
+        against = " ".join(f'+"{term}"' for term in terms)
+        query = f"""
+        SELECT {SEARCH_COLUMNS},
+            MATCH(message, response) AGAINST (%s IN BOOLEAN MODE) AS score
+        FROM chat_messages
+        WHERE MATCH(message, response) AGAINST (%s IN BOOLEAN MODE)
+        """
+        params: list = [against, against]
+        if user_email:
+            query += " AND user_email = %s"
+            params.append(user_email)
+        query += " ORDER BY score DESC, id DESC LIMIT %s OFFSET %s"
+        params.extend((limit, offset))
+        return query, params, mode
+
+    # LIKE検索（全件走査になるため関連度は計算せず新しい順）
+    like_terms = terms or [search_term]
+    patterns = [f"%{_escape_like(term)}%" for term in like_terms]
+    conditions = " AND ".join(["(message LIKE %s OR response LIKE %s)"] * len(patterns))
+    query = f"""
+    SELECT {SEARCH_COLUMNS}, NULL AS score
+    FROM chat_messages
+    WHERE {conditions}
+    """
+    params = [pattern for pattern in patterns for _ in range(2)]
+    if user_email:
+        query += " AND user_email = %s"
+        params.append(user_email)
+    query += " ORDER BY created_at DESC, id DESC LIMIT %s OFFSET %s"
+    params.extend((limit, offset))
+    return query, params, mode
+
+
+def _escape_like(term: str) -> str:
+    return term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
@@ -0,0 +1,170 @@
+"""
+同一キーの同時実行をまとめる（single-flight）
+
+同じ質問が短時間に集中した場合に、実行中の1回の呼び出し結果を
+後から来た呼び出し元と共有する。共有中の呼び出しは待機者が
+1人でも残っている限り継続し、全員がキャンセルした場合のみ中断される。
+"""
+
+import asyncio
+import logging
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class _Flight:
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    """同一キーのコルーチンを1回だけ実行し、結果（または例外）を全員に返す"""
+
+    def __init__(self):
+        self._flights: Dict[str, _Flight] = {}
+        self.calls = 0
+        self.coalesced = 0
+        self.cancelled = 0
+
+    async def do(self, key: str, factory: Callable[[], Awaitable[Any]]) -> Any:
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = _Flight(asyncio.create_task(factory()))
+            self._flights[key] = flight
+            flight.task.add_done_callback(lambda _, key=key, flight=flight: self._finish(key, flight))
+            self.calls += 1
+        else:
+            self.coalesced += 1
+
+        flight.waiters += 1
+        try:
+            # 呼び出し元がキャンセルされても共有中のタスクは止めない
+            return await asyncio.shield(flight.task)
+        except asyncio.CancelledError:
+            if flight.waiters == 1 and not flight.task.done():
+                # 最後の待機者がいなくなった場合のみ中断する（後から来た呼び出しが中断済みの結果を待たないよう先に外す）
+                self._remove(key, flight)
+                flight.task.cancel()
+                self.cancelled += 1
+            raise
+        finally:
+            flight.waiters -= 1
+
+    def _remove(self, key: str, flight: _Flight):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+    def _finish(self, key: str, flight: _Flight):
+        self._remove(key, flight)
+        if flight.task.cancelled():
+            return
+        # 待機者が全員キャンセル済みの場合に例外が未取得のまま残らないようにする
+        flight.task.exception()
+
+    def in_flight(self) -> int:
+        return len(self._flights)
+
+    def stats(self) -> Dict:
+        return {
+            "calls": self.calls,
+            "coalesced": self.coalesced,
+            "cancelled": self.cancelled,
+            "in_flight": self.in_flight(),
+        }
+
+
+class _Broadcast:
+    """1つの非同期イテレータの出力を複数の購読者に配信する"""
+
+    def __init__(self):
+        self.chunks: List[Any] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.subscribers = 0
+        self.task: Optional[asyncio.Task] = None
+        self._changed = asyncio.Event()
+
+    def _notify(self):
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    async def run(self, source: AsyncIterator[Any]):
+        try:
+            async for chunk in source:
+                self.chunks.append(chunk)
+                self._notify()
+        except asyncio.CancelledError:
+            self.error = asyncio.CancelledError()
+            raise
+        except Exception as e:
+            self.error = e
+        finally:
+            aclose = getattr(source, "aclose", None)
+            if aclose:
+                await aclose()
+            self.done = True
+            self._notify()
+
+    async def subscribe(self) -> AsyncIterator[Any]:
+        # 途中から参加した購読者にもそれまでのチャンクを先頭から配信する
+        index = 0
+        while True:
+            if index < len(self.chunks):
+                yield self.chunks[index]
+                index += 1
+                continue
+            if self.done:
+                if self.error is not None:
+                    raise self.error
+                return
+            await self._changed.wait()
+
+
+class SingleFlightStream:
+    """同一キーのストリームを1本だけ開き、同時に要求した全員で共有する"""
+
+    def __init__(self):
+        self._broadcasts: Dict[str, _Broadcast] = {}
+        self.streams = 0
+        self.coalesced = 0
+        self.cancelled = 0
+
+    async def subscribe(self, key: str, factory: Callable[[], AsyncIterator[Any]]) -> AsyncIterator[Any]:
+        broadcast = self._broadcasts.get(key)
+        if broadcast is None:
+            broadcast = _Broadcast()
+            broadcast.task = asyncio.create_task(broadcast.run(factory()))
+            broadcast.task.add_done_callback(lambda _, key=key, broadcast=broadcast: self._finish(key, broadcast))
+            self._broadcasts[key] = broadcast
+            self.streams += 1
+        else:
+            self.coalesced += 1
+
+        broadcast.subscribers += 1
+        try:
+            async for chunk in broadcast.subscribe():
+                yield chunk
+        finally:
+            broadcast.subscribers -= 1
+            if broadcast.subscribers == 0 and not broadcast.done:
+                # 購読者が全員切断した場合のみ元のストリームを閉じる（後から来た購読者が中断済みの配信に参加しないよう先に外す）
+                self._finish(key, broadcast)
+                broadcast.task.cancel()
+                self.cancelled += 1
+
+    def _finish(self, key: str, broadcast: _Broadcast):
+        if self._broadcasts.get(key) is broadcast:
+            del self._broadcasts[key]
+
+    def in_flight(self) -> int:
+        return len(self._broadcasts)
+
+    def stats(self) -> Dict:
+        return {
+            "streams": self.streams,
+            "coalesced": self.coalesced,
+            "cancelled": self.cancelled,
+            "in_flight": self.in_flight(),
+        }
@@ -6,7 +6,10 @@
 import mysql.connector
 from mysql.connector import Error
 import logging
+from azure.cosmos import CosmosClient, PartitionKey, exceptions
 from config.settings import settings
+from services.cosmosdb_service import INDEXING_POLICY
+from services.search import FULLTEXT_INDEX_NAME
 
 # ログ設定
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -64,7 +67,8 @@ def create_tables(cursor):
         updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
         INDEX idx_user_email (user_email),
         INDEX idx_session_id (session_id),
-        INDEX idx_created_at (created_at)
+        INDEX idx_created_at (created_at),
+        INDEX idx_user_email_created_at (user_email, created_at)
     ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
     """
     
@@ -82,7 +86,8 @@ def create_tables(cursor):
         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
         INDEX idx_session_id (session_id),
         INDEX idx_user_email (user_email),
-        INDEX idx_created_at (created_at)
+        INDEX idx_created_at (created_at),
+        INDEX idx_user_email_created_at (user_email, created_at)
     ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
     """
     
@@ -107,6 +112,66 @@ def create_tables(cursor):
     
     cursor.execute(create_user_stats_table)
     logger.info("Table 'user_stats' created or verified successfully")
+    
+    # 既存のテーブルに不足しているインデックスを追加
+    create_indexes(cursor)
+
+def create_indexes(cursor):
+    """既存のテーブルに後から追加したインデックスを作成"""
+    indexes = [
+        # キーセットページネーション用（InnoDBではidも末尾に含まれる）
+        ("chat_sessions", "idx_user_email_created_at", "INDEX idx_user_email_created_at (user_email, created_at)"),
+        ("chat_messages", "idx_user_email_created_at", "INDEX idx_user_email_created_at (user_email, created_at)"),
+        # 日本語を含む会話の全文検索用（ngramパーサー）
+        ("chat_messages", FULLTEXT_INDEX_NAME,
+         f"FULLTEXT INDEX {FULLTEXT_INDEX_NAME} (message, response) WITH PARSER ngram"),
+    ]
+    
+    for table, index_name, definition in indexes:
+        cursor.execute(
+            """
+            SELECT COUNT(*) FROM information_schema.statistics
+            WHERE table_schema = DATABASE() AND table_name = %s AND index_name = %s
+            """,
+            (table, index_name)
+        )
+        if cursor.fetchone()[0] == 0:
+            cursor.execute(f"ALTER TABLE {table} ADD {definition}")
+            logger.info(f"Index '{index_name}' added to '{table}'")
+
+def setup_cosmosdb():
+    """CosmosDBのデータベースとコンテナを作成し、インデックスポリシーを適用"""
+    try:
+        client = CosmosClient(settings.COSMOSDB_ENDPOINT, settings.COSMOSDB_KEY)
+        database = client.create_database_if_not_exists(id=settings.COSMOSDB_DATABASE_NAME)
+        
+        partition_key = PartitionKey(path="/user_email")
+        container = database.create_container_if_not_exists(
+            id=settings.COSMOSDB_CONTAINER_NAME,
+            partition_key=partition_key,
+            indexing_policy=INDEXING_POLICY,
+            offer_throughput=400
+        )
+        
+        # 既存のコンテナにも複合インデックスを反映（インデックスの再構築はバックグラウンドで行われる）
+        properties = container.read()
+        if properties.get("indexingPolicy", {}).get("compositeIndexes") != INDEXING_POLICY["compositeIndexes"]:
+            database.replace_container(
+                container,
+                partition_key=partition_key,
+                indexing_policy=INDEXING_POLICY
+            )
+            logger.info("CosmosDB indexing policy updated")
+        
+        logger.info(
+            f"CosmosDB container '{settings.COSMOSDB_DATABASE_NAME}/{settings.COSMOSDB_CONTAINER_NAME}' "
+            f"created or verified successfully"
+        )
+        return True
+        
+    except exceptions.CosmosHttpResponseError as e:
+        logger.error(f"Error setting up CosmosDB: {e}")
+        return False
 
 def verify_connection():
     """データベース接続をテスト"""
@@ -167,12 +232,20 @@ def main():
         create_database()
         
         # 接続テスト
-        if verify_connection():
-            logger.info("✅ Database setup completed successfully!")
-            return True
-        else:
+        if not verify_connection():
             logger.error("❌ Database setup failed during verification")
             return False
+        
+        # CosmosDBのコンテナとインデックスポリシー
+        if settings.COSMOSDB_ENDPOINT and settings.COSMOSDB_KEY:
+            if not setup_cosmosdb():
+                logger.error("❌ CosmosDB setup failed")
+                return False
+        else:
+            logger.info("CosmosDB configuration not found; skipping CosmosDB setup")
+        
+        logger.info("✅ Database setup completed successfully!")
+        return True
             
     except Exception as e:
         logger.error(f"❌ Database setup failed: {e}")
@@ -0,0 +1,91 @@
+"""
+/chat へのリクエストがイベントループを止めずに並行して進むことの確認
+
+アプリケーションに異なる質問の /chat を同時に送り、ローカルの代替OpenAIサーバー
+（一定の遅延で応答）でもすべての呼び出しが同時に処理され、全体の所要時間が
+遅延1回分程度であることを確かめる。認証は依存関係の上書きで通し、
+MySQLのセッション管理と会話履歴の保存先はメモリ上の代替に置き換える。
+"""
+
+import asyncio
+import time
+from typing import List
+import httpx
+import pytest
+from benchmarks.fakes import FakeOpenAIServer
+from config.settings import settings
+from dependencies.security import get_current_user
+from main import app
+from models.chat_models import ConversationRecord
+from routes import chat_routes
+from services.azure_openai_service import AzureOpenAIService
+
+LATENCY = 0.5
+CONCURRENCY = 10
+USER_EMAIL = "user@example.com"
+
+
+@pytest.fixture
+def openai_server(monkeypatch):
+    server = FakeOpenAIServer(latency=LATENCY).start()
+    monkeypatch.setattr(settings, "AZURE_OPENAI_ENDPOINT", server.url)
+    monkeypatch.setattr(settings, "AZURE_OPENAI_API_KEY", "test")
+    monkeypatch.setattr(settings, "AZURE_OPENAI_DEPLOYMENT_NAME", "test")
+    # 集約されると1回の呼び出しになるため無効にする
+    monkeypatch.setattr(settings, "AZURE_OPENAI_COALESCE_REQUESTS", False)
+    monkeypatch.setattr(settings, "RESPONSE_CACHE_ENABLED", False)
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def saved(monkeypatch) -> List[ConversationRecord]:
+    """MySQL・CosmosDBの代わりに会話履歴をメモリに保存する"""
+    records: List[ConversationRecord] = []
+
+    async def get_or_create_session(user_email: str) -> str:
+        await asyncio.sleep(0.01)
+        return "session"
+
+    async def write(batch: List[ConversationRecord]):
+        await asyncio.sleep(0.01)
+        records.extend(batch)
+
+    monkeypatch.setattr(chat_routes.mysql_service, "get_or_create_session", get_or_create_session)
+    monkeypatch.setattr(settings, "WRITE_BEHIND_ENABLED", False)
+    monkeypatch.setattr(chat_routes.concurrent_writer, "backends", {"mysql": write, "cosmosdb": write})
+    return records
+
+
+def test_concurrent_chat_requests_overlap(openai_server, saved, monkeypatch):
+    service = AzureOpenAIService()
+    monkeypatch.setattr(chat_routes, "azure_openai_service", service)
+    app.dependency_overrides[get_current_user] = lambda: {"email": USER_EMAIL}
+
+    async def run():
+        # lifespan（バックエンドへの接続）は起動しない
+        transport = httpx.ASGITransport(app=app)
+        try:
+            async with httpx.AsyncClient(transport=transport, base_url="http://testserver") as client:
+                start = time.perf_counter()
+                responses = await asyncio.gather(*(
+                    client.post("/chat", json={"message": f"質問 {i}", "user_email": USER_EMAIL})
+                    for i in range(CONCURRENCY)
+                ))
+                return time.perf_counter() - start, responses
+        finally:
+            await service.close()
+
+    try:
+        elapsed, responses = asyncio.run(run())
+    finally:
+        app.dependency_overrides.pop(get_current_user, None)
+
+    assert [response.status_code for response in responses] == [200] * CONCURRENCY
+    assert {response.json()["response"] for response in responses} == {"ベンチマーク" * openai_server.tokens}
+    assert openai_server.requests == CONCURRENCY
+    assert openai_server.max_in_flight == CONCURRENCY
+    # MySQL・CosmosDBの両方に保存される
+    assert sorted(record.message for record in saved) == sorted(f"質問 {i}" for i in range(CONCURRENCY) for _ in range(2))
+    # 直列に処理されていれば LATENCY * CONCURRENCY かかる
+    assert elapsed < LATENCY * 2
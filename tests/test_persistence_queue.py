@@ -0,0 +1,66 @@
+"""
+write-behindキューで書き込めない記録があっても後続の記録が詰まらないことの確認
+
+特定の記録だけ必ず失敗するバックエンドに対してキューの上限を超える件数を投入し、
+投入が待機時間内に完了すること、他の記録はすべて書き込まれること、
+失敗し続ける記録は dead-letter（ReconciliationLog）に移されることを確かめる。
+"""
+
+import asyncio
+import json
+from typing import List
+from models.chat_models import ConversationRecord
+from services.persistence_queue import ReconciliationLog, WriteBehindQueue
+
+POISON = "poison"
+
+
+def _record(message: str) -> ConversationRecord:
+    return ConversationRecord(
+        user_email="user@example.com", session_id="session", message=message, response="response"
+    )
+
+
+def test_poison_record_is_dead_lettered_while_queue_drains(tmp_path):
+    written: List[str] = []
+
+    async def writer(records: List[ConversationRecord]):
+        await asyncio.sleep(0.01)
+        if any(record.message == POISON for record in records):
+            raise RuntimeError("Data too long for column 'message'")
+        written.extend(record.message for record in records)
+
+    dead_letter = ReconciliationLog(str(tmp_path / "reconciliation.jsonl"))
+    queue = WriteBehindQueue(
+        backends={"mysql": writer},
+        max_queue_size=5,
+        batch_size=5,
+        flush_interval=0.01,
+        enqueue_timeout=2.0,
+        max_retries=2,
+        max_backoff=0.01,
+        spill_path=str(tmp_path / "spill.jsonl"),
+        dead_letter=dead_letter
+    )
+    messages = [POISON] + [f"message {i}" for i in range(30)]
+
+    async def run():
+        await queue.start()
+        try:
+            for message in messages:
+                await queue.enqueue(_record(message))
+        finally:
+            await queue.stop(timeout=5.0)
+
+    asyncio.run(run())
+
+    assert sorted(written) == sorted(messages[1:])
+    stats = queue.stats()
+    assert stats["rejected"] == 0
+    assert stats["pending"] == 0
+    assert stats["backends"]["mysql"]["dead_lettered"] == 1
+    assert stats["backends"]["mysql"]["flushed"] == len(messages) - 1
+
+    with open(dead_letter.path, encoding="utf-8") as f:
+        entries = [json.loads(line) for line in f]
+    assert [(entry["backend"], entry["record"]["message"]) for entry in entries] == [("mysql", POISON)]